@@ -1,23 +1,59 @@
 #!/usr/bin/python3
+import ast
+import bisect
+import builtins
+import codecs
+import collections
+import concurrent.futures
 import curses
+import functools
+import hashlib
+import json
+import keyword
+import math
+import multiprocessing
+import queue
+import random
 import sys
 import os
 import re
+import struct
+import subprocess
+import threading
+import time
+import unicodedata
+import zlib
 
 KEY_F3 = "KEY_F(3)"
+KEY_F4 = "KEY_F(4)"
 KEY_SHIFT_F3 = "KEY_F(15)"
 KEY_CTRL_F3 = "KEY_F(27)"
 KEY_ALT_F3 = "KEY_F(51)"
-
+KEY_F6 = "KEY_F(6)"
+KEY_F7 = "KEY_F(7)"
+KEY_SHIFT_F7 = "KEY_F(19)"
+KEY_F8 = "KEY_F(8)"
+KEY_F9 = "KEY_F(9)"
+KEY_F10 = "KEY_F(10)"
+KEY_SHIFT_F10 = "KEY_F(22)"
+KEY_F12 = "KEY_F(12)"
+
+KEY_CTRL_SPACE = "\x00"
 KEY_CTRL_A = "\x01"
+KEY_CTRL_B = "\x02"
 KEY_CTRL_Z = "\x1a"
 KEY_CTRL_Y = "\x19"
 KEY_CTRL_F = "\x06"
 KEY_CTRL_G = "\x07"
+KEY_CTRL_K = "\x0b"
+KEY_CTRL_L = "\x0c"
 KEY_CTRL_P = "\x10"
 KEY_CTRL_D = "\x04"
+KEY_CTRL_E = "\x05"
 KEY_CTRL_R = "\x12"
 KEY_CTRL_S = "\x13"
+KEY_CTRL_T = "\x14"
+KEY_CTRL_U = "\x15"
 KEY_CTRL_W = "\x17"
 KEY_CTRL_X = "\x18"
 KEY_CTRL_O = "\x0f"
@@ -27,8 +63,14 @@ KEY_CTRL_Q = "\x11"
 KEY_CTRL_BACKSPACE = "\x08"
 KEY_CTRL_DELETE = "kDC5"
 KEY_ESC = "\x1b"
+KEY_CTRL_RIGHT_BRACKET = "\x1d"
+KEY_CTRL_BACKSLASH = "\x1c"
 KEY_SHIFT_ALT_DOWN = "kDN4"
 KEY_SHIFT_ALT_UP = "kUP4"
+KEY_CTRL_ALT_DOWN = "kDN7"
+KEY_CTRL_ALT_UP = "kUP7"
+KEY_CTRL_ALT_LEFT = "kLFT7"
+KEY_CTRL_ALT_RIGHT = "kRIT7"
 KEY_CTRL_SHIFT_LEFT = "kLFT6"
 KEY_CTRL_LEFT = "kLFT5"
 KEY_CTRL_SHIFT_RIGHT = "kRIT6"
@@ -47,786 +89,4815 @@ def pad(text, chars):
     return text + " " * (chars - len(text))
 
 
-class FileSet:
-    def __init__(self, namesToPaths):
-        self.namesToPaths = namesToPaths
-        self.sortedNames = sorted(namesToPaths)
+# tabs run to the next multiple of this many cells
+TAB_WIDTH = 4
 
-    def readlines(self, path):
-        def stripnewline(x):
-            if x.endswith("\n"):
-                return x[:-1]
-            return x
+# what the gutter shows for lines that differ from the saved file, or
+# (drawn dimmer) from the version committed at HEAD
+CHANGE_MARKERS = {
+    "added": "+", "modified": "~", "deleted": "_",
+    "headAdded": "+", "headModified": "~", "headDeleted": "_",
+}
 
-        with open(path, "r") as f:
-            return [stripnewline(x) for x in f.readlines()]
 
-    def writelines(self, path, lines):
-        with open(path, "w") as f:
-            f.write("".join([x + "\n" for x in lines]))
+def charWidth(c, cell):
+    """How many screen cells 'c' takes if it starts at 'cell'."""
+    if c == "\t":
+        return TAB_WIDTH - cell % TAB_WIDTH
+    if c < "\x7f":
+        return 1
+    if unicodedata.combining(c):
+        return 0
+    if unicodedata.east_asian_width(c) in ("W", "F"):
+        return 2
+    return 1
 
 
-class Display:
-    """Baseclass for all things that make little windows."""
-    def __init__(self, context):
-        self.context = context
+@functools.lru_cache(maxsize=1024)
+def columnMap(text):
+    """Return the screen cell each column of 'text' starts at, plus the cell its end is at.
 
-    def textWithCursors(self, x0, y0, text, cursors):
-        self.context.stdscr.addstr(y0, x0, text)
+    Returns None if every character takes exactly one cell, which is almost
+    always the case. Lines are interned, so this caches one map per distinct
+    line we've drawn recently.
+    """
+    if text.isascii() and "\t" not in text:
+        return None
 
-        for i in cursors:
-            self.context.stdscr.chgat(y0, x0 + i, 1, self.context.stdscr.A_STANDOUT)
+    cells = [0] * (len(text) + 1)
+    cell = 0
 
-    def lightText(self, x0, y0, text):
-        self.context.stdscr.addstr(y0, x0, text)
-        self.context.stdscr.chgat(y0, x0, len(text), self.context.stdscr.A_DIM)
+    for i, c in enumerate(text):
+        cells[i] = cell
+        cell += charWidth(c, cell)
 
-    def textBold(self, x0, y0, text):
-        self.context.stdscr.addstr(y0, x0, text)
-        self.context.stdscr.chgat(y0, x0, len(text), self.context.stdscr.A_BOLD)
+    cells[-1] = cell
 
-    def highlightedText(self, x0, y0, text):
-        self.context.stdscr.addstr(y0, x0, text)
-        self.context.stdscr.chgat(y0, x0, len(text), self.context.stdscr.A_STANDOUT)
+    return cells
 
-    def text(self, x0, y0, text):
-        self.context.stdscr.addstr(y0, x0, text)
 
-    def box(self, x0, y0, x1, y1, clear=False):
-        self.context.stdscr.addch(y0, x0, self.context.stdscr.ACS_ULCORNER)
-        self.context.stdscr.addch(y1, x0, self.context.stdscr.ACS_LLCORNER)
-        self.context.stdscr.addch(y0, x1, self.context.stdscr.ACS_URCORNER)
-        self.context.stdscr.addch(y1, x1, self.context.stdscr.ACS_LRCORNER)
-        self.context.stdscr.hline(y0, x0 + 1, self.context.stdscr.ACS_HLINE, x1 - x0 - 1)
-        self.context.stdscr.hline(y1, x0 + 1, self.context.stdscr.ACS_HLINE, x1 - x0 - 1)
-        self.context.stdscr.vline(y0 + 1, x0, self.context.stdscr.ACS_VLINE, y1 - y0 - 1)
-        self.context.stdscr.vline(y0 + 1, x1, self.context.stdscr.ACS_VLINE, y1 - y0 - 1)
+def cellOfCol(text, col):
+    """The screen cell column 'col' of 'text' starts at. Columns past the end take a cell each."""
+    cells = columnMap(text)
 
-        if clear:
-            for row in range(y0 + 1, y1):
-                self.text(x0 + 1, row, " " * (x1 - x0 - 2))
+    if cells is None:
+        return col
 
-    def receiveChar(self, char):
-        pass
+    if col >= len(text):
+        return cells[-1] + col - len(text)
 
-    def resized(self):
-        pass
+    return cells[col]
 
-    def redraw(self):
-        pass
 
+def colOfCell(text, cell):
+    """The first column of 'text' that starts at or after screen cell 'cell'."""
+    cells = columnMap(text)
 
+    if cells is None:
+        return cell
 
-class DirFileSet(FileSet):
-    def __init__(self, directory):
-        self.directory = os.path.abspath(directory)
+    if cell >= cells[-1]:
+        return len(text) + cell - cells[-1]
 
-        names = {}
-        def walk(subdir):
-            for badDir in ["__pycache__", ".git"]:
-                if subdir.endswith("/" + badDir) or subdir == badDir:
-                    return
+    return bisect.bisect_left(cells, cell)
 
-            if subdir.split("/")[0].startswith("."):
-                return
 
-            dirPart = [subdir] if subdir is not None else []
-            ownDir = os.path.join(self.directory, *dirPart)
+def cellText(text, col0, col1, cell0, width):
+    """The columns [col0, col1) of 'text' laid out in 'width' cells, the first of which is cell 'cell0' of the line.
 
-            for f in os.listdir(ownDir):
-                if os.path.isfile(os.path.join(ownDir, f)):
-                    names[os.path.join(*dirPart, f)] = os.path.join(ownDir, f)
-                elif os.path.isdir(os.path.join(ownDir, f)):
-                    walk(os.path.join(*dirPart, f))
+    Tabs become spaces, and a wide character that would hang off the right
+    edge is left out.
+    """
+    cells = columnMap(text)
 
-        walk("")
+    if cells is None:
+        return pad(" " * (col0 - cell0) + text[col0:min(col1, col0 + width)], width)
 
-        super().__init__(names)
+    x = cellOfCol(text, col0) - cell0
+    pieces = [" " * x]
 
+    for i in range(col0, min(col1, len(text))):
+        w = cells[i + 1] - cells[i]
 
-class FindBox(Display):
-    def __init__(self, context):
-        super().__init__(context)
+        if x + w > width:
+            break
 
-        self.regex = False
-        self.wholeWord = False
-        self.caseSensitive = False
+        pieces.append(" " * w if text[i] == "\t" else text[i])
+        x += w
 
-        self.visible = False
-        self.showReplace = False
-        self.allFiles = False
+    return "".join(pieces) + " " * (width - x)
 
-        self.pattern = ""
-        self.cursor = 0
 
-    def curHeight(self):
-        return 1
+def wrapPoints(text, width):
+    """Return the columns where each screen row of 'text' starts, wrapped to 'width' cells.
 
-    def setPattern(self, pattern):
-        self.pattern = pattern
+    Rows break after the last space in their second half if there is one. The
+    last row is always narrower than 'width', so there's room for a cursor at
+    the end of the line.
+    """
+    points = [0]
 
-        openFile = self.context.currentOpenFile()
+    if width <= 0:
+        return points
 
-        if openFile is not None:
-            selections = openFile.findAll(pattern)
+    cells = columnMap(text)
+    start = 0
 
-            if selections:
-                openFile.ensureOnScreen(selections[0])
+    while cellOfCol(text, len(text)) - cellOfCol(text, start) >= width:
+        if cells is None:
+            end = start + width
+        else:
+            # as many columns as fit, but always at least one
+            end = max(start + 1, bisect.bisect_right(cells, cells[start] + width) - 1)
 
-    def redraw(self):
-        ypos = self.context.windowY - 2
-        width = self.context.windowX
-        self.text(0, ypos, " " * width)
-        self.textBold(0, ypos, "FIND:")
-        self.textWithCursors(6, ypos, pad(self.pattern, width - 6), [self.cursor])
+        space = text.rfind(" ", start + (end - start) // 2, end)
 
-    def receiveChar(self, char):
-        if char == KEY_ESC:
-            self.visible = False
-            return True
+        if space >= 0:
+            end = space + 1
 
-        if char == "KEY_BACKSPACE" and self.cursor > 0:
-            self.setPattern(self.pattern[:self.cursor - 1] + self.pattern[self.cursor:])
-            self.cursor -= 1
-            return True
+        points.append(end)
+        start = end
 
-        if char == KEY_CTRL_BACKSPACE:
-            self.setPattern(self.pattern[self.cursor:])
-            self.cursor = 0
-            return True
+    return points
 
-        if char == KEY_CTRL_DELETE:
-            self.setPattern(self.pattern[:self.cursor])
-            return True
 
-        if char == "KEY_DC" and self.cursor < len(self.pattern):
-            self.setPattern(self.pattern[:self.cursor] + self.pattern[self.cursor + 1:])
-            return True
+def formatBytes(byteCount):
+    for unit in ["b", "k", "M"]:
+        if byteCount < 1024:
+            return f"{byteCount:.0f}{unit}" if unit == "b" else f"{byteCount:.1f}{unit}"
+        byteCount /= 1024
+    return f"{byteCount:.1f}G"
 
-        if char == "KEY_LEFT":
-            self.cursor = max(0, self.cursor - 1)
-            return True
 
-        if char == "KEY_RIGHT":
-            self.cursor = min(len(self.pattern), self.cursor + 1)
-            return True
+def linesMemoryUsage(lines, seen):
+    """Bytes used by a list of lines, not counting strings whose ids are in 'seen'.
 
-        if char in ("\n", KEY_CTRL_A):
-            openFile = self.context.currentOpenFile()
+    Snapshots of a buffer share most of their string objects, so callers pass
+    the same 'seen' set across all the line lists they want to account for
+    and each string gets charged to the first list that holds it.
+    """
+    total = sys.getsizeof(lines)
 
-            if openFile is not None:
-                if char == "\n":
-                    curSel = openFile.selections[-1]
-                    newSel = openFile.find(self.pattern, (curSel.line1, curSel.col1))
-                    if newSel is None:
-                        newSel = openFile.find(self.pattern, (0, 0))
+    for line in lines:
+        if id(line) not in seen:
+            seen.add(id(line))
+            total += sys.getsizeof(line)
 
-                    if newSel is not None:
-                        openFile.selections = [newSel]
-                else:
-                    openFile.selections = openFile.findAll(self.pattern)
+    return total
 
-                if openFile.selections:
-                    openFile.ensureOnScreen(openFile.selections[0])
 
-                self.visible = False
+def commonPrefixLength(a, b, chunk=1024):
+    """The number of leading elements 'a' and 'b' have in common.
 
-            return True
+    Compares whole chunks at a time so that long runs of shared lines are
+    checked at C speed.
+    """
+    n = min(len(a), len(b))
+    i = 0
 
-        if len(char) == 1 and char.isprintable():
-            self.setPattern(self.pattern[:self.cursor] + char + self.pattern[self.cursor:])
-            self.cursor += 1
-            return True
+    while i + chunk <= n and a[i:i + chunk] == b[i:i + chunk]:
+        i += chunk
 
+    while i < n and a[i] == b[i]:
+        i += 1
 
-class DisplayContext:
-    def __init__(self, stdscr, fileSet):
-        self.fileSet = fileSet
-        self.openFiles = {}
-        self.clipboard = None
-        self.clipboardIsWholeLine = False
+    return i
 
-        self.findBox = FindBox(self)
 
-        self.stdscr = stdscr
-        self.windowY, self.windowX = self.stdscr.getmaxyx()
-        self.displays = [DefaultDisplay(self)]
-        self.wantsToExit = False
+def commonSuffixLength(a, b, maxLength, chunk=1024):
+    """The number of trailing elements 'a' and 'b' have in common, up to 'maxLength'."""
+    i = 0
 
-    def pushDisplay(self, display):
-        self.displays.append(display)
-        self.fullRedraw()
+    while i + chunk <= maxLength and a[len(a) - i - chunk:len(a) - i] == b[len(b) - i - chunk:len(b) - i]:
+        i += chunk
 
-    def pushDisplays(self, displays):
-        self.displays.extend(displays)
-        self.fullRedraw()
+    while i < maxLength and a[len(a) - i - 1] == b[len(b) - i - 1]:
+        i += 1
 
-    def currentOpenFile(self):
-        if isinstance(self.displays[-1], FileDisplay):
-            return self.displays[-1]
-        return None
+    return i
 
-    def openFile(self, fileName):
-        self.displays = [d for d in self.displays if not isinstance(d, TextBufferDisplay)]
 
-        if fileName not in self.openFiles:
-            self.openFiles[fileName] = FileDisplay(self, fileName)
+# the most work (roughly lines * edits) we'll do diffing a region with myersDiff
+# before falling back to patienceDiff
+MYERS_BUDGET = 200000
 
-        self.openFiles[fileName].checkDisk()
+# roughly how many lines one diff may look at in all. Past that, whatever it
+# hasn't split up yet is reported as a single hunk, so that something like
+# reversing a million lines can't take minutes.
+DIFF_BUDGET = 1000000
 
-        self.displays.append(self.openFiles[fileName])
 
-        self.fullRedraw()
+def diffLines(a, b, budget=None):
+    """Return the hunks (a0, a1, b0, b1) where a[a0:a1] replaces b[b0:b1], in order.
 
-    def receiveChars(self, *chars):
-        for c in chars:
-            self.receiveChar(c)
+    Everything between the hunks is the same in both. Uses Myers' algorithm
+    when the difference is small, and patience diff to split up big ones.
+    'budget' is a one-item list of how much it may still look at, shared by the recursion.
+    """
+    if budget is None:
+        budget = [DIFF_BUDGET]
 
-    def receiveChar(self, char):
-        if char in (KEY_ALT_PAGE_DOWN, KEY_ALT_PAGE_UP):
-            # alt-page-down/up
-            if self.openFiles:
-                cof = self.currentOpenFile()
-                if cof is not None:
-                    index = sorted(self.openFiles).index(cof.fileName)
-                    index = (index + (1 if char == KEY_ALT_PAGE_DOWN else -1)) % len(self.openFiles)
-                    self.openFile(sorted(self.openFiles)[index])
-            return True
+    prefix = commonPrefixLength(a, b)
+    suffix = commonSuffixLength(a, b, min(len(a), len(b)) - prefix)
 
-        if char == "KEY_RESIZE":
-            self.windowY, self.windowX = self.stdscr.getmaxyx()
+    a0, a1 = prefix, len(a) - suffix
+    b0, b1 = prefix, len(b) - suffix
 
-            for d in self.displays:
-                d.resized()
+    if a0 == a1 and b0 == b1:
+        return []
 
-            self.fullRedraw()
+    if a0 == a1 or b0 == b1 or a1 - a0 + b1 - b0 > budget[0]:
+        return [(a0, a1, b0, b1)]
 
-            return True
+    budget[0] -= a1 - a0 + b1 - b0
 
-        if char == KEY_CTRL_P:
-            self.newWindow(FileSelector(self))
-            return True
+    hunks = myersDiff(a[a0:a1], b[b0:b1], MYERS_BUDGET // (a1 - a0 + b1 - b0), budget)
 
-        if char == KEY_CTRL_O:
-            whichFile = 0
+    if hunks is None:
+        hunks = patienceDiff(a[a0:a1], b[b0:b1], budget)
 
-            if self.displays and isinstance(self.displays[-1], FileDisplay):
-                try:
-                    whichFile = sorted(self.openFiles).index(self.displays[-1].fileName)
-                except ValueError:
-                    pass
+    return [(h[0] + a0, h[1] + a0, h[2] + b0, h[3] + b0) for h in hunks]
 
-            self.newWindow(OpenFiles(self, whichFile))
-            return True
 
-        if self.displays[-1].receiveChar(char):
-            return True
+def hunksBetween(matches, lenA, lenB):
+    """The hunks in between a sorted list of matching (i, j) pairs."""
+    hunks = []
+    i = j = 0
 
-        if char == KEY_CTRL_Q:
-            needClose = [o for o in self.openFiles.values() if o.isChanged()]
-            if not needClose:
-                self.wantsToExit = True
-            else:
-                isFirst = True
-                displays = []
-                for n in needClose:
-                    displays.append(CloseBeforeSavingDialog(self, n, postAction=self.setExitFlag))
-                    isFirst = False
-                self.pushDisplays(displays)
+    for mi, mj in matches + [(lenA, lenB)]:
+        if mi > i or mj > j:
+            hunks.append((i, mi, j, mj))
+        i, j = mi + 1, mj + 1
 
-            return True
+    return hunks
 
-    def setExitFlag(self):
-        self.wantsToExit = True
 
-    def removeDisplay(self, disp):
-        self.displays.remove(disp)
+def myersDiff(a, b, maxEdits, budget=None):
+    """Myers' O((N+M)D) diff. Returns hunks like 'diffLines', or None if it takes more than 'maxEdits' edits.
 
-        if len(self.displays) == 0:
-            self.displays.append(DefaultDisplay(self))
+    Also gives up if it uses up 'budget', as for 'diffLines'.
+    """
+    n, m = len(a), len(b)
+    maxEdits = min(n + m, maxEdits)
 
-        self.fullRedraw()
+    # diagonals run from -maxEdits to maxEdits
+    offset = maxEdits + 1
 
-    def fullRedraw(self):
-        self.stdscr.erase()
+    v = [0] * (2 * offset + 1)
+    trace = []
 
-        for disp in self.displays:
-            disp.redraw()
+    for d in range(maxEdits + 1):
+        if budget is not None:
+            budget[0] -= d + 1
+            if budget[0] <= 0:
+                return None
 
-    def newWindow(self, window):
-        self.displays.append(window)
-        window.redraw()
+        trace.append(list(v[offset - d:offset + d + 1]))
 
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+                x = v[offset + k + 1]
+            else:
+                x = v[offset + k - 1] + 1
 
-class Selection:
-    def __init__(self, line0, col0, line1, col1):
-        self.line0 = line0
-        self.col0 = col0
-        self.line1 = line1
-        self.col1 = col1
+            y = x - k
 
-    def asTuple(self):
-        # ensure the sort-order is based on the earliest visible point
-        if not self.isOrdered():
-            return (self.line1, self.col1, self.line0, self.col0, 1)
-        else:
-            return (self.line0, self.col0, self.line1, self.col1, 0)
+            while x < n and y < m and a[x] == b[y]:
+                x += 1
+                y += 1
 
-    def isOrdered(self):
-        return (self.line0, self.col0) <= (self.line1, self.col1)
+            v[offset + k] = x
 
-    def overlaps(self, other):
-        t1 = self.asTuple()
-        t2 = other.asTuple()
+            if x >= n and y >= m:
+                return hunksBetween(myersMatches(a, b, trace, d), n, m)
 
-        low1 = (t1[0], t1[1])
-        high1 = (t1[2], t1[3])
+    return None
 
-        low2 = (t2[0], t2[1])
-        high2 = (t2[2], t2[3])
 
-        if low1 > high2:
-            return False
+def myersMatches(a, b, trace, depth):
+    """Walk back through the frontiers 'myersDiff' saved, collecting the (i, j) pairs of matching lines."""
+    matches = []
+    x, y = len(a), len(b)
 
-        if low2 > high1:
-            return False
+    for d in range(depth, 0, -1):
+        # trace[d] holds the frontier after d - 1 edits, for diagonals -d..d
+        v = trace[d]
+        k = x - y
 
-        return True
+        if k == -d or (k != d and v[k - 1 + d] < v[k + 1 + d]):
+            prevK = k + 1
+        else:
+            prevK = k - 1
 
-    def merge(self, other):
-        t1 = self.asTuple()
-        t2 = other.asTuple()
+        prevX = v[prevK + d]
+        prevY = prevX - prevK
 
-        low1 = (t1[0], t1[1])
-        high1 = (t1[2], t1[3])
+        while x > prevX and y > prevY:
+            x -= 1
+            y -= 1
+            matches.append((x, y))
 
-        low2 = (t2[0], t2[1])
-        high2 = (t2[2], t2[3])
+        x, y = prevX, prevY
 
-        low = min(low1, low2)
-        high = min(high1, high2)
+    while x > 0 and y > 0:
+        x -= 1
+        y -= 1
+        matches.append((x, y))
 
-        return Selection(*low, *high)
+    matches.reverse()
 
-    def __eq__(self, other):
-        return self.asTuple() == other.asTuple()
+    return matches
 
-    def __lt__(self, other):
-        return self.asTuple() < other.asTuple()
 
-    def __hash__(self):
-        return hash(self.asTuple())
+def patienceDiff(a, b, budget=None):
+    """Diff by anchoring on the lines that appear exactly once in each, then diffing the gaps.
 
-    def __str__(self):
-        if self.isSingle():
-            return f"{self.line0}:{self.col0}"
+    This never blows up on big changes the way Myers' algorithm can, and
+    tends to line up the structure of code better.
+    """
+    countsA = collections.Counter(a)
+    countsB = collections.Counter(b)
 
-        if self.isSingleLine():
-            return f"{self.line0}:{self.col0}-{self.col1}"
+    indexInA = {line: i for i, line in enumerate(a) if countsA[line] == 1 and countsB.get(line) == 1}
+    pairs = [(indexInA[line], j) for j, line in enumerate(b) if line in indexInA]
 
-        return f"({self.line0}:{self.col0})-({self.line1}:{self.col1})"
+    # the longest run of pairs increasing in both, by patience sorting
+    tops = []
+    topIndices = []
+    back = [None] * len(pairs)
 
-    def __repr__(self):
-        return str(self)
+    for pairIx, (i, j) in enumerate(pairs):
+        pile = bisect.bisect_left(tops, i)
 
-    def isSingle(self):
-        return (self.line0, self.col0) == (self.line1, self.col1)
+        if pile > 0:
+            back[pairIx] = topIndices[pile - 1]
 
-    def isSingleLine(self):
-        return self.line0 == self.line1
+        if pile == len(tops):
+            tops.append(i)
+            topIndices.append(pairIx)
+        else:
+            tops[pile] = i
+            topIndices[pile] = pairIx
 
-    def isTrivial(self):
-        return (self.line0, self.line1, self.col0, self.col1) == (0, 0, 0, 0)
+    if not tops:
+        return [(0, len(a), 0, len(b))]
 
-    def clipToReal(self, lines):
-        l0, c0, l1, c1 = self.line0, self.col0, self.line1, self.col1
+    anchors = []
+    pairIx = topIndices[-1]
+    while pairIx is not None:
+        anchors.append(pairs[pairIx])
+        pairIx = back[pairIx]
+    anchors.reverse()
 
-        if not lines:
-            return Selection(0, 0, 0, 0)
+    hunks = []
+    i = j = 0
 
-        if l0 < 0:
-            l0 = 0
-            c0 = 0
+    for ai, bj in anchors + [(len(a), len(b))]:
+        for h in diffLines(a[i:ai], b[j:bj], budget):
+            hunks.append((h[0] + i, h[1] + i, h[2] + j, h[3] + j))
+        i, j = ai + 1, bj + 1
 
-        if l1 < 0:
-            l1 = 0
-            c1 = 0
+    return hunks
 
-        if l0 >= len(lines):
-            l0 = len(lines) - 1
-            c0 = len(lines[-1])
 
-        if l1 >= len(lines):
-            l1 = len(lines) - 1
-            c1 = len(lines[-1])
+NUMBER_PREFIX = re.compile(r"\s*[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?")
+DIGIT_RUNS = re.compile(r"0*(\d+)")
 
-        if c0 < 0:
-            c0 = 0
-        if c0 > len(lines[l0]):
-            c0 = len(lines[l0])
 
-        if c1 < 0:
-            c1 = 0
-        if c1 > len(lines[l1]):
-            c1 = len(lines[l1])
+def numericSortKey(line):
+    """Sort by the number a line starts with. Lines that don't start with one go last."""
+    match = NUMBER_PREFIX.match(line)
+    if match is None:
+        return (1, 0.0)
+    return (0, float(match.group()))
 
-        if l0 > l1 or l0 == l1 and c0 > c1:
-            lt, ct = l0, c0
-            l0, c0 = l1, c1
-            l1, c1 = lt, ct
 
-        return Selection(l0, c0, l1, c1)
+def lengthPrefixedDigits(match):
+    digits = match.group(1)
+    return chr(ord("0") + len(digits) - 1) + digits
 
-    def extendCursors(self, cursorsByLine, lines):
-        self = self.clipToReal(lines)
 
-        if self.isTrivial():
-            cursorsByLine.setdefault(0, []).append(0)
-            return
+def naturalSortKey(line):
+    """Sort ignoring case, with runs of digits compared as numbers, so 'file2' comes before 'file10'.
 
-        if self.isSingle():
-            cursorsByLine.setdefault(self.line0, []).append(self.col0)
+    Each run of digits gets its length in front, so shorter numbers sort first,
+    and the key stays a plain string, which sorts far faster than a list would.
+    """
+    return DIGIT_RUNS.sub(lengthPrefixedDigits, line.casefold())
 
-        if self.line0 != self.line1:
-            cursorsByLine.setdefault(self.line0, []).extend(
-                range(self.col0, len(lines[self.line0]) + 1)
-            )
-            cursorsByLine.setdefault(self.line1, []).extend(
-                range(0, self.col1)
-            )
-            for line in range(self.line0 + 1, self.line1):
-                cursorsByLine.setdefault(line, []).extend(
-                    range(max(1, len(lines[line])))
-                )
-        else:
-            cursorsByLine.setdefault(self.line0, []).extend(
-                range(self.col0, self.col1)
-            )
 
-    @staticmethod
-    def clipLine(lNumber, lines):
-        return max(0, min(lNumber, max(len(lines) - 1, 0)))
+def uniqueLines(lines):
+    """'lines' without repeats, keeping the first of each."""
+    return list(dict.fromkeys(lines))
 
-    @staticmethod
-    def wordDelta(lines, line, col, direction):
-        if line < 0:
-            return 0, 0
 
-        if line >= len(lines):
-            return max(0, len(lines) - 1), MAX_COL
+def joinLines(lines):
+    """'lines' as a single line, with their indentation and blank lines dropped and a space between each."""
+    if not lines:
+        return []
+    return [" ".join([lines[0].rstrip()] + [line.strip() for line in lines[1:] if line.strip()])]
 
-        col = min(col, len(lines[line]))
 
-        # we can skip space until we get to non-space
-        # at which point, we don't skip space
-        skippedIdentifier = False
+class TextFormat:
+    """How a file's text is stored as bytes, so we can write it back the way we found it.
 
-        charsSkipped = 0
+    That's the encoding, any byte order mark, the line ending, and whether
+    the last line has one.
+    """
+    # longest first, since the utf-32 little-endian mark starts with the utf-16 one
+    BOMS = [
+        (codecs.BOM_UTF32_LE, "utf-32-le"),
+        (codecs.BOM_UTF32_BE, "utf-32-be"),
+        (codecs.BOM_UTF8, "utf-8"),
+        (codecs.BOM_UTF16_LE, "utf-16-le"),
+        (codecs.BOM_UTF16_BE, "utf-16-be"),
+    ]
+
+    # how much of a file we look at to guess its line endings, or whether it's binary
+    SNIFF_BYTES = 8000
+
+    def __init__(self, encoding="utf-8", bom=b"", newline="\n", finalNewline=True):
+        self.encoding = encoding
+        self.bom = bom
+        self.newline = newline
+        self.finalNewline = finalNewline
 
-        while True:
-            lineOut, colOut = Selection.charDelta(lines, line, col, direction)
+    @staticmethod
+    def decode(data):
+        """Return (lines, TextFormat) for the contents of a file.
+
+        Without a byte order mark we try utf-8, and fall back to latin-1,
+        which decodes (and re-encodes) any bytes at all. Lines may end in
+        any of '\\n', '\\r\\n' or '\\r', and the most common of those in the
+        first few thousand characters is what we'll write back.
+        """
+        for bom, encoding in TextFormat.BOMS:
+            if data.startswith(bom):
+                text = str(memoryview(data)[len(bom):], encoding, "replace")
+                break
+        else:
+            bom = b""
+            try:
+                encoding = "utf-8"
+                text = data.decode(encoding)
+            except UnicodeDecodeError:
+                encoding = "latin-1"
+                text = data.decode(encoding)
 
-            if lineOut != line and charsSkipped > 0:
-                return line, col
+        newline = "\n"
 
-            if (lineOut, colOut) == (line, col):
-                return lineOut, colOut
+        if "\r" in text:
+            sample = text[:TextFormat.SNIFF_BYTES]
+            crlf = sample.count("\r\n")
+            lf = sample.count("\n") - crlf
+            cr = sample.count("\r") - crlf
 
-            charCrossed = Selection.charCrossedBy(lines, line, col, lineOut, colOut)
+            if crlf >= max(lf, cr) and crlf:
+                newline = "\r\n"
+            elif cr > lf:
+                newline = "\r"
 
-            if not charCrossed.isidentifier() and not skippedIdentifier:
-                pass
-            else:
-                if not charCrossed.isidentifier():
-                    return line, col
+            text = text.replace("\r\n", "\n")
+            if newline == "\r":
+                text = text.replace("\r", "\n")
 
-                skippedIdentifier = True
+        lines = text.split("\n")
+        finalNewline = not lines[-1]
+        if finalNewline:
+            lines.pop()
 
-            line, col = lineOut, colOut
-            charsSkipped += len(charCrossed)
+        return lines, TextFormat(encoding, bom, newline, finalNewline or not lines)
 
-    @staticmethod
-    def charCrossedBy(lines, l0, c0, l1, c1):
-        if l0 != l1:
-            return "\n"
+    def encode(self, lines):
+        """The bytes to store 'lines' as. Raises UnicodeEncodeError if the encoding can't hold them."""
+        text = self.newline.join(lines)
+        if lines and self.finalNewline:
+            text += self.newline
 
-        return lines[l0][min(c0, c1):max(c0, c1)]
+        return self.bom + text.encode(self.encoding)
 
     @staticmethod
-    def charDelta(lines, line, col, direction):
-        if col >= len(lines[line]) and direction == -1:
-            col = len(lines[line]) - 1
-            if col < 0:
-                line -= 1
-                col = MAX_COL
-        elif col >= len(lines[line]) and direction == 1:
-            col = 0
-            line += 1
-        else:
-            col += direction
-
-            if col < 0:
-                line -= 1
-                col = MAX_COL
-
-        line = Selection.clipLine(line, lines)
+    def looksBinary(data):
+        """Whether the start of a file looks like binary data rather than text.
 
-        col = min(col, MAX_COL)
+        Like git, we call it binary if there's a NUL byte early on, unless
+        a byte order mark says it's utf-16 or utf-32, where NULs are normal.
+        """
+        if data.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE, codecs.BOM_UTF32_BE)):
+            return False
 
-        return line, col
+        return b"\0" in data[:TextFormat.SNIFF_BYTES]
 
-    def delta(self, lines, dLine, dCol, extend=False, word=False, isHomeKey=False, isTabBackspace=False):
-        if not lines:
-            return Selection(0, 0, 0, 0)
 
-        l0, c0, l1, c1 = self.line0, self.col0, self.line1, self.col1
+class LineStore:
+    """Interns lines of text so that identical lines share one string object.
 
-        if isTabBackspace and c0 > 0:
-            assert dCol == -1
+    Every line that goes into a buffer passes through here, so identical lines
+    across buffers, saved copies and undo snapshots are stored once. Strings
+    can't be weakly referenced, so we hold them strongly and periodically
+    'sweep' the table down to the lines that are still in use.
+    """
+    # the table can grow by this many bytes (past twice what survived the
+    # last sweep) before it wants sweeping. Typing on a huge line interns a
+    # new copy of it on every key, so counting lines alone isn't enough
+    SWEEP_SLACK_BYTES = 16 * 1024 * 1024
 
-            frontWhitespaceChars = len(lines[l1]) - len(lines[l1].lstrip())
-            if c0 <= frontWhitespaceChars:
-                whitespace = lines[l1][:frontWhitespaceChars]
-                if whitespace == " " * len(whitespace):
-                    # it's all whitespace here
-                    if c0 % 4 == 0:
-                        dCol = -4
-                    else:
-                        dCol = -(c0 % 4)
+    def __init__(self):
+        self.table = {}
+        self.internHits = 0
+        self.sizeAtLastSweep = 0
 
-        if isHomeKey:
-            c1 = len(lines[l1]) - len(lines[l1].lstrip())
-        elif word:
-            assert dLine == 0
-            l1, c1 = self.wordDelta(lines, l1, c1, dCol)
-        else:
-            if dCol != 0:
-                # this is a character delta
-                l1, c1 = self.charDelta(lines, l1, c1, dCol)
-            else:
-                # this is a line delta
-                l1 += dLine
+        # the total length of the lines in 'table'
+        self.tableBytes = 0
+        self.bytesAtLastSweep = 0
 
-                if l1 < 0 and dLine < -1:
-                    c1 = 0
-                elif l1 >= len(lines) and dLine > 1:
-                    c1 = MAX_COL
+    def intern(self, line):
+        existing = self.table.get(line)
 
-                l1 = self.clipLine(l1, lines)
+        if existing is None:
+            self.table[line] = line
+            self.tableBytes += len(line)
+            return line
 
-        if extend:
-            return Selection(l0, c0, l1, c1)
-        else:
-            return Selection(l1, c1, l1, c1)
+        if existing is not line:
+            self.internHits += 1
 
-    def selectedText(self, lines):
-        self = self.clipToReal(lines)
+        return existing
 
-        if self.line0 == self.line1:
-            return lines[self.line0][self.col0:self.col1]
+    def internLines(self, lines):
+        return [self.intern(line) for line in lines]
 
-        return "\n".join(
-            [lines[self.line0][self.col0:]]
-            + lines[self.line0 + 1:self.line1]
-            + [lines[self.line1][:self.col1]]
+    def needsSweep(self):
+        return (
+            len(self.table) > 2 * self.sizeAtLastSweep + 10000
+            or self.tableBytes > 2 * self.bytesAtLastSweep + self.SWEEP_SLACK_BYTES
         )
 
-    def selectWord(self, lines):
-        self = self.clipToReal(lines)
-
-        toLeft = self.charDelta(lines, self.line0, self.col0, -1)
-        toRight = self.charDelta(lines, self.line1, self.col1, 1)
-
-        crossedLeft = self.charCrossedBy(lines, self.line0, self.col0, toLeft[0], toLeft[1])
-        crossedRight = self.charCrossedBy(lines, self.line1, self.col1, toRight[0], toRight[1])
+    def sweep(self, lineLists):
+        """Forget every line not held by one of 'lineLists' and return stats()."""
+        table = {}
+        references = 0
+        referencedBytes = 0
 
-        if crossedLeft.isidentifier():
-            leftPoint = self.wordDelta(lines, self.line0, self.col0, -1)
-        else:
-            leftPoint = self.line0, self.col0
+        for lines in lineLists:
+            references += len(lines)
 
-        if crossedRight.isidentifier():
-            rightPoint = self.wordDelta(lines, self.line1, self.col1, 1)
-        else:
-            rightPoint = self.line1, self.col1
+            for line in lines:
+                referencedBytes += sys.getsizeof(line)
+                table.setdefault(line, line)
 
-        return Selection(*leftPoint, *rightPoint)
+        self.table = table
+        self.sizeAtLastSweep = len(table)
+        self.tableBytes = self.bytesAtLastSweep = sum(len(line) for line in table)
 
-    @staticmethod
-    def mergeContiguous(selections):
-        selections = sorted(selections)
+        return self.stats(references, referencedBytes)
 
-        while True:
-            newSelections = Selection.mergeContiguousSinglePass(selections)
+    def stats(self, references, referencedBytes):
+        uniqueBytes = sum(sys.getsizeof(line) for line in self.table)
 
-            if newSelections == selections:
-                return newSelections
-            else:
-                selections = newSelections
+        return {
+            "uniqueLines": len(self.table),
+            "references": references,
+            "dedupRatio": references / len(self.table) if self.table else 1.0,
+            "uniqueBytes": uniqueBytes,
+            "bytesSaved": referencedBytes - uniqueBytes,
+            "internHits": self.internHits
+        }
 
-        return selections
 
-    @staticmethod
-    def mergeContiguousSinglePass(selections):
-        selections = list(selections)
+class FileSet:
+    def __init__(self, namesToPaths):
+        self.namesToPaths = namesToPaths
+        self.sortedNames = sorted(namesToPaths)
 
-        i = 0
-        while i + 1 < len(selections):
-            if selections[i].overlaps(selections[i+1]):
-                merged = selections[i].merge(selections[i+1])
-                selections[i] = merged
-                selections.pop(i+1)
-            else:
-                i += 1
+        # path -> the TextFormat we read it in, so we save it the same way
+        self.formats = {}
 
-        return selections
+    def readlines(self, path):
+        with open(path, "rb") as f:
+            lines, self.formats[path] = TextFormat.decode(f.read())
 
-    def insertedChars(self, line, col, charsInserted):
-        l0, c0, l1, c1 = self.line0, self.col0, self.line1, self.col1
+        return lines
 
-        if line == l0 and col <= c0:
-            c0 += charsInserted
+    def writelines(self, path, lines):
+        textFormat = self.formats.get(path, TextFormat())
+
+        try:
+            data = textFormat.encode(lines)
+        except UnicodeEncodeError:
+            # we've typed something the old encoding can't hold, so it becomes utf-8
+            textFormat = TextFormat("utf-8", b"", textFormat.newline, textFormat.finalNewline)
+            data = textFormat.encode(lines)
+
+        with open(path, "wb") as f:
+            f.write(data)
+
+        self.formats[path] = textFormat
+
+    def isBinary(self, path):
+        """Whether 'path' looks like it holds binary data we shouldn't try to edit."""
+        try:
+            with open(path, "rb") as f:
+                return TextFormat.looksBinary(f.read(TextFormat.SNIFF_BYTES))
+        except OSError:
+            return False
 
-        if line == l1 and col <= c1:
-            c1 += charsInserted
+    def mtime(self, path):
+        """The modification time of 'path', or None if we can't tell."""
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
 
-        return Selection(l0, c0, l1, c1)
+    def headBlobId(self, path):
+        """An id for the version of 'path' committed at HEAD, or None if it isn't in a git repository."""
+        return None
 
-    def insertedLines(self, line, col, count=1):
-        l0, c0, l1, c1 = self.line0, self.col0, self.line1, self.col1
+    def readBlobLines(self, blobId):
+        """The lines of a blob named by headBlobId, or None if we can't read it."""
+        return None
 
-        def mapPoint(l, c):
-            if (l, c) < (line, col):
-                return l, c
-            if l == line:
-                return l + count, c - col
-            else:
-                return l + count, c
 
-        l0, c0 = mapPoint(l0, c0)
-        l1, c1 = mapPoint(l1, c1)
+class Display:
+    """Baseclass for all things that make little windows."""
+    def __init__(self, context):
+        self.context = context
 
-        return Selection(l0, c0, l1, c1)
+    def textWithCursors(self, x0, y0, text, cursors, attributeRuns=()):
+        self.context.stdscr.addstr(y0, x0, text)
 
-    def rangeDeleted(self, selection):
-        assert selection.isOrdered()
+        for start, length, attr in attributeRuns:
+            self.context.stdscr.chgat(y0, x0 + start, length, attr)
 
-        l0, c0, l1, c1 = self.line0, self.col0, self.line1, self.col1
+        for i in cursors:
+            self.context.stdscr.chgat(y0, x0 + i, 1, self.context.stdscr.A_STANDOUT)
 
-        l0, c0 = selection.mapPointIfSelfDeleted(l0, c0)
-        l1, c1 = selection.mapPointIfSelfDeleted(l1, c1)
+    def lightText(self, x0, y0, text):
+        self.context.stdscr.addstr(y0, x0, text)
+        self.context.stdscr.chgat(y0, x0, len(text), self.context.stdscr.A_DIM)
 
-        return Selection(l0, c0, l1, c1)
+    def textBold(self, x0, y0, text):
+        self.context.stdscr.addstr(y0, x0, text)
+        self.context.stdscr.chgat(y0, x0, len(text), self.context.stdscr.A_BOLD)
 
-    def mapPointIfSelfDeleted(self, line, col):
-        if (line, col) < (self.line0, self.col0):
-            return (line, col)
+    def highlightedText(self, x0, y0, text):
+        self.context.stdscr.addstr(y0, x0, text)
+        self.context.stdscr.chgat(y0, x0, len(text), self.context.stdscr.A_STANDOUT)
 
-        if (line, col) <= (self.line1, self.col1):
-            return (self.line0, self.col0)
+    def text(self, x0, y0, text):
+        self.context.stdscr.addstr(y0, x0, text)
 
-        if line == self.line1:
+    def box(self, x0, y0, x1, y1, clear=False):
+        self.context.stdscr.addch(y0, x0, self.context.stdscr.ACS_ULCORNER)
+        self.context.stdscr.addch(y1, x0, self.context.stdscr.ACS_LLCORNER)
+        self.context.stdscr.addch(y0, x1, self.context.stdscr.ACS_URCORNER)
+        self.context.stdscr.addch(y1, x1, self.context.stdscr.ACS_LRCORNER)
+        self.context.stdscr.hline(y0, x0 + 1, self.context.stdscr.ACS_HLINE, x1 - x0 - 1)
+        self.context.stdscr.hline(y1, x0 + 1, self.context.stdscr.ACS_HLINE, x1 - x0 - 1)
+        self.context.stdscr.vline(y0 + 1, x0, self.context.stdscr.ACS_VLINE, y1 - y0 - 1)
+        self.context.stdscr.vline(y0 + 1, x1, self.context.stdscr.ACS_VLINE, y1 - y0 - 1)
+
+        if clear:
+            for row in range(y0 + 1, y1):
+                self.text(x0 + 1, row, " " * (x1 - x0 - 2))
+
+    def receiveChar(self, char):
+        pass
+
+    def resized(self):
+        pass
+
+    def redraw(self):
+        pass
+
+
+
+class IgnoreRules:
+    """Compiled .gitignore patterns, applying to the paths under 'base'.
+
+    As in git, '#' starts a comment, '!' re-includes what an earlier pattern
+    ignored, a trailing '/' only matches directories, a '/' anywhere else
+    anchors the pattern to 'base' (otherwise it matches a name at any
+    depth), and '**' matches any number of directories. The last pattern
+    that matches a path wins.
+    """
+    def __init__(self, patterns, base=""):
+        self.base = base
+
+        # (regex, isNegated, isDirOnly), in the order they were given
+        self.rules = []
+
+        for pattern in patterns:
+            rule = IgnoreRules.compileRule(pattern)
+            if rule is not None:
+                self.rules.append(rule)
+
+        # one regex for all of the patterns, so a path that matches none of
+        # them (almost all of them) costs a single match
+        self.anyRule = re.compile("|".join(regex.pattern for regex, _, _ in self.rules)) if self.rules else None
+
+    @staticmethod
+    def fromFile(path, base):
+        """The rules in the .gitignore at 'path', or None if there isn't one."""
+        try:
+            with open(path, "r", errors="replace") as f:
+                return IgnoreRules(f.read().split("\n"), base)
+        except OSError:
+            return None
+
+    @staticmethod
+    def compileRule(pattern):
+        pattern = pattern.rstrip()
+
+        if not pattern or pattern.startswith("#"):
+            return None
+
+        isNegated = pattern.startswith("!")
+        if isNegated:
+            pattern = pattern[1:]
+
+        isDirOnly = pattern.endswith("/")
+        pattern = pattern.rstrip("/")
+
+        isAnchored = "/" in pattern
+        pattern = pattern.lstrip("/")
+
+        if not pattern:
+            return None
+
+        regex = []
+        i = 0
+        while i < len(pattern):
+            if pattern.startswith("**/", i):
+                regex.append("(?:.*/)?")
+                i += 3
+            elif pattern.startswith("**", i):
+                regex.append(".*")
+                i += 2
+            elif pattern[i] == "*":
+                regex.append("[^/]*")
+                i += 1
+            elif pattern[i] == "?":
+                regex.append("[^/]")
+                i += 1
+            elif pattern[i] == "[" and "]" in pattern[i + 2:]:
+                end = pattern.index("]", i + 2)
+                body = pattern[i + 1:end]
+                if body.startswith("!"):
+                    body = "^" + body[1:]
+                regex.append("[" + body.replace("\\", "\\\\") + "]")
+                i = end + 1
+            else:
+                if pattern[i] == "\\" and i + 1 < len(pattern):
+                    i += 1
+                regex.append(re.escape(pattern[i]))
+                i += 1
+
+        prefix = "" if isAnchored else "(?:.*/)?"
+
+        return re.compile("(?:" + prefix + "".join(regex) + ")$"), isNegated, isDirOnly
+
+    def match(self, relPath, isDir):
+        """True if 'relPath' is ignored, False if it's re-included, and None if no pattern matches it."""
+        if self.base:
+            if not relPath.startswith(self.base + "/"):
+                return None
+            relPath = relPath[len(self.base) + 1:]
+
+        if self.anyRule is None or not self.anyRule.match(relPath):
+            return None
+
+        for regex, isNegated, isDirOnly in reversed(self.rules):
+            if (isDir or not isDirOnly) and regex.match(relPath):
+                return not isNegated
+
+        return None
+
+    @staticmethod
+    def isIgnored(rulesList, relPath, isDir):
+        """Is 'relPath' ignored by the last of 'rulesList' (outermost first) that has an opinion?"""
+        for rules in reversed(rulesList):
+            result = rules.match(relPath, isDir)
+            if result is not None:
+                return result
+
+        return False
+
+
+class DirFileSet(FileSet):
+    # what we skip even without a .gitignore: caches, git's own directory,
+    # and dot-directories at the top level
+    DEFAULT_IGNORE = ["__pycache__/", ".git/", "/.*/"]
+
+    def __init__(self, directory, ignore=()):
+        """Every file under 'directory', leaving out what .gitignore files or the globs in 'ignore' exclude.
+
+        The globs in 'ignore' work like lines of a top-level .gitignore. Ignored
+        directories are never walked into.
+        """
+        self.directory = os.path.abspath(directory)
+
+        names = {}
+        toWalk = [("", [IgnoreRules(DirFileSet.DEFAULT_IGNORE + list(ignore))])]
+
+        while toWalk:
+            subdir, rules = toWalk.pop()
+            ownDir = os.path.join(self.directory, subdir)
+
+            localRules = IgnoreRules.fromFile(os.path.join(ownDir, ".gitignore"), subdir)
+            if localRules is not None:
+                rules = rules + [localRules]
+
+            try:
+                entries = list(os.scandir(ownDir))
+            except OSError:
+                continue
+
+            for entry in entries:
+                relPath = subdir + "/" + entry.name if subdir else entry.name
+                isDir = entry.is_dir()
+
+                if IgnoreRules.isIgnored(rules, relPath, isDir):
+                    continue
+
+                if isDir:
+                    toWalk.append((relPath, rules))
+                elif entry.is_file():
+                    names[relPath] = entry.path
+
+        super().__init__(names)
+
+        self.gitRepo = GitRepo.find(self.directory)
+
+    def headBlobId(self, path):
+        if self.gitRepo is None:
+            return None
+
+        relPath = os.path.relpath(path, self.gitRepo.workTree).replace(os.sep, "/")
+        if relPath.startswith("../"):
+            return None
+
+        try:
+            return self.gitRepo.headBlobId(relPath)
+        except GitRepo.ERRORS:
+            return None
+
+    def readBlobLines(self, blobId):
+        try:
+            return TextFormat.decode(self.gitRepo.readBlob(blobId))[0]
+        except GitRepo.ERRORS:
+            return None
+
+
+class GitRepo:
+    """Reads files as of HEAD straight out of a git repository's object store.
+
+    Objects never change once written, so whatever we've parsed stays good:
+    pack indices and trees are cached, and only HEAD and the refs it points
+    at are read again each time we ask.
+    """
+    # reading a damaged or unusual repository can fail in any of these ways
+    ERRORS = (OSError, ValueError, KeyError, IndexError, struct.error, zlib.error)
+
+    def __init__(self, gitDir, workTree):
+        self.gitDir = gitDir
+        self.workTree = workTree
+
+        # a linked worktree keeps its own HEAD but shares refs and objects
+        self.commonDir = gitDir
+        try:
+            with open(os.path.join(gitDir, "commondir")) as f:
+                self.commonDir = os.path.normpath(os.path.join(gitDir, f.read().strip()))
+        except OSError:
+            pass
+
+        self.objectsDir = os.path.join(self.commonDir, "objects")
+        self.packs = None
+        self.trees = {}
+        self.commitTrees = {}
+
+    @staticmethod
+    def find(directory):
+        """The GitRepo whose work tree contains 'directory', or None."""
+        directory = os.path.abspath(directory)
+
+        while True:
+            dotGit = os.path.join(directory, ".git")
+
+            if os.path.isdir(dotGit):
+                return GitRepo(dotGit, directory)
+
+            if os.path.isfile(dotGit):
+                # worktrees and submodules have a '.git' file naming the real directory
+                try:
+                    with open(dotGit) as f:
+                        content = f.read().strip()
+                except OSError:
+                    return None
+
+                if not content.startswith("gitdir:"):
+                    return None
+
+                return GitRepo(os.path.join(directory, content[len("gitdir:"):].strip()), directory)
+
+            parent = os.path.dirname(directory)
+            if parent == directory:
+                return None
+            directory = parent
+
+    def readRef(self, ref):
+        for base in (self.gitDir, self.commonDir):
+            try:
+                with open(os.path.join(base, ref)) as f:
+                    return f.read().strip()
+            except OSError:
+                pass
+
+        try:
+            with open(os.path.join(self.commonDir, "packed-refs")) as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) == 2 and parts[1] == ref and not line.startswith(("#", "^")):
+                        return parts[0]
+        except OSError:
+            pass
+
+        return None
+
+    def headCommit(self):
+        """The sha of the commit HEAD points at, or None if there isn't one yet."""
+        ref = "HEAD"
+
+        # symbolic refs can point at other symbolic refs, but not forever
+        for _ in range(8):
+            content = self.readRef(ref)
+            if content is None:
+                return None
+            if not content.startswith("ref:"):
+                return bytes.fromhex(content)
+            ref = content[len("ref:"):].strip()
+
+        return None
+
+    def readObject(self, sha):
+        """Return (kind, data) for the object with binary sha 'sha'. Raises KeyError if we don't have it."""
+        hexSha = sha.hex()
+
+        try:
+            with open(os.path.join(self.objectsDir, hexSha[:2], hexSha[2:]), "rb") as f:
+                raw = zlib.decompress(f.read())
+        except OSError:
+            pass
+        else:
+            header, _, data = raw.partition(b"\0")
+            return header.split(b" ")[0].decode("ascii"), data
+
+        for rescan in (False, True):
+            # a repack since we last looked may have moved the object into a new pack
+            if self.packs is None or rescan:
+                packDir = os.path.join(self.objectsDir, "pack")
+                try:
+                    names = sorted(os.listdir(packDir))
+                except OSError:
+                    names = []
+                self.packs = [GitPack(self, os.path.join(packDir, n)) for n in names if n.endswith(".idx")]
+
+            for pack in self.packs:
+                offset = pack.offsetOf(sha)
+                if offset is not None:
+                    return pack.readAt(offset)
+
+        raise KeyError(hexSha)
+
+    def treeEntries(self, sha):
+        """A dict from name to (mode, sha) for the tree 'sha'."""
+        if sha not in self.trees:
+            kind, data = self.readObject(sha)
+            if kind != "tree":
+                raise ValueError("%s is a %s, not a tree" % (sha.hex(), kind))
+
+            entries = {}
+            pos = 0
+            while pos < len(data):
+                space = data.index(b" ", pos)
+                nul = data.index(b"\0", space)
+                entries[data[space + 1:nul].decode("utf-8", "surrogateescape")] = (data[pos:space], data[nul + 1:nul + 21])
+                pos = nul + 21
+
+            if len(self.trees) > 10000:
+                self.trees = {}
+            self.trees[sha] = entries
+
+        return self.trees[sha]
+
+    def headBlobId(self, relPath):
+        """The sha of the blob committed at HEAD for 'relPath' ('/'-separated, from the work tree), or None."""
+        commit = self.headCommit()
+        if commit is None:
+            return None
+
+        if commit not in self.commitTrees:
+            kind, data = self.readObject(commit)
+            if kind != "commit" or not data.startswith(b"tree "):
+                raise ValueError("%s is not a commit" % commit.hex())
+            self.commitTrees[commit] = bytes.fromhex(data[5:45].decode("ascii"))
+
+        sha = self.commitTrees[commit]
+        mode = b"40000"
+
+        for part in relPath.split("/"):
+            if mode != b"40000":
+                return None
+
+            entries = self.treeEntries(sha)
+            if part not in entries:
+                return None
+            mode, sha = entries[part]
+
+        # regular files only: not directories, symlinks or submodules
+        if not mode.startswith(b"100"):
+            return None
+
+        return sha
+
+    def readBlob(self, sha):
+        kind, data = self.readObject(sha)
+        if kind != "blob":
+            raise ValueError("%s is a %s, not a blob" % (sha.hex(), kind))
+        return data
+
+
+class GitPack:
+    """One packfile in a git object store, found through its version 2 .idx."""
+    KINDS = {1: "commit", 2: "tree", 3: "blob", 4: "tag"}
+    OFS_DELTA = 6
+    REF_DELTA = 7
+
+    def __init__(self, repo, indexPath):
+        self.repo = repo
+        self.packPath = indexPath[:-len(".idx")] + ".pack"
+
+        with open(indexPath, "rb") as f:
+            index = f.read()
+
+        if index[:4] != b"\xfftOc" or struct.unpack(">I", index[4:8])[0] != 2:
+            raise ValueError("%s isn't a version 2 pack index" % indexPath)
+
+        self.fanout = struct.unpack(">256I", index[8:8 + 1024])
+        count = self.fanout[255]
+
+        shasStart = 8 + 1024
+        offsetsStart = shasStart + count * 24
+
+        self.shas = index[shasStart:shasStart + count * 20]
+        self.offsets = index[offsetsStart:offsetsStart + count * 4]
+        self.largeOffsets = index[offsetsStart + count * 4:]
+
+    def offsetOf(self, sha):
+        """Where the object 'sha' starts in the pack, or None if it isn't in this one."""
+        lo = self.fanout[sha[0] - 1] if sha[0] else 0
+        hi = self.fanout[sha[0]]
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            midSha = self.shas[mid * 20:mid * 20 + 20]
+            if midSha < sha:
+                lo = mid + 1
+            elif midSha > sha:
+                hi = mid
+            else:
+                offset = struct.unpack_from(">I", self.offsets, mid * 4)[0]
+                if offset & 0x80000000:
+                    offset = struct.unpack_from(">Q", self.largeOffsets, (offset & 0x7fffffff) * 8)[0]
+                return offset
+
+        return None
+
+    def readAt(self, offset):
+        with open(self.packPath, "rb") as f:
+            return self.readFrom(f, offset)
+
+    def readFrom(self, f, offset):
+        f.seek(offset)
+        header = f.read(32)
+
+        byte = header[0]
+        kind = (byte >> 4) & 7
+        size = byte & 15
+        shift = 4
+        pos = 1
+        while byte & 0x80:
+            byte = header[pos]
+            pos += 1
+            size |= (byte & 0x7f) << shift
+            shift += 7
+
+        if kind == GitPack.OFS_DELTA:
+            byte = header[pos]
+            pos += 1
+            distance = byte & 0x7f
+            while byte & 0x80:
+                byte = header[pos]
+                pos += 1
+                distance = ((distance + 1) << 7) | (byte & 0x7f)
+
+            baseKind, base = self.readFrom(f, offset - distance)
+        elif kind == GitPack.REF_DELTA:
+            baseKind, base = self.repo.readObject(header[pos:pos + 20])
+            pos += 20
+
+        f.seek(offset + pos)
+        decompressor = zlib.decompressobj()
+        chunks = []
+        while not decompressor.eof:
+            chunk = f.read(65536)
+            if not chunk:
+                raise ValueError("truncated object in %s" % self.packPath)
+            chunks.append(decompressor.decompress(chunk))
+        data = b"".join(chunks)
+
+        if len(data) != size:
+            raise ValueError("object at %d in %s has the wrong size" % (offset, self.packPath))
+
+        if kind in (GitPack.OFS_DELTA, GitPack.REF_DELTA):
+            return baseKind, GitPack.applyDelta(base, data)
+
+        return GitPack.KINDS[kind], data
+
+    @staticmethod
+    def applyDelta(base, delta):
+        """Rebuild an object from the one it's a delta against: a run of copy-from-base and insert ops."""
+        pos = 0
+
+        # the delta starts with the sizes of the base and the result, which we don't need
+        for _ in range(2):
+            while delta[pos] & 0x80:
+                pos += 1
+            pos += 1
+
+        out = bytearray()
+        while pos < len(delta):
+            op = delta[pos]
+            pos += 1
+
+            if op & 0x80:
+                copyOffset = 0
+                copySize = 0
+                for i in range(4):
+                    if op & (1 << i):
+                        copyOffset |= delta[pos] << (8 * i)
+                        pos += 1
+                for i in range(3):
+                    if op & (0x10 << i):
+                        copySize |= delta[pos] << (8 * i)
+                        pos += 1
+                out += base[copyOffset:copyOffset + (copySize or 0x10000)]
+            elif op:
+                out += delta[pos:pos + op]
+                pos += op
+            else:
+                raise ValueError("bad delta opcode")
+
+        return bytes(out)
+
+
+class SwapFiles:
+    """Crash-safe journals of unsaved edits, one per dirty buffer.
+
+    Each swap file is a sequence of json lines. The first is a header with
+    the path and a hash of the text on disk the journal applies to. Each
+    following line is either ["r", line0, oldCount, newLines], meaning lines
+    [line0, line0 + oldCount) were replaced, or ["s", lines], a snapshot of
+    the whole buffer.
+
+    The keystroke path only puts operations on a queue. A background thread
+    writes them out, batching fsyncs to at most one every 'fsyncInterval'
+    seconds, and every 'compactAfter' operations the journal is rewritten as
+    a single snapshot so it doesn't grow without bound.
+    """
+    def __init__(self, directory, fsyncInterval=1.0, compactAfter=1000):
+        self.directory = directory
+        self.fsyncInterval = fsyncInterval
+        self.compactAfter = compactAfter
+
+        os.makedirs(directory, exist_ok=True)
+
+        # path -> number of operations since the journal was started or compacted.
+        # only touched by the main thread.
+        self.opCounts = {}
+
+        # state owned by the writer thread
+        self.openJournals = {}
+        self.needsFsync = set()
+        self.lastFsync = time.time()
+        self.lastError = None
+
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._writerLoop, daemon=True)
+        self.thread.start()
+
+    def swapPathFor(self, path):
+        digest = hashlib.sha1(os.path.abspath(path).encode("utf8", "surrogateescape")).hexdigest()[:16]
+        return os.path.join(self.directory, digest + "-" + os.path.basename(path) + ".swp")
+
+    @staticmethod
+    def hashLines(lines):
+        return hashlib.sha1("\n".join(lines).encode("utf8", "surrogateescape")).hexdigest()
+
+    def recordChange(self, path, linesOnDisk, line0, oldCount, newLines, currentLines):
+        """Note that lines [line0, line0 + oldCount) of the buffer for 'path' became 'newLines'.
+
+        'linesOnDisk' is what the journal is relative to if this is the first
+        change since the last save. 'newLines' and 'linesOnDisk' must not be
+        modified afterwards; 'currentLines' gets copied if we decide to
+        compact.
+        """
+        if path not in self.opCounts:
+            self.opCounts[path] = 0
+            self.queue.put(("begin", path, linesOnDisk))
+
+        self.opCounts[path] += 1
+
+        if self.opCounts[path] >= self.compactAfter:
+            self.opCounts[path] = 0
+            self.queue.put(("snapshot", path, list(currentLines)))
+        else:
+            self.queue.put(("replace", path, (line0, oldCount, newLines)))
+
+    def discard(self, path):
+        """Throw away the journal for 'path', because it's been saved or abandoned."""
+        if path in self.opCounts or os.path.exists(self.swapPathFor(path)):
+            self.opCounts.pop(path, None)
+            self.queue.put(("discard", path, None))
+
+    def flush(self):
+        """Block until everything queued so far is on disk."""
+        self.queue.put(("fsync", None, None))
+        self.queue.join()
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+
+    def recover(self, path, linesOnDisk):
+        """Return the unsaved text for 'path' from a previous session, or None.
+
+        A journal whose base doesn't match what's on disk is ignored unless it
+        contains a snapshot. A record cut off by a crash is ignored.
+        """
+        if path in self.opCounts:
+            return None
+
+        self.flush()
+
+        swapPath = self.swapPathFor(path)
+
+        if not os.path.exists(swapPath):
+            return None
+
+        with open(swapPath, "r", encoding="utf8", errors="surrogateescape") as f:
+            records = f.read().split("\n")
+
+        try:
+            header = json.loads(records[0])
+        except ValueError:
+            return None
+
+        lines = list(linesOnDisk) if header.get("base") == self.hashLines(linesOnDisk) else None
+
+        for record in records[1:]:
+            try:
+                record = json.loads(record)
+            except ValueError:
+                break
+
+            if record[0] == "s":
+                lines = record[1]
+            elif record[0] == "r" and lines is not None:
+                line0, oldCount, newLines = record[1:]
+                lines[line0:line0 + oldCount] = newLines
+
+        if lines is None or lines == linesOnDisk:
+            return None
+
+        return lines
+
+    def _writerLoop(self):
+        stopping = False
+
+        while not stopping:
+            try:
+                batch = [self.queue.get(timeout=self.fsyncInterval)]
+            except queue.Empty:
+                self._fsync()
+                continue
+
+            # drain everything that's waiting so we write it in one batch
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            forceFsync = False
+
+            for item in batch:
+                if item is None:
+                    stopping = True
+                    continue
+
+                kind, path, payload = item
+
+                if kind == "fsync":
+                    forceFsync = True
+                    continue
+
+                try:
+                    self._apply(kind, path, payload)
+                except OSError as e:
+                    self.lastError = e
+
+            if forceFsync or stopping or time.time() - self.lastFsync >= self.fsyncInterval:
+                self._fsync()
+
+            for _ in batch:
+                self.queue.task_done()
+
+        for path in list(self.openJournals):
+            self._closeJournal(path)
+
+    def _apply(self, kind, path, payload):
+        swapPath = self.swapPathFor(path)
+
+        if kind == "begin":
+            self._closeJournal(path)
+            f = open(swapPath, "w", encoding="utf8", errors="surrogateescape")
+            f.write(json.dumps({"path": path, "base": self.hashLines(payload)}) + "\n")
+            self.openJournals[path] = (f, payload)
+            self.needsFsync.add(path)
+
+        elif path not in self.openJournals:
+            # we failed to start this journal - nothing to add to
+            if kind == "discard" and os.path.exists(swapPath):
+                os.remove(swapPath)
+
+        elif kind == "replace":
+            f, _ = self.openJournals[path]
+            f.write(json.dumps(["r", *payload]) + "\n")
+            self.needsFsync.add(path)
+
+        elif kind == "snapshot":
+            _, base = self.openJournals[path]
+            self._closeJournal(path)
+
+            with open(swapPath + ".tmp", "w", encoding="utf8", errors="surrogateescape") as f:
+                f.write(json.dumps({"path": path, "base": self.hashLines(base)}) + "\n")
+                f.write(json.dumps(["s", payload]) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+            os.replace(swapPath + ".tmp", swapPath)
+
+            self.openJournals[path] = (open(swapPath, "a", encoding="utf8", errors="surrogateescape"), base)
+
+        elif kind == "discard":
+            self._closeJournal(path)
+            if os.path.exists(swapPath):
+                os.remove(swapPath)
+
+    def _closeJournal(self, path):
+        if path in self.openJournals:
+            self.openJournals.pop(path)[0].close()
+        self.needsFsync.discard(path)
+
+    def _fsync(self):
+        for path in self.needsFsync:
+            f = self.openJournals[path][0]
+            try:
+                f.flush()
+                os.fsync(f.fileno())
+            except OSError as e:
+                self.lastError = e
+
+        self.needsFsync = set()
+        self.lastFsync = time.time()
+
+
+def parseSymbols(source):
+    """Return a list of (qualname, kind, lineNumber) for the classes and defs in python source."""
+    try:
+        tree = ast.parse(source)
+    except (SyntaxError, ValueError):
+        return []
+
+    symbols = []
+
+    def walk(node, prefix, inClass):
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, ast.ClassDef):
+                symbols.append((prefix + child.name, "class", child.lineno))
+                walk(child, prefix + child.name + ".", True)
+            elif isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                symbols.append((prefix + child.name, "method" if inClass else "def", child.lineno))
+                walk(child, prefix + child.name + ".", False)
+            else:
+                walk(child, prefix, inClass)
+
+    walk(tree, "", False)
+
+    return symbols
+
+
+def parseSymbolsInFile(path):
+    """Worker for SymbolIndex's process pool."""
+    try:
+        with open(path, "rb") as f:
+            return parseSymbols(f.read())
+    except OSError:
+        return []
+
+
+class SymbolIndex:
+    """Classes, functions and methods defined in every .py file of a FileSet.
+
+    'symbols' maps a file name to (mtime, [(qualname, kind, lineNumber)]).
+    The index is persisted as json at 'cachePath', so on startup we only
+    reparse files whose mtime changed. Parsing happens in a process pool
+    driven from a background thread, into a new dict that replaces 'symbols'
+    when it's done; the index is usable (if incomplete) while that's running.
+
+    With processes=0 everything happens synchronously in-process, reading
+    through the FileSet.
+    """
+    def __init__(self, fileSet, cachePath=None, processes=None):
+        self.fileSet = fileSet
+        self.cachePath = cachePath
+        self.processes = processes
+        self.symbols = {}
+        self.isBuilding = False
+        self.needsSave = False
+        self.thread = None
+
+        # files reindexed by 'updateFile' while a build was running, which
+        # the build mustn't overwrite with what it read from disk
+        self.updatedDuringBuild = {}
+        self.lock = threading.Lock()
+
+        if cachePath is not None and os.path.exists(cachePath):
+            try:
+                with open(cachePath, "r") as f:
+                    self.symbols = {
+                        fileName: (mtime, [tuple(s) for s in symbols])
+                        for fileName, (mtime, symbols) in json.load(f).items()
+                        if fileName in fileSet.namesToPaths
+                    }
+            except (OSError, ValueError):
+                self.symbols = {}
+
+    def pythonFiles(self):
+        return [n for n in self.fileSet.sortedNames if n.endswith(".py")]
+
+    def staleFiles(self):
+        """Return [(fileName, mtime)] for the files we need to (re)parse."""
+        result = []
+
+        for fileName in self.pythonFiles():
+            mtime = self.fileSet.mtime(self.fileSet.namesToPaths[fileName])
+
+            if mtime is None or fileName not in self.symbols or self.symbols[fileName][0] != mtime:
+                result.append((fileName, mtime))
+
+        return result
+
+    def start(self):
+        """Bring the index up to date in the background."""
+        if self.processes == 0:
+            self.build()
+            return
+
+        self.isBuilding = True
+        self.thread = threading.Thread(target=self.build, daemon=True)
+        self.thread.start()
+
+    def build(self):
+        self.isBuilding = True
+
+        try:
+            stale = self.staleFiles()
+            symbols = dict(self.symbols)
+
+            if self.processes == 0:
+                for fileName, mtime in stale:
+                    lines = self.fileSet.readlines(self.fileSet.namesToPaths[fileName])
+                    symbols[fileName] = (mtime, parseSymbols("\n".join(lines)))
+            elif stale:
+                # we're on a background thread while others run, where forking can deadlock
+                with concurrent.futures.ProcessPoolExecutor(
+                    self.processes, mp_context=multiprocessing.get_context("spawn")
+                ) as pool:
+                    paths = [self.fileSet.namesToPaths[fileName] for fileName, _ in stale]
+
+                    for (fileName, mtime), fileSymbols in zip(
+                        stale, pool.map(parseSymbolsInFile, paths, chunksize=32)
+                    ):
+                        symbols[fileName] = (mtime, fileSymbols)
+
+            for fileName in set(symbols) - set(self.pythonFiles()):
+                del symbols[fileName]
+
+            with self.lock:
+                symbols.update(self.updatedDuringBuild)
+                self.updatedDuringBuild = {}
+                self.symbols = symbols
+
+            self.needsSave = True
+            self.save()
+        finally:
+            self.isBuilding = False
+
+    def updateFile(self, fileName, lines):
+        """Reindex a file from text we already have in memory, e.g. because we just saved it."""
+        mtime = self.fileSet.mtime(self.fileSet.namesToPaths[fileName])
+        entry = (mtime, parseSymbols("\n".join(lines)))
+
+        with self.lock:
+            self.symbols[fileName] = entry
+
+            if self.isBuilding:
+                self.updatedDuringBuild[fileName] = entry
+
+        self.needsSave = True
+
+    def save(self):
+        if self.cachePath is None or not self.needsSave:
+            return
+
+        self.needsSave = False
+
+        try:
+            os.makedirs(os.path.dirname(self.cachePath), exist_ok=True)
+            with open(self.cachePath + ".tmp", "w") as f:
+                json.dump(dict(self.symbols), f)
+            os.replace(self.cachePath + ".tmp", self.cachePath)
+        except OSError:
+            pass
+
+    def allSymbols(self):
+        """Return a list of (qualname, kind, fileName, lineNumber)."""
+        return [
+            (qualname, kind, fileName, lineNumber)
+            for fileName, (_, symbols) in sorted(self.symbols.items())
+            for qualname, kind, lineNumber in symbols
+        ]
+
+    def definitionsOf(self, name):
+        return [s for s in self.allSymbols() if s[0] == name or s[0].endswith("." + name)]
+
+
+class FileHistory:
+    """How much and how recently each file has been used ('frecency'), for ranking Ctrl-P.
+
+    Each file has a score that goes up by OPEN_WEIGHT every time it's
+    opened and SAVE_WEIGHT every time it's saved, and halves every
+    HALF_LIFE seconds. 'entries' maps a file name to (score, time of the
+    last bump), which is enough to work out the current score. It's
+    persisted as json at 'path', if there is one.
+    """
+    HALF_LIFE = 3 * 24 * 3600
+    OPEN_WEIGHT = 1.0
+    SAVE_WEIGHT = 2.0
+
+    # we forget the least used files beyond this many
+    MAX_ENTRIES = 2000
+
+    def __init__(self, path=None, clock=time.time):
+        self.path = path
+        self.clock = clock
+        self.entries = {}
+        self.needsSave = False
+
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, "r") as f:
+                    self.entries = {name: (score, when) for name, (score, when) in json.load(f).items()}
+            except (OSError, ValueError, TypeError):
+                self.entries = {}
+
+    def scoreOf(self, fileName, now=None):
+        if fileName not in self.entries:
+            return 0.0
+
+        score, when = self.entries[fileName]
+
+        if now is None:
+            now = self.clock()
+
+        return score * 0.5 ** (max(0.0, now - when) / self.HALF_LIFE)
+
+    def record(self, fileName, weight):
+        now = self.clock()
+        self.entries[fileName] = (self.scoreOf(fileName, now) + weight, now)
+        self.needsSave = True
+
+    def save(self):
+        if self.path is None or not self.needsSave:
+            return
+
+        self.needsSave = False
+
+        if len(self.entries) > self.MAX_ENTRIES:
+            now = self.clock()
+            keep = sorted(self.entries, key=lambda name: -self.scoreOf(name, now))[:self.MAX_ENTRIES]
+            self.entries = {name: self.entries[name] for name in keep}
+
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path + ".tmp", "w") as f:
+                json.dump(self.entries, f)
+            os.replace(self.path + ".tmp", self.path)
+        except OSError:
+            pass
+
+
+class CompletionIndex:
+    """Every identifier in the open buffers (and optionally the whole project), with counts.
+
+    Identifiers live in a trie. Each node caches the TOP_K most common words
+    below it, so completing a prefix is a walk down the trie plus a cached
+    list. Edits only adjust the counts of words whose number of occurrences
+    on the edited lines changed, clearing the caches on those words' paths.
+    """
+    # words longer than this aren't worth completing, and a minified file can
+    # have one that's megabytes long, which would cost a trie node per character
+    WORD = re.compile(r"\b[A-Za-z_][A-Za-z0-9_]{1,79}\b")
+    TOP_K = 10
+
+    # edits touching more lines than this check for lines that only moved first
+    BIG_EDIT = 1000
+
+    class Node:
+        __slots__ = ("children", "count", "word", "top")
+
+        def __init__(self, word):
+            self.children = {}
+            self.count = 0
+            self.word = word
+            self.top = None
+
+    def __init__(self):
+        self.root = CompletionIndex.Node("")
+
+        # files from the project that we still want to read, if any
+        self.pendingFiles = []
+
+        # whether we count the words in the whole project, not just open files
+        self.indexesProject = False
+
+        # paths whose words were counted from disk by the project pass, and
+        # paths whose words come from an open FileBuffer. A path is in at most
+        # one of them, so nothing gets counted twice
+        self.projectPaths = set()
+        self.bufferPaths = set()
+
+    def wordCounts(self, lines):
+        # words never span a newline, so one findall over the joined text
+        # finds the same ones much faster than one per line
+        return collections.Counter(self.WORD.findall("\n".join(lines)))
+
+    def add(self, word, delta):
+        if delta > 0:
+            # the common case, with nothing to prune
+            node = self.root
+            node.top = None
+
+            for char in word:
+                child = node.children.get(char)
+                if child is None:
+                    child = node.children[char] = CompletionIndex.Node(node.word + char)
+                node = child
+                node.top = None
+
+            node.count += delta
+            return
+
+        path = [self.root]
+
+        for char in word:
+            node = path[-1]
+            if char not in node.children:
+                node.children[char] = CompletionIndex.Node(node.word + char)
+            path.append(node.children[char])
+
+        path[-1].count += delta
+
+        for node in path:
+            node.top = None
+
+        # prune nodes that no longer lead anywhere
+        for i in range(len(path) - 1, 0, -1):
+            if path[i].count > 0 or path[i].children:
+                break
+            del path[i - 1].children[word[i - 1]]
+
+    def linesReplaced(self, oldLines, newLines):
+        if len(oldLines) + len(newLines) > self.BIG_EDIT:
+            # big edits often just move lines around (sorting, say), which
+            # doesn't change any word's count, so only look at lines that
+            # came or went
+            oldLineCounts = collections.Counter(oldLines)
+            newLineCounts = collections.Counter(newLines)
+
+            # (dict's own == is much quicker than Counter's for big counts)
+            if dict.__eq__(oldLineCounts, newLineCounts):
+                return
+
+            oldLines = list((oldLineCounts - newLineCounts).elements())
+            newLines = list((newLineCounts - oldLineCounts).elements())
+
+        self.countsReplaced(self.wordCounts(oldLines), self.wordCounts(newLines))
+
+    def countsReplaced(self, oldCounts, newCounts):
+        """Words counted 'oldCounts' times now occur 'newCounts' times, both from 'wordCounts'."""
+        for word in set(oldCounts) | set(newCounts):
+            delta = newCounts.get(word, 0) - oldCounts.get(word, 0)
+            if delta:
+                self.add(word, delta)
+
+    def topOf(self, node):
+        if node.top is None:
+            candidates = [(node.count, node.word)] if node.count > 0 else []
+
+            for child in node.children.values():
+                candidates.extend(self.topOf(child))
+
+            node.top = sorted(candidates, key=lambda c: (-c[0], c[1]))[:self.TOP_K]
+
+        return node.top
+
+    def complete(self, prefix):
+        """Return up to TOP_K (count, word) pairs starting with 'prefix', most common first."""
+        node = self.root
+
+        for char in prefix:
+            node = node.children.get(char)
+            if node is None:
+                return []
+
+        return self.topOf(node)
+
+    def queueFiles(self, fileSet):
+        """Arrange to read every file in 'fileSet' a few at a time from 'indexSomeFiles'.
+
+        Binaries get skipped there rather than here, since telling means opening each one.
+        """
+        self.indexesProject = True
+        self.pendingFiles = [fileSet.namesToPaths[name] for name in fileSet.sortedNames]
+
+    def indexSomeFiles(self, fileSet, seconds=0.05):
+        """Read queued files until 'seconds' have passed. Returns True if any remain."""
+        t0 = time.time()
+
+        while self.pendingFiles and time.time() - t0 < seconds:
+            path = self.pendingFiles.pop()
+
+            # an open file's words are already counted from its buffer
+            if path in self.bufferPaths or path in self.projectPaths:
+                continue
+
+            # reading binaries never fails now, so sniff them out before reading them in full
+            if fileSet.isBinary(path):
+                continue
+
+            try:
+                self.linesReplaced([], fileSet.readlines(path))
+                self.projectPaths.add(path)
+            except OSError:
+                pass
+
+        return bool(self.pendingFiles)
+
+
+class FindBox(Display):
+    def __init__(self, context):
+        super().__init__(context)
+
+        self.regex = False
+        self.wholeWord = False
+        self.caseSensitive = False
+
+        self.visible = False
+        self.showReplace = False
+        self.allFiles = False
+
+        self.pattern = ""
+        self.cursor = 0
+
+    def curHeight(self):
+        return 1
+
+    def setPattern(self, pattern):
+        self.pattern = pattern
+
+        openFile = self.context.currentOpenFile()
+
+        if openFile is not None:
+            selections = openFile.findAll(pattern)
+
+            if selections:
+                openFile.ensureOnScreen(selections[0])
+
+    def redraw(self):
+        ypos = self.context.windowY - 2
+        width = self.context.windowX
+        self.text(0, ypos, " " * width)
+        self.textBold(0, ypos, "FIND:")
+        self.textWithCursors(6, ypos, pad(self.pattern, width - 6), [self.cursor])
+
+    def receiveChar(self, char):
+        if char == KEY_ESC:
+            self.visible = False
+            return True
+
+        if char == "KEY_BACKSPACE" and self.cursor > 0:
+            self.setPattern(self.pattern[:self.cursor - 1] + self.pattern[self.cursor:])
+            self.cursor -= 1
+            return True
+
+        if char == KEY_CTRL_BACKSPACE:
+            self.setPattern(self.pattern[self.cursor:])
+            self.cursor = 0
+            return True
+
+        if char == KEY_CTRL_DELETE:
+            self.setPattern(self.pattern[:self.cursor])
+            return True
+
+        if char == "KEY_DC" and self.cursor < len(self.pattern):
+            self.setPattern(self.pattern[:self.cursor] + self.pattern[self.cursor + 1:])
+            return True
+
+        if char == "KEY_LEFT":
+            self.cursor = max(0, self.cursor - 1)
+            return True
+
+        if char == "KEY_RIGHT":
+            self.cursor = min(len(self.pattern), self.cursor + 1)
+            return True
+
+        if char in ("\n", KEY_CTRL_A):
+            openFile = self.context.currentOpenFile()
+
+            if openFile is not None:
+                if char == "\n":
+                    curSel = openFile.selections[-1]
+                    newSel = openFile.find(self.pattern, (curSel.line1, curSel.col1))
+                    if newSel is None:
+                        newSel = openFile.find(self.pattern, (0, 0))
+
+                    if newSel is not None:
+                        openFile.selections = [newSel]
+                else:
+                    openFile.selections = openFile.findAll(self.pattern)
+
+                if openFile.selections:
+                    openFile.ensureOnScreen(openFile.selections[0])
+
+                self.visible = False
+
+            return True
+
+        if len(char) == 1 and char.isprintable():
+            self.setPattern(self.pattern[:self.cursor] + char + self.pattern[self.cursor:])
+            self.cursor += 1
+            return True
+
+
+class PipeJob:
+    """Runs a shell command over some texts on background threads, one process per text.
+
+    One thread writes each text to the command in chunks while another
+    reads its output, so a big buffer can't fill one pipe while the other
+    waits on it, and the editor carries on while the command runs. Once
+    'done' is set, 'outputs' has a result per text, or 'error' says why
+    there isn't one.
+    """
+    CHUNK = 65536
+
+    def __init__(self, command, texts, cwd=None):
+        self.command = command
+        self.texts = texts
+        self.cwd = cwd
+
+        self.outputs = []
+        self.error = None
+        self.process = None
+        self.isCancelled = False
+        self.done = threading.Event()
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            for text in self.texts:
+                if self.isCancelled:
+                    break
+                self.outputs.append(self.runOne(text))
+        except (OSError, ValueError) as e:
+            self.error = str(e)
+        finally:
+            if self.isCancelled:
+                self.error = "cancelled"
+            self.done.set()
+
+    def runOne(self, text):
+        # commands expect lines to end with a newline, so give them one, and take it back off the output
+        addedNewline = not text.endswith("\n")
+        data = memoryview((text + "\n" if addedNewline else text).encode("utf-8"))
+
+        process = self.process = subprocess.Popen(
+            self.command, shell=True, cwd=self.cwd,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+
+        def feed():
+            try:
+                for start in range(0, len(data), PipeJob.CHUNK):
+                    process.stdin.write(data[start:start + PipeJob.CHUNK])
+            except (BrokenPipeError, ValueError):
+                # it stopped reading early, like 'head' does
+                pass
+            finally:
+                try:
+                    process.stdin.close()
+                except OSError:
+                    pass
+
+        errors = []
+        helpers = [
+            threading.Thread(target=feed, daemon=True),
+            threading.Thread(target=lambda: errors.append(process.stderr.read()), daemon=True)
+        ]
+        for helper in helpers:
+            helper.start()
+
+        chunks = []
+        while True:
+            chunk = process.stdout.read1(PipeJob.CHUNK)
+            if not chunk:
+                break
+            chunks.append(chunk)
+
+        for helper in helpers:
+            helper.join()
+        process.stdout.close()
+        process.stderr.close()
+
+        if process.wait() != 0 and not self.isCancelled:
+            message = errors[0].decode("utf-8", "replace").strip().split("\n")[-1] if errors and errors[0].strip() else ""
+            raise ValueError("exited with status %d%s" % (process.returncode, ": " + message if message else ""))
+
+        output = b"".join(chunks).decode("utf-8", "replace")
+
+        if addedNewline and output.endswith("\n"):
+            output = output[:-1]
+
+        return output
+
+    def cancel(self):
+        self.isCancelled = True
+
+        if self.process is not None:
+            try:
+                self.process.kill()
+            except OSError:
+                pass
+
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+
+class Pane:
+    """One rectangle of a split window, showing a TextBufferDisplay.
+
+    Panes showing the same file each have their own view of its buffer, so
+    they scroll and select independently.
+    """
+    def __init__(self, display):
+        self.display = display
+        self.rect = None
+
+    def leaves(self):
+        return [self]
+
+    def layout(self, x, y, width, height):
+        self.rect = (x, y, width, height)
+
+
+class PaneSplit:
+    """Two panes (or splits), side by side if 'sideBySide' and one above the other if not."""
+    def __init__(self, sideBySide, first, second):
+        self.sideBySide = sideBySide
+        self.children = [first, second]
+
+    def leaves(self):
+        return self.children[0].leaves() + self.children[1].leaves()
+
+    def layout(self, x, y, width, height):
+        if self.sideBySide:
+            firstWidth = width // 2
+            self.children[0].layout(x, y, firstWidth, height)
+            self.children[1].layout(x + firstWidth, y, width - firstWidth, height)
+        else:
+            firstHeight = height // 2
+            self.children[0].layout(x, y, width, firstHeight)
+            self.children[1].layout(x, y + firstHeight, width, height - firstHeight)
+
+    def replace(self, old, new):
+        """Replace 'old' (a child, or a descendant) with 'new'. Returns True if we found it."""
+        for i, child in enumerate(self.children):
+            if child is old:
+                self.children[i] = new
+                return True
+
+            if isinstance(child, PaneSplit) and child.replace(old, new):
+                return True
+
+        return False
+
+    def parentOf(self, node):
+        for child in self.children:
+            if child is node:
+                return self
+
+            if isinstance(child, PaneSplit):
+                parent = child.parentOf(node)
+                if parent is not None:
+                    return parent
+
+        return None
+
+
+class DisplayContext:
+    # we won't split a pane if the halves would be smaller than this
+    MIN_PANE_WIDTH = 24
+    MIN_PANE_HEIGHT = 6
+
+    def __init__(self, stdscr, fileSet):
+        self.fileSet = fileSet
+        self.openFiles = {}
+        self.lineStore = LineStore()
+        self.clipboard = None
+        self.clipboardIsWholeLine = False
+
+        # the keys of the last keyboard macro, and of the one being recorded, if any
+        self.macro = []
+        self.macroRecording = None
+
+        # (view, PipeJob) for commands still filtering some text, and the last command we ran
+        self.pipeJobs = []
+        self.lastPipeCommand = ""
+
+        self.findBox = FindBox(self)
+
+        self.stdscr = stdscr
+        self.windowY, self.windowX = self.stdscr.getmaxyx()
+        self.displays = [DefaultDisplay(self)]
+        self.wantsToExit = False
+
+        # if set, a KeyJournal that gets every key we receive
+        self.journal = None
+
+        # if set, a SwapFiles that journals unsaved edits
+        self.swapFiles = None
+
+        # if set, a SymbolIndex of the python files in the fileSet
+        self.symbolIndex = None
+
+        # a Pane or PaneSplit once the window has been split, and the Pane with the focus
+        self.paneTree = None
+        self.activePane = None
+
+        # identifiers in the open buffers, for Ctrl-Space
+        self.completions = CompletionIndex()
+
+        # which files get used, for ranking Ctrl-P. main() replaces this with one that persists
+        self.fileHistory = FileHistory(clock=lambda: self.clock())
+
+        # if set, the number of bytes open buffers may use before we start
+        # throwing away undo history and unloading clean buffers
+        self.memoryBudget = None
+        self.memoryCheckInterval = 500
+        self.keysSinceMemoryCheck = 0
+
+        # bumped every time a file is opened, so we know which ones are stale
+        self.activationCounter = 0
+
+        # if set, clean buffers that haven't been looked at for this many
+        # seconds get unloaded, and read back from disk when we switch to them
+        self.unloadInactiveAfter = None
+        self.clock = time.time
+
+    def pushDisplay(self, display):
+        self.displays.append(display)
+        self.fullRedraw()
+
+    def pushDisplays(self, displays):
+        self.displays.extend(displays)
+        self.fullRedraw()
+
+    def currentOpenFile(self):
+        if isinstance(self.displays[-1], FileDisplay):
+            return self.displays[-1]
+        return None
+
+    def openFile(self, fileName):
+        replaced = [d for d in self.displays if isinstance(d, TextBufferDisplay)]
+        self.displays = [d for d in self.displays if not isinstance(d, (TextBufferDisplay, CompletionPopup))]
+
+        recovered = None
+
+        if fileName not in self.openFiles:
+            self.openFiles[fileName] = FileDisplay(self, fileName, loadNow=False)
+
+        if not self.openFiles[fileName].isLoaded:
+            self.openFiles[fileName].load()
+
+            # buffers only get unloaded once their journal is gone, so if
+            # there is one it's from a session that didn't exit cleanly
+            if self.swapFiles is not None:
+                recovered = self.swapFiles.recover(
+                    self.openFiles[fileName].path,
+                    self.openFiles[fileName].linesOnDisk
+                )
+        else:
+            self.openFiles[fileName].checkDisk()
+
+        self.activationCounter += 1
+        self.openFiles[fileName].lastActivated = self.activationCounter
+        self.openFiles[fileName].lastActiveTime = self.clock()
+
+        self.fileHistory.record(fileName, FileHistory.OPEN_WEIGHT)
+
+        view = self.openFiles[fileName]
+
+        if any(p.display is view for p in self.panes() if p is not self.activePane):
+            # it's in another pane, which keeps its own view
+            view = view.newView()
+
+        self.displays.append(view)
+
+        for d in replaced:
+            self.dropView(d)
+
+        if recovered is not None:
+            self.displays.append(RecoverSwapDialog(self, self.openFiles[fileName], recovered))
+
+        self.unloadInactiveBuffers()
+        self.enforceMemoryBudget()
+
+        self.fullRedraw()
+
+    def openFileAtLine(self, fileName, lineIx):
+        self.openFile(fileName)
+
+        openFile = self.activeTextDisplay()
+        openFile.selections = [Selection(lineIx, 0, lineIx, 0).clipToReal(openFile.lines)]
+        openFile.ensureOnScreen(openFile.selections[-1])
+
+        self.fullRedraw()
+
+    def panes(self):
+        return self.paneTree.leaves() if self.paneTree is not None else []
+
+    def isOnScreen(self, display):
+        """Is 'display' on the display stack or in a pane?"""
+        return display in self.displays or any(p.display is display for p in self.panes())
+
+    def isBufferOnScreen(self, buffer):
+        return any(
+            getattr(d, "buffer", None) is buffer for d in self.displays
+        ) or any(p.display.buffer is buffer for p in self.panes())
+
+    def dropView(self, view):
+        """Detach 'view' from its buffer if nothing shows it and it isn't the view in 'openFiles'."""
+        if self.isOnScreen(view):
+            return
+
+        if isinstance(view, FileDisplay) and self.openFiles.get(view.fileName) is view:
+            return
+
+        view.detach()
+
+    def closeViewsOf(self, buffer):
+        """Take every view of 'buffer' off the screen, because it has been closed."""
+        for d in self.displays:
+            if getattr(d, "buffer", None) is buffer:
+                d.detach()
+
+        self.displays = [d for d in self.displays if getattr(d, "buffer", None) is not buffer]
+
+        for pane in self.panes():
+            if pane.display.buffer is buffer:
+                pane.display.detach()
+                pane.display = DefaultDisplay(self)
+
+        if len(self.displays) == 0:
+            self.displays.append(DefaultDisplay(self))
+
+        self.fullRedraw()
+
+    def activeTextDisplay(self):
+        """The TextBufferDisplay that has the focus."""
+        for d in reversed(self.displays):
+            if isinstance(d, TextBufferDisplay):
+                return d
+        return None
+
+    def splitPane(self, sideBySide):
+        """Split the focused pane in two, both showing its buffer, and focus the new half."""
+        display = self.activeTextDisplay()
+
+        if display is None:
+            return
+
+        _, _, width, height = display.viewRect()
+        if (width // 2 if sideBySide else width) < self.MIN_PANE_WIDTH:
+            return
+        if (height if sideBySide else height // 2) < self.MIN_PANE_HEIGHT:
+            return
+
+        if self.paneTree is None:
+            self.activePane = self.paneTree = Pane(display)
+
+        newPane = Pane(display.newView())
+        split = PaneSplit(sideBySide, self.activePane, newPane)
+
+        if self.paneTree is self.activePane:
+            self.paneTree = split
+        else:
+            self.paneTree.replace(self.activePane, split)
+
+        self.focusPane(newPane)
+
+    def closePane(self):
+        """Close the focused pane, giving its space to its neighbor."""
+        if not isinstance(self.paneTree, PaneSplit):
+            return
+
+        parent = self.paneTree.parentOf(self.activePane)
+        sibling = parent.children[1] if parent.children[0] is self.activePane else parent.children[0]
+
+        if parent is self.paneTree:
+            self.paneTree = sibling
+        else:
+            self.paneTree.replace(parent, sibling)
+
+        closed = self.activePane.display
+
+        self.focusPane(sibling.leaves()[0])
+        self.dropView(closed)
+
+        if isinstance(self.paneTree, Pane):
+            # back to a single pane, which takes the whole window
+            self.paneTree.display.rect = None
+            self.paneTree = self.activePane = None
+
+        self.fullRedraw()
+
+    def focusNextPane(self):
+        panes = self.panes()
+
+        if len(panes) > 1:
+            self.focusPane(panes[(panes.index(self.activePane) + 1) % len(panes)])
+
+    def focusPane(self, pane):
+        current = self.activePane.display
+
+        self.activePane = pane
+
+        if pane.display is not current:
+            self.displays = [pane.display if d is current else d for d in self.displays]
+
+        if isinstance(pane.display, FileDisplay):
+            self.activationCounter += 1
+            pane.display.lastActivated = self.activationCounter
+            pane.display.lastActiveTime = self.clock()
+
+        self.fullRedraw()
+
+    def layoutPanes(self):
+        """Work out where each pane goes, and make sure they show sensible displays."""
+        findBoxRows = self.findBox.curHeight() if self.findBox.visible else 0
+        self.paneTree.layout(0, 0, self.windowX, self.windowY - findBoxRows)
+
+        active = self.activeTextDisplay()
+
+        # whatever display is on the stack is what the focused pane shows
+        if active is not None and self.activePane.display is not active:
+            previous = self.activePane.display
+            self.activePane.display = active
+            self.dropView(previous)
+
+        for pane in self.panes():
+            pane.display.rect = pane.rect
+
+    def drawInactivePane(self, pane):
+        pane.display.isActive = False
+
+        try:
+            pane.display.redraw()
+        finally:
+            pane.display.isActive = True
+
+    def redrawPanesSharing(self, display):
+        """Redraw the unfocused panes that show the buffer of 'display', which may just have been edited."""
+        for pane in self.panes():
+            if pane is not self.activePane and pane.display.buffer is display.buffer:
+                self.drawInactivePane(pane)
+
+    def sessionState(self):
+        """What we need to reopen the same files, looking at the same places, next time we start."""
+        active = self.currentOpenFile()
+
+        return {
+            "files": [
+                {
+                    "name": name,
+                    "selections": [[s.line0, s.col0, s.line1, s.col1] for s in f.selections],
+                    "topLine": f.topLine,
+                    "leftmostCol": f.leftmostCol
+                }
+                for name, f in sorted(self.openFiles.items())
+            ],
+            "active": active.fileName if active is not None else None,
+            "find": {
+                "pattern": self.findBox.pattern,
+                "regex": self.findBox.regex,
+                "wholeWord": self.findBox.wholeWord,
+                "caseSensitive": self.findBox.caseSensitive
+            }
+        }
+
+    def restoreSession(self, state):
+        """Reopen the files from 'sessionState'.
+
+        Only the file that was active gets read. The others are opened
+        unloaded, and read from disk when we switch to them.
+        """
+        for entry in state.get("files", []):
+            name = entry["name"]
+
+            if name not in self.fileSet.namesToPaths or name in self.openFiles:
+                continue
+
+            f = FileDisplay(self, name, loadNow=False)
+
+            # these get clipped to the text once it's loaded
+            f.selections = [Selection(*s) for s in entry["selections"]] or [Selection(0, 0, 0, 0)]
+            f.topLine = entry["topLine"]
+            f.leftmostCol = entry.get("leftmostCol", 0)
+
+            self.openFiles[name] = f
+
+        find = state.get("find", {})
+        self.findBox.pattern = find.get("pattern", "")
+        self.findBox.cursor = len(self.findBox.pattern)
+        self.findBox.regex = find.get("regex", False)
+        self.findBox.wholeWord = find.get("wholeWord", False)
+        self.findBox.caseSensitive = find.get("caseSensitive", False)
+
+        if state.get("active") in self.openFiles:
+            self.openFile(state["active"])
+        else:
+            self.fullRedraw()
+
+    def saveSession(self, path):
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + ".tmp", "w") as f:
+                json.dump(self.sessionState(), f)
+            os.replace(path + ".tmp", path)
+        except OSError:
+            pass
+
+    def loadSession(self, path):
+        """Restore the session saved at 'path', if there is one we can read."""
+        try:
+            with open(path, "r") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        try:
+            self.restoreSession(state)
+        except (KeyError, TypeError, ValueError):
+            # a session from an incompatible version. Better to start empty than not at all
+            pass
+
+    def memoryUsage(self):
+        """Return a dict from file name to FileDisplay.memoryUsage()."""
+        return {name: f.memoryUsage() for name, f in self.openFiles.items()}
+
+    def enforceMemoryBudget(self):
+        """Free memory until the open buffers fit in 'memoryBudget'.
+
+        We throw away undo history, least recently used buffer first, and
+        then unload buffers that have no unsaved changes. Buffers that are
+        on screen are never touched.
+        """
+        self.keysSinceMemoryCheck = 0
+
+        if self.memoryBudget is None:
+            return
+
+        usage = self.memoryUsage()
+        total = sum(sum(u.values()) for u in usage.values())
+
+        candidates = sorted(
+            [f for f in self.openFiles.values() if not self.isBufferOnScreen(f.buffer)],
+            key=lambda f: f.lastActivated
+        )
+
+        for f in candidates:
+            if total <= self.memoryBudget:
+                return
+
+            if f.undoBuffer.evict():
+                newUsage = f.memoryUsage()
+                total += sum(newUsage.values()) - sum(usage[f.fileName].values())
+                usage[f.fileName] = newUsage
+
+        for f in candidates:
+            if total <= self.memoryBudget:
+                return
+
+            if f.isLoaded and not f.isChanged():
+                f.unload()
+                total -= sum(usage[f.fileName].values())
+
+    def unloadInactiveBuffers(self):
+        """Unload clean buffers nobody has looked at for 'unloadInactiveAfter' seconds."""
+        if self.unloadInactiveAfter is None:
+            return
+
+        now = self.clock()
+
+        for f in self.openFiles.values():
+            if (
+                f.isLoaded
+                and not self.isBufferOnScreen(f.buffer)
+                and now - f.lastActiveTime > self.unloadInactiveAfter
+                and not f.isChanged()
+            ):
+                f.unload()
+
+    def liveLineLists(self):
+        """Every list of lines we're holding onto: text, saved copies and undo history."""
+        for f in self.openFiles.values():
+            yield f.lines
+            yield f.linesOnDisk
+
+            for lines, _ in f.undoBuffer.history:
+                yield lines
+
+    def sweepLineStore(self):
+        return self.lineStore.sweep(self.liveLineLists())
+
+    def idle(self):
+        """Called periodically when no keys are arriving."""
+        self.finishPipeJobs()
+
+        self.unloadInactiveBuffers()
+
+        if self.lineStore.needsSweep():
+            self.sweepLineStore()
+
+        if self.symbolIndex is not None and not self.symbolIndex.isBuilding:
+            self.symbolIndex.save()
+
+        if self.completions.pendingFiles:
+            self.completions.indexSomeFiles(self.fileSet)
+
+        self.fileHistory.save()
+
+    def finishPipeJobs(self):
+        """Apply the output of any commands that have finished to the views that ran them."""
+        finished = [(view, job) for view, job in self.pipeJobs if job.done.is_set()]
+
+        if not finished:
+            return
+
+        self.pipeJobs = [(view, job) for view, job in self.pipeJobs if not job.done.is_set()]
+
+        for view, job in finished:
+            view.pipeFinished(job)
+
+        self.fullRedraw()
+
+    def receiveChars(self, *chars):
+        for c in chars:
+            self.receiveChar(c)
+
+    def receiveChar(self, char):
+        # not just when idle: typing fast on a huge line interns a new copy of it per key
+        if self.lineStore.needsSweep():
+            self.sweepLineStore()
+
+        if self.journal is not None:
+            if char == "KEY_RESIZE":
+                self.journal.recordResize(*self.stdscr.getmaxyx())
+            else:
+                self.journal.recordKey(char)
+
+        if char in (KEY_ALT_PAGE_DOWN, KEY_ALT_PAGE_UP):
+            # alt-page-down/up
+            if self.openFiles:
+                cof = self.currentOpenFile()
+                if cof is not None:
+                    index = sorted(self.openFiles).index(cof.fileName)
+                    index = (index + (1 if char == KEY_ALT_PAGE_DOWN else -1)) % len(self.openFiles)
+                    self.openFile(sorted(self.openFiles)[index])
+            return True
+
+        if char == "KEY_RESIZE":
+            self.windowY, self.windowX = self.stdscr.getmaxyx()
+
+            for d in self.displays:
+                d.resized()
+
+            self.fullRedraw()
+
+            return True
+
+        if char in (KEY_F6, KEY_F7, KEY_SHIFT_F7, KEY_F8) and isinstance(self.displays[-1], TextBufferDisplay):
+            if char == KEY_F6:
+                self.focusNextPane()
+            elif char == KEY_F8:
+                self.closePane()
+            else:
+                self.splitPane(sideBySide=(char == KEY_F7))
+            return True
+
+        if char == KEY_CTRL_P:
+            self.newWindow(FileSelector(self))
+            return True
+
+        if char == KEY_CTRL_T:
+            if self.symbolIndex is not None:
+                self.newWindow(SymbolSelector(self))
+            return True
+
+        if char == KEY_CTRL_O:
+            whichFile = 0
+
+            if self.displays and isinstance(self.displays[-1], FileDisplay):
+                try:
+                    whichFile = sorted(self.openFiles).index(self.displays[-1].fileName)
+                except ValueError:
+                    pass
+
+            self.newWindow(OpenFiles(self, whichFile))
+            return True
+
+        cof = self.currentOpenFile()
+        if cof is not None:
+            cof.lastActiveTime = self.clock()
+
+        self.keysSinceMemoryCheck += 1
+        if self.keysSinceMemoryCheck >= self.memoryCheckInterval:
+            self.enforceMemoryBudget()
+
+        handled = self.displays[-1].receiveChar(char)
+
+        if self.paneTree is not None and isinstance(self.displays[-1], TextBufferDisplay):
+            self.redrawPanesSharing(self.displays[-1])
+
+        if handled:
+            return True
+
+        if char == KEY_CTRL_Q:
+            needClose = [o for o in self.openFiles.values() if o.isChanged()]
+            if not needClose:
+                self.wantsToExit = True
+            else:
+                isFirst = True
+                displays = []
+                for n in needClose:
+                    displays.append(CloseBeforeSavingDialog(self, n, postAction=self.setExitFlag))
+                    isFirst = False
+                self.pushDisplays(displays)
+
+            return True
+
+    def setExitFlag(self):
+        self.wantsToExit = True
+
+    def removeDisplay(self, disp):
+        self.displays.remove(disp)
+
+        if len(self.displays) == 0:
+            self.displays.append(DefaultDisplay(self))
+
+        self.fullRedraw()
+
+    def fullRedraw(self):
+        self.stdscr.erase()
+
+        if self.paneTree is not None:
+            self.layoutPanes()
+
+            for pane in self.panes():
+                if pane is not self.activePane:
+                    self.drawInactivePane(pane)
+
+        for disp in self.displays:
+            disp.redraw()
+
+    def newWindow(self, window):
+        self.displays.append(window)
+        window.redraw()
+
+
+class Selection:
+    def __init__(self, line0, col0, line1, col1):
+        self.line0 = line0
+        self.col0 = col0
+        self.line1 = line1
+        self.col1 = col1
+
+    def asTuple(self):
+        # ensure the sort-order is based on the earliest visible point
+        if not self.isOrdered():
+            return (self.line1, self.col1, self.line0, self.col0, 1)
+        else:
+            return (self.line0, self.col0, self.line1, self.col1, 0)
+
+    def isOrdered(self):
+        return (self.line0, self.col0) <= (self.line1, self.col1)
+
+    def overlaps(self, other):
+        t1 = self.asTuple()
+        t2 = other.asTuple()
+
+        low1 = (t1[0], t1[1])
+        high1 = (t1[2], t1[3])
+
+        low2 = (t2[0], t2[1])
+        high2 = (t2[2], t2[3])
+
+        if low1 > high2:
+            return False
+
+        if low2 > high1:
+            return False
+
+        return True
+
+    def merge(self, other):
+        t1 = self.asTuple()
+        t2 = other.asTuple()
+
+        low1 = (t1[0], t1[1])
+        high1 = (t1[2], t1[3])
+
+        low2 = (t2[0], t2[1])
+        high2 = (t2[2], t2[3])
+
+        low = min(low1, low2)
+        high = min(high1, high2)
+
+        return Selection(*low, *high)
+
+    def __eq__(self, other):
+        return self.asTuple() == other.asTuple()
+
+    def __lt__(self, other):
+        return self.asTuple() < other.asTuple()
+
+    def __hash__(self):
+        return hash(self.asTuple())
+
+    def __str__(self):
+        if self.isSingle():
+            return f"{self.line0}:{self.col0}"
+
+        if self.isSingleLine():
+            return f"{self.line0}:{self.col0}-{self.col1}"
+
+        return f"({self.line0}:{self.col0})-({self.line1}:{self.col1})"
+
+    def __repr__(self):
+        return str(self)
+
+    def isSingle(self):
+        return (self.line0, self.col0) == (self.line1, self.col1)
+
+    def isSingleLine(self):
+        return self.line0 == self.line1
+
+    def isTrivial(self):
+        return (self.line0, self.line1, self.col0, self.col1) == (0, 0, 0, 0)
+
+    def clipToReal(self, lines):
+        l0, c0, l1, c1 = self.line0, self.col0, self.line1, self.col1
+
+        if not lines:
+            return Selection(0, 0, 0, 0)
+
+        if l0 < 0:
+            l0 = 0
+            c0 = 0
+
+        if l1 < 0:
+            l1 = 0
+            c1 = 0
+
+        if l0 >= len(lines):
+            l0 = len(lines) - 1
+            c0 = len(lines[-1])
+
+        if l1 >= len(lines):
+            l1 = len(lines) - 1
+            c1 = len(lines[-1])
+
+        if c0 < 0:
+            c0 = 0
+        if c0 > len(lines[l0]):
+            c0 = len(lines[l0])
+
+        if c1 < 0:
+            c1 = 0
+        if c1 > len(lines[l1]):
+            c1 = len(lines[l1])
+
+        if l0 > l1 or l0 == l1 and c0 > c1:
+            lt, ct = l0, c0
+            l0, c0 = l1, c1
+            l1, c1 = lt, ct
+
+        return Selection(l0, c0, l1, c1)
+
+    def extendCursors(self, cursorsByLine, lines, firstLine=0, lastLine=None):
+        """Add the (startCol, endCol) spans we highlight to 'cursorsByLine', for lines in [firstLine, lastLine]."""
+        self = self.clipToReal(lines)
+
+        if lastLine is None:
+            lastLine = len(lines) - 1
+
+        def add(line, start, end):
+            if firstLine <= line <= lastLine and start < end:
+                cursorsByLine.setdefault(line, []).append((start, end))
+
+        if self.isTrivial():
+            add(0, 0, 1)
+            return
+
+        if self.isSingle():
+            add(self.line0, self.col0, self.col0 + 1)
+
+        if self.line0 != self.line1:
+            add(self.line0, self.col0, len(lines[self.line0]) + 1)
+            add(self.line1, 0, self.col1)
+
+            for line in range(max(self.line0 + 1, firstLine), min(self.line1, lastLine + 1)):
+                add(line, 0, max(1, len(lines[line])))
+        else:
+            add(self.line0, self.col0, self.col1)
+
+    @staticmethod
+    def clipLine(lNumber, lines):
+        return max(0, min(lNumber, max(len(lines) - 1, 0)))
+
+    @staticmethod
+    def wordDelta(lines, line, col, direction):
+        if line < 0:
+            return 0, 0
+
+        if line >= len(lines):
+            return max(0, len(lines) - 1), MAX_COL
+
+        col = min(col, len(lines[line]))
+
+        # we can skip space until we get to non-space
+        # at which point, we don't skip space
+        skippedIdentifier = False
+
+        charsSkipped = 0
+
+        while True:
+            lineOut, colOut = Selection.charDelta(lines, line, col, direction)
+
+            if lineOut != line and charsSkipped > 0:
+                return line, col
+
+            if (lineOut, colOut) == (line, col):
+                return lineOut, colOut
+
+            charCrossed = Selection.charCrossedBy(lines, line, col, lineOut, colOut)
+
+            if not charCrossed.isidentifier() and not skippedIdentifier:
+                pass
+            else:
+                if not charCrossed.isidentifier():
+                    return line, col
+
+                skippedIdentifier = True
+
+            line, col = lineOut, colOut
+            charsSkipped += len(charCrossed)
+
+    @staticmethod
+    def charCrossedBy(lines, l0, c0, l1, c1):
+        if l0 != l1:
+            return "\n"
+
+        return lines[l0][min(c0, c1):max(c0, c1)]
+
+    @staticmethod
+    def charDelta(lines, line, col, direction):
+        if col >= len(lines[line]) and direction == -1:
+            col = len(lines[line]) - 1
+            if col < 0:
+                line -= 1
+                col = MAX_COL
+        elif col >= len(lines[line]) and direction == 1:
+            col = 0
+            line += 1
+        else:
+            col += direction
+
+            if col < 0:
+                line -= 1
+                col = MAX_COL
+
+        line = Selection.clipLine(line, lines)
+
+        col = min(col, MAX_COL)
+
+        return line, col
+
+    def delta(self, lines, dLine, dCol, extend=False, word=False, isHomeKey=False, isTabBackspace=False, folds=None):
+        """Move the cursor end of the selection.
+
+        If 'folds' is a FoldMap, line movement counts visible lines, and the
+        cursor skips over folded text rather than landing inside it.
+        """
+        if not lines:
+            return Selection(0, 0, 0, 0)
+
+        l0, c0, l1, c1 = self.line0, self.col0, self.line1, self.col1
+
+        if isTabBackspace and c0 > 0:
+            assert dCol == -1
+
+            frontWhitespaceChars = len(lines[l1]) - len(lines[l1].lstrip())
+            if c0 <= frontWhitespaceChars:
+                whitespace = lines[l1][:frontWhitespaceChars]
+                if whitespace == " " * len(whitespace):
+                    # it's all whitespace here
+                    if c0 % 4 == 0:
+                        dCol = -4
+                    else:
+                        dCol = -(c0 % 4)
+
+        if isHomeKey:
+            c1 = len(lines[l1]) - len(lines[l1].lstrip())
+        elif word:
+            assert dLine == 0
+            l1, c1 = self.wordDelta(lines, l1, c1, dCol)
+        else:
+            if dCol != 0:
+                # this is a character delta
+                l1, c1 = self.charDelta(lines, l1, c1, dCol)
+            else:
+                # this is a line delta
+                if folds is not None:
+                    l1 = folds.moveLine(l1, dLine)
+                else:
+                    l1 += dLine
+
+                if l1 < 0 and dLine < -1:
+                    c1 = 0
+                elif l1 >= len(lines) and dLine > 1:
+                    c1 = MAX_COL
+
+                l1 = self.clipLine(l1, lines)
+
+        if folds is not None and folds.isHidden(l1):
+            if dLine > 0 or dCol > 0:
+                l1 = self.clipLine(folds.nextVisible(l1, 1), lines)
+                c1 = 0
+            else:
+                l1 = folds.nextVisible(l1, -1)
+                c1 = len(lines[l1])
+
+        if extend:
+            return Selection(l0, c0, l1, c1)
+        else:
+            return Selection(l1, c1, l1, c1)
+
+    def selectedText(self, lines):
+        self = self.clipToReal(lines)
+
+        if self.line0 == self.line1:
+            return lines[self.line0][self.col0:self.col1]
+
+        return "\n".join(
+            [lines[self.line0][self.col0:]]
+            + lines[self.line0 + 1:self.line1]
+            + [lines[self.line1][:self.col1]]
+        )
+
+    def selectWord(self, lines):
+        self = self.clipToReal(lines)
+
+        toLeft = self.charDelta(lines, self.line0, self.col0, -1)
+        toRight = self.charDelta(lines, self.line1, self.col1, 1)
+
+        crossedLeft = self.charCrossedBy(lines, self.line0, self.col0, toLeft[0], toLeft[1])
+        crossedRight = self.charCrossedBy(lines, self.line1, self.col1, toRight[0], toRight[1])
+
+        if crossedLeft.isidentifier():
+            leftPoint = self.wordDelta(lines, self.line0, self.col0, -1)
+        else:
+            leftPoint = self.line0, self.col0
+
+        if crossedRight.isidentifier():
+            rightPoint = self.wordDelta(lines, self.line1, self.col1, 1)
+        else:
+            rightPoint = self.line1, self.col1
+
+        return Selection(*leftPoint, *rightPoint)
+
+    @staticmethod
+    def mergeContiguous(selections):
+        selections = sorted(selections)
+
+        while True:
+            newSelections = Selection.mergeContiguousSinglePass(selections)
+
+            if newSelections == selections:
+                return newSelections
+            else:
+                selections = newSelections
+
+        return selections
+
+    @staticmethod
+    def mergeContiguousSinglePass(selections):
+        selections = list(selections)
+
+        i = 0
+        while i + 1 < len(selections):
+            if selections[i].overlaps(selections[i+1]):
+                merged = selections[i].merge(selections[i+1])
+                selections[i] = merged
+                selections.pop(i+1)
+            else:
+                i += 1
+
+        return selections
+
+    def insertedChars(self, line, col, charsInserted):
+        l0, c0, l1, c1 = self.line0, self.col0, self.line1, self.col1
+
+        if line == l0 and col <= c0:
+            c0 += charsInserted
+
+        if line == l1 and col <= c1:
+            c1 += charsInserted
+
+        return Selection(l0, c0, l1, c1)
+
+    def insertedLines(self, line, col, count=1):
+        l0, c0, l1, c1 = self.line0, self.col0, self.line1, self.col1
+
+        def mapPoint(l, c):
+            if (l, c) < (line, col):
+                return l, c
+            if l == line:
+                return l + count, c - col
+            else:
+                return l + count, c
+
+        l0, c0 = mapPoint(l0, c0)
+        l1, c1 = mapPoint(l1, c1)
+
+        return Selection(l0, c0, l1, c1)
+
+    def rangeDeleted(self, selection):
+        assert selection.isOrdered()
+
+        l0, c0, l1, c1 = self.line0, self.col0, self.line1, self.col1
+
+        l0, c0 = selection.mapPointIfSelfDeleted(l0, c0)
+        l1, c1 = selection.mapPointIfSelfDeleted(l1, c1)
+
+        return Selection(l0, c0, l1, c1)
+
+    def mapPointIfSelfDeleted(self, line, col):
+        if (line, col) < (self.line0, self.col0):
+            return (line, col)
+
+        if (line, col) <= (self.line1, self.col1):
+            return (self.line0, self.col0)
+
+        if line == self.line1:
             return (self.line1, col - (self.col1 - self.col0))
 
-        return (line - (self.line1 - self.line0), col)
+        return (line - (self.line1 - self.line0), col)
+
+    def ensureValid(self, lines):
+        l0, c0, l1, c1 = self.line0, self.col0, self.line1, self.col1
+
+        if l0 >= len(lines):
+            l0 = max(0, len(lines) - 1)
+
+        if l1 >= len(lines):
+            l1 = max(0, len(lines) - 1)
+
+        return Selection(l0, c0, l1, c1)
+
+
+class BlockSelection:
+    """A rectangle of text: the same range of screen cells on each of a run of lines.
+
+    It's kept in cells rather than columns so that it stays straight across
+    tabs and wide characters. The 'anchor' corner stays put while the 'head'
+    corner moves. Each line's part of it is clipped to the line, so a short
+    line just gets a cursor at its end.
+
+    After an edit the block is a column of cursors, and 'cols' holds the
+    column of each one (from 'top' down), since where typing left them can
+    be a different cell on each line once tabs or wide characters are
+    involved. Moving the block goes back to cells, from the head's.
+    """
+    def __init__(self, anchorLine, anchorCell, headLine, headCell, cols=None):
+        self.anchorLine = anchorLine
+        self.anchorCell = anchorCell
+        self.headLine = headLine
+        self.headCell = headCell
+        self.cols = cols
+
+    @property
+    def top(self):
+        return min(self.anchorLine, self.headLine)
+
+    @property
+    def bottom(self):
+        return max(self.anchorLine, self.headLine)
+
+    @property
+    def left(self):
+        return min(self.anchorCell, self.headCell)
+
+    @property
+    def right(self):
+        return max(self.anchorCell, self.headCell)
+
+    def moved(self, lines, dLine, dCell):
+        """The block with its head moved by 'dLine' lines and 'dCell' cells."""
+        return BlockSelection(
+            self.anchorLine,
+            self.anchorCell,
+            Selection.clipLine(self.headLine + dLine, lines),
+            max(0, self.headCell + dCell)
+        )
+
+    def spanOn(self, text, line):
+        """The columns (col0, col1) of 'text', which is line 'line', that the block covers."""
+        if self.cols is not None:
+            col = min(self.cols[line - self.top], len(text))
+            return col, col
+
+        return min(colOfCell(text, self.left), len(text)), min(colOfCell(text, self.right), len(text))
+
+    def selectionOn(self, lines, line):
+        text = lines[line] if line < len(lines) else ""
+
+        if self.cols is not None:
+            col = min(self.cols[line - self.top], len(text))
+            return Selection(line, col, line, col)
+
+        anchorCol = min(colOfCell(text, self.anchorCell), len(text))
+        headCol = min(colOfCell(text, self.headCell), len(text))
+
+        return Selection(line, anchorCol, line, headCol)
+
+    def selections(self, lines):
+        """The block as one Selection per line, with the head's line last."""
+        return [
+            self.selectionOn(lines, line) for line in range(self.top, self.bottom + 1) if line != self.headLine
+        ] + [self.selectionOn(lines, self.headLine)]
+
+    def edited(self, lines, char):
+        """Type 'char' (or backspace or delete) on every line of the block.
+
+        Returns (newLines, block): replacements for lines [top, bottom], and
+        where the block ends up, which is a column of cursors. Backspace and
+        delete at a bare cursor take the character before or after it, but
+        never join lines.
+        """
+        typed = char if len(char) == 1 else ""
+
+        newLines = []
+        newCols = []
+
+        for line in range(self.top, self.bottom + 1):
+            # an empty buffer has no lines at all yet
+            text = lines[line] if line < len(lines) else ""
+            col0, col1 = self.spanOn(text, line)
+
+            if col0 == col1:
+                if char == "KEY_BACKSPACE":
+                    col0 = max(col0 - 1, 0)
+                elif char == "KEY_DC":
+                    col1 = min(col1 + 1, len(text))
+
+            newLines.append(text[:col0] + typed + text[col1:])
+            newCols.append(col0 + len(typed))
+
+        headCell = cellOfCol(newLines[self.headLine - self.top], newCols[self.headLine - self.top])
+
+        return newLines, BlockSelection(self.anchorLine, headCell, self.headLine, headCell, newCols)
+
+
+class UndoBuffer:
+    def __init__(self):
+        self.history = []
+        self.currentHistoryPos = None
+        self.topHistoryPosIsInsert = False
+
+    def pushState(self, state, changeIsNav=False):
+        if not self.history:
+            self.history.append(state)
+            self.currentHistoryPos = 0
+            self.topHistoryPosIsInsert = False
+        else:
+            if self.currentHistoryPos < len(self.history) - 1:
+                self.history = self.history[:self.currentHistoryPos + 1]
+
+            if changeIsNav:
+                # we navigated - just set the flag
+                self.topHistoryPosIsInsert = False
+                return
+
+            if self.topHistoryPosIsInsert:
+                # replace the top history with this
+                self.history[self.currentHistoryPos] = state
+            else:
+                self.history.append(state)
+                self.currentHistoryPos += 1
+                self.topHistoryPosIsInsert = True
+
+    def undo(self):
+        if not self.history:
+            return None
+
+        self.currentHistoryPos = max(0, self.currentHistoryPos - 1)
+
+        return self.history[self.currentHistoryPos]
+
+    def redo(self):
+        if not self.history:
+            return None
+
+        self.currentHistoryPos = min(len(self.history) - 1, self.currentHistoryPos + 1)
+
+        return self.history[self.currentHistoryPos]
+
+    def evict(self):
+        """Forget everything but the current state. Returns True if that freed anything."""
+        if len(self.history) <= 1:
+            return False
+
+        self.history = [self.history[self.currentHistoryPos]]
+        self.currentHistoryPos = 0
+        self.topHistoryPosIsInsert = False
+
+        return True
+
+    def memoryUsage(self, seen):
+        return sys.getsizeof(self.history) + sum(
+            linesMemoryUsage(lines, seen) + sys.getsizeof(selections)
+            for lines, selections in self.history
+        )
+
+
+class PythonHighlighter:
+    """Incremental syntax highlighting for python.
+
+    We cache, for each line, the lexer state at the end of the line - which
+    is None, or the delimiter of the triple-quoted string we're inside of.
+    'endStates[:validUpTo]' are known to be correct. Lines below that are
+    only lexed when something asks about them, so opening a file only costs
+    the rows that are on screen.
+
+    When lines are edited above 'validUpTo' we re-lex just the edited lines
+    and keep going until the end-of-line state matches what we had cached
+    before the edit, at which point everything below is still good.
+
+    Attribute runs for a line are cached along with the state the line was
+    lexed from, so they're recomputed only when the text or the incoming
+    state changes.
+    """
+    TOKEN = re.compile(
+        r"(?P<comment>#.*)"
+        r"|(?P<string>[rRbBuUfF]{0,2}(?:" '"""' r"|'''" r'|"(?:\\.|[^"\\])*"?' r"|'(?:\\.|[^'\\])*'?))"
+        r"|(?P<number>\b(?:0[xXoObB][0-9a-fA-F_]+|\d[\d_]*\.?[\d_]*(?:[eE][+-]?\d+)?j?)\b)"
+        r"|(?P<decorator>^\s*@[\w.]+)"
+        r"|(?P<name>[A-Za-z_]\w*)"
+    )
+    KEYWORDS = frozenset(keyword.kwlist)
+    BUILTINS = frozenset(dir(builtins)) | {"self", "cls"}
+
+    # how many lines past an edit we'll re-lex eagerly looking for the
+    # state to converge. Beyond that we leave the rest for later.
+    MAX_EAGER_RELEX = 2000
+
+    def __init__(self, lineCount):
+        self.endStates = [None] * lineCount
+        self.validUpTo = 0
+        self.runs = [None] * lineCount
+
+    @staticmethod
+    def lexLine(line, state):
+        """Lex one line starting in 'state'. Returns (runs, endState).
+
+        'runs' is a list of (startCol, length, kind) where kind is one of
+        'keyword', 'builtin', 'definition', 'string', 'comment', 'number'
+        or 'decorator'.
+        """
+        runs = []
+        pos = 0
+
+        if state is not None:
+            end = line.find(state)
+            if end == -1:
+                return [(0, len(line), "string")] if line else [], state
+
+            runs.append((0, end + 3, "string"))
+            pos = end + 3
+
+        prevWord = None
+
+        while True:
+            match = PythonHighlighter.TOKEN.search(line, pos)
+            if match is None:
+                break
+
+            kind = match.lastgroup
+            start, end = match.span()
+
+            if kind == "string":
+                quote = match.group().lstrip("rRbBuUfF")[:3]
+
+                if quote in ('"""', "'''"):
+                    close = line.find(quote, end)
+                    if close == -1:
+                        runs.append((start, len(line) - start, "string"))
+                        return runs, quote
+                    end = close + 3
+
+            elif kind == "name":
+                word = match.group()
+
+                if word in PythonHighlighter.KEYWORDS:
+                    kind = "keyword"
+                elif prevWord in ("def", "class"):
+                    kind = "definition"
+                elif word in PythonHighlighter.BUILTINS:
+                    kind = "builtin"
+                else:
+                    kind = None
+
+                prevWord = word
+
+            if kind is not None:
+                runs.append((start, end - start, kind))
+
+            pos = end
+
+        return runs, None
+
+    @staticmethod
+    def endStateOf(line, state):
+        if state is None and '"' not in line and "'" not in line:
+            return None
+
+        return PythonHighlighter.lexLine(line, state)[1]
+
+    def startStateFor(self, lines, lineIx):
+        self.ensureStates(lines, lineIx)
+        return self.endStates[lineIx - 1] if lineIx > 0 else None
+
+    def ensureStates(self, lines, upTo):
+        """Make sure endStates[:upTo] are valid."""
+        state = self.endStates[self.validUpTo - 1] if self.validUpTo > 0 else None
+
+        for i in range(self.validUpTo, min(upTo, len(lines))):
+            state = self.endStateOf(lines[i], state)
+            self.endStates[i] = state
+
+        self.validUpTo = max(self.validUpTo, min(upTo, len(lines)))
+
+    def runsFor(self, lines, lineIx):
+        startState = self.startStateFor(lines, lineIx)
+
+        cached = self.runs[lineIx]
+        if cached is not None and cached[0] == startState:
+            return cached[1]
+
+        runs, endState = self.lexLine(lines[lineIx], startState)
+        self.runs[lineIx] = (startState, runs)
+
+        return runs
+
+    def linesReplaced(self, lines, line0, oldCount, newCount):
+        oldValidUpTo = self.validUpTo
+
+        self.endStates[line0:line0 + oldCount] = [None] * newCount
+        self.runs[line0:line0 + oldCount] = [None] * newCount
+
+        if line0 >= oldValidUpTo:
+            return
+
+        # everything below the edit that was valid is still valid if the state
+        # coming out of the edited region matches what it was before
+        stillValidUpTo = oldValidUpTo + newCount - oldCount
+        state = self.endStates[line0 - 1] if line0 > 0 else None
+
+        i = line0
+        while i < stillValidUpTo:
+            newState = self.endStateOf(lines[i], state)
+
+            if i >= line0 + newCount and newState == self.endStates[i]:
+                self.validUpTo = stillValidUpTo
+                return
+
+            self.endStates[i] = newState
+            state = newState
+            i += 1
+
+            if i > line0 + newCount + self.MAX_EAGER_RELEX:
+                break
+
+        self.validUpTo = i
+
+    def memoryUsage(self):
+        return sys.getsizeof(self.endStates) + sys.getsizeof(self.runs) + sum(
+            sys.getsizeof(r[1]) + 72 * len(r[1]) for r in self.runs if r is not None
+        )
+
+
+class Outline:
+    """The classes and defs in a python buffer, kept up to date as it's edited.
+
+    'entries' has one slot per line: None, or (indent, kind, name) if the line
+    starts a class or def. Edits only rescan the lines they touch, so the
+    outline of a huge module costs one pass when it's first asked for and
+    almost nothing after that.
+    """
+    DEFINITION = re.compile(r"^(\s*)(class|def|async\s+def)\s+([A-Za-z_]\w*)")
+
+    def __init__(self, lines):
+        self.entries = [self.entryFor(line) for line in lines]
+
+    @staticmethod
+    def entryFor(line):
+        if "def" not in line and "class" not in line:
+            return None
+
+        match = Outline.DEFINITION.match(line)
+        if match is None:
+            return None
+
+        return (len(match.group(1)), "class" if match.group(2) == "class" else "def", match.group(3))
+
+    def linesReplaced(self, line0, oldCount, newLines):
+        self.entries[line0:line0 + oldCount] = [self.entryFor(line) for line in newLines]
+
+    def symbols(self):
+        """Return a list of (qualname, kind, lineIx), in file order."""
+        result = []
+
+        # (indent, qualname) of the definitions enclosing the current line
+        stack = []
+
+        for lineIx, entry in enumerate(self.entries):
+            if entry is None:
+                continue
+
+            indent, kind, name = entry
+
+            while stack and stack[-1][0] >= indent:
+                stack.pop()
+
+            qualname = stack[-1][1] + "." + name if stack else name
+            result.append((qualname, kind, lineIx))
+            stack.append((indent, qualname))
+
+        return result
+
+    def memoryUsage(self):
+        return sys.getsizeof(self.entries) + 120 * sum(1 for e in self.entries if e is not None)
+
+
+class SummaryTree:
+    """A sequence of values, one per line, with fast range replacement and aggregate searches.
+
+    This is a treap whose nodes each hold a chunk of up to 2 * CHUNK
+    consecutive values, and know the aggregate of their whole subtree. That
+    makes replacing a range of lines, computing the aggregate of a prefix,
+    and searching for the first (or last) line satisfying some condition on
+    the aggregate all take O(log n) node visits plus a scan of one chunk.
+
+    'combine(a, b)' must be associative with identity 'identity'. Values are
+    combined directly, so each value is its own aggregate - it may carry
+    extra trailing fields that 'combine' ignores. 'combineMany' is an
+    optional fast way to combine a whole list of values.
+    """
+    CHUNK = 64
+
+    class Node:
+        __slots__ = ("values", "chunkAgg", "agg", "size", "priority", "left", "right")
+
+    def __init__(self, values, combine, identity, combineMany=None):
+        self.combine = combine
+        self.identity = identity
+        self.combineMany = combineMany or (lambda values: functools.reduce(combine, values, identity))
+        self.root = self._build(list(values))
+
+    def __len__(self):
+        return self.root.size if self.root is not None else 0
+
+    def __getitem__(self, index):
+        node = self.root
+
+        while node is not None:
+            leftSize = node.left.size if node.left is not None else 0
+
+            if index < leftSize:
+                node = node.left
+            elif index < leftSize + len(node.values):
+                return node.values[index - leftSize]
+            else:
+                index -= leftSize + len(node.values)
+                node = node.right
+
+        raise IndexError(index)
+
+    def values(self):
+        result = []
+
+        def walk(node):
+            if node is not None:
+                walk(node.left)
+                result.extend(node.values)
+                walk(node.right)
+
+        walk(self.root)
+
+        return result
+
+    def nodeCount(self):
+        def count(node):
+            return 0 if node is None else 1 + count(node.left) + count(node.right)
+
+        return count(self.root)
+
+    def _makeNode(self, values, priority):
+        node = SummaryTree.Node()
+        node.values = values
+        node.chunkAgg = self.combineMany(values)
+        node.priority = priority
+        node.left = node.right = None
+        self._update(node)
+        return node
+
+    def _update(self, node):
+        size = len(node.values)
+        agg = node.chunkAgg
+
+        if node.left is not None:
+            size += node.left.size
+            agg = self.combine(node.left.agg, agg)
+
+        if node.right is not None:
+            size += node.right.size
+            agg = self.combine(agg, node.right.agg)
+
+        node.size = size
+        node.agg = agg
+
+    def _build(self, values):
+        """Build a balanced subtree out of 'values', with priorities in heap order."""
+        if not values:
+            return None
+
+        # split as evenly as we can, so we don't leave slivers behind
+        chunkCount = (len(values) + self.CHUNK - 1) // self.CHUNK
+        chunks = [
+            values[len(values) * i // chunkCount:len(values) * (i + 1) // chunkCount] for i in range(chunkCount)
+        ]
+
+        # hand out random priorities, largest first, in breadth-first order
+        # of the balanced tree, so the heap property holds
+        priorities = sorted((random.random() for _ in chunks), reverse=True)
+        nodes = [None] * len(chunks)
+
+        pending = [(0, len(chunks))]
+        nextPriority = 0
+
+        while nextPriority < len(chunks):
+            newPending = []
+            for lo, hi in pending:
+                if lo < hi:
+                    mid = (lo + hi) // 2
+                    nodes[mid] = self._makeNode(chunks[mid], priorities[nextPriority])
+                    nextPriority += 1
+                    newPending.append((lo, mid))
+                    newPending.append((mid + 1, hi))
+            pending = newPending
+
+        def link(lo, hi):
+            if lo >= hi:
+                return None
+            mid = (lo + hi) // 2
+            node = nodes[mid]
+            node.left = link(lo, mid)
+            node.right = link(mid + 1, hi)
+            self._update(node)
+            return node
+
+        return link(0, len(chunks))
+
+    def _split(self, node, count):
+        """Split into (first 'count' values, the rest)."""
+        if node is None:
+            return None, None
+
+        leftSize = node.left.size if node.left is not None else 0
+
+        if count <= leftSize:
+            a, b = self._split(node.left, count)
+            node.left = b
+            self._update(node)
+            return a, node
+
+        count -= leftSize
+
+        if count >= len(node.values):
+            a, b = self._split(node.right, count - len(node.values))
+            node.right = a
+            self._update(node)
+            return node, b
+
+        # the split point is inside this node's chunk. The new node sits above
+        # node.right, so its priority has to be between that and ours.
+        lowest = node.right.priority if node.right is not None else 0.0
+        rightNode = self._makeNode(node.values[count:], random.uniform(lowest, node.priority))
+        rightNode.right = node.right
+        self._update(rightNode)
+
+        node.values = node.values[:count]
+        node.chunkAgg = self.combineMany(node.values)
+        node.right = None
+        self._update(node)
+
+        return node, rightNode
+
+    def _merge(self, a, b):
+        if a is None:
+            return b
+        if b is None:
+            return a
+
+        if a.priority > b.priority:
+            a.right = self._merge(a.right, b)
+            self._update(a)
+            return a
+        else:
+            b.left = self._merge(a, b.left)
+            self._update(b)
+            return b
+
+    def _popFirst(self, node):
+        """Remove the first chunk. Returns (its values, the rest of the tree)."""
+        if node.left is None:
+            return node.values, node.right
+
+        values, node.left = self._popFirst(node.left)
+        self._update(node)
+        return values, node
+
+    def _popLast(self, node):
+        if node.right is None:
+            return node.values, node.left
+
+        values, node.right = self._popLast(node.right)
+        self._update(node)
+        return values, node
+
+    def _replaceWithinChunk(self, node, i0, i1, newValues):
+        if node is None:
+            return False
+
+        leftSize = node.left.size if node.left is not None else 0
+        chunkEnd = leftSize + len(node.values)
+
+        if i0 >= leftSize and i1 <= chunkEnd:
+            values = node.values[:i0 - leftSize] + newValues + node.values[i1 - leftSize:]
+
+            if not values or len(values) > 2 * self.CHUNK:
+                return False
+
+            node.values = values
+            node.chunkAgg = self.combineMany(values)
+        elif i1 <= leftSize:
+            if not self._replaceWithinChunk(node.left, i0, i1, newValues):
+                return False
+        elif i0 >= chunkEnd:
+            if not self._replaceWithinChunk(node.right, i0 - chunkEnd, i1 - chunkEnd, newValues):
+                return False
+        else:
+            return False
+
+        self._update(node)
+        return True
+
+    def replace(self, i0, i1, newValues):
+        """Replace values [i0, i1) with 'newValues'."""
+        newValues = list(newValues)
+
+        if self._replaceWithinChunk(self.root, i0, i1, newValues):
+            return
+
+        left, rest = self._split(self.root, i0)
+        _, right = self._split(rest, i1 - i0)
+
+        # rebuild the chunks on either side of the edit along with the new
+        # values, so repeated edits don't fragment the tree into tiny chunks
+        before = after = []
+        if left is not None:
+            before, left = self._popLast(left)
+        if right is not None:
+            after, right = self._popFirst(right)
+
+        self.root = self._merge(self._merge(left, self._build(before + newValues + after)), right)
+
+    def prefix(self, index):
+        """The aggregate of values [0, index)."""
+        acc = self.identity
+        node = self.root
+
+        while node is not None and index > 0:
+            leftSize = node.left.size if node.left is not None else 0
+
+            if index <= leftSize:
+                node = node.left
+                continue
+
+            if node.left is not None:
+                acc = self.combine(acc, node.left.agg)
+            index -= leftSize
+
+            if index <= len(node.values):
+                return self.combine(acc, self.combineMany(node.values[:index]))
+
+            acc = self.combine(acc, node.chunkAgg)
+            index -= len(node.values)
+            node = node.right
+
+        return acc
+
+    def findFirst(self, fromIndex, test):
+        """Find the first index >= fromIndex whose value satisfies 'test'.
+
+        'test(prefix, agg)' is called with the aggregate of everything before
+        a range and the aggregate of the range, and must return True if some
+        value in the range could satisfy the search. For a single value it
+        must be exact.
+
+        Returns (index, prefix) or None.
+        """
+        return self._findFirst(self.root, 0, self.identity, fromIndex, test)
+
+    def _findFirst(self, node, base, prefix, fromIndex, test):
+        if node is None or base + node.size <= fromIndex:
+            return None
+
+        if base >= fromIndex and not test(prefix, node.agg):
+            return None
+
+        result = self._findFirst(node.left, base, prefix, fromIndex, test)
+        if result is not None:
+            return result
+
+        leftSize = node.left.size if node.left is not None else 0
+        chunkStart = base + leftSize
+        acc = self.combine(prefix, node.left.agg) if node.left is not None else prefix
+
+        start = max(0, fromIndex - chunkStart)
+        if start < len(node.values) and (start > 0 or test(acc, node.chunkAgg)):
+            if start:
+                acc = self.combine(acc, self.combineMany(node.values[:start]))
+
+            for i in range(start, len(node.values)):
+                if test(acc, node.values[i]):
+                    return chunkStart + i, acc
+                acc = self.combine(acc, node.values[i])
+        else:
+            acc = self.combine(acc, node.chunkAgg)
+
+        return self._findFirst(node.right, chunkStart + len(node.values), acc, fromIndex, test)
+
+    def findLast(self, beforeIndex, test):
+        """Like findFirst, but finds the last index < beforeIndex."""
+        return self._findLast(self.root, 0, self.identity, beforeIndex, test)
+
+    def _findLast(self, node, base, prefix, beforeIndex, test):
+        if node is None or base >= beforeIndex:
+            return None
+
+        if base + node.size <= beforeIndex and not test(prefix, node.agg):
+            return None
+
+        leftSize = node.left.size if node.left is not None else 0
+        chunkStart = base + leftSize
+        chunkPrefix = self.combine(prefix, node.left.agg) if node.left is not None else prefix
+
+        result = self._findLast(
+            node.right, chunkStart + len(node.values), self.combine(chunkPrefix, node.chunkAgg), beforeIndex, test
+        )
+        if result is not None:
+            return result
+
+        end = min(len(node.values), beforeIndex - chunkStart)
+        if end > 0 and (end < len(node.values) or test(chunkPrefix, node.chunkAgg)):
+            prefixes = []
+            acc = chunkPrefix
+            for i in range(end):
+                prefixes.append(acc)
+                acc = self.combine(acc, node.values[i])
+
+            for i in range(end - 1, -1, -1):
+                if test(prefixes[i], node.values[i]):
+                    return chunkStart + i, prefixes[i]
+
+        return self._findLast(node.left, base, prefix, beforeIndex, test)
+
+
+INFINITY = float("inf")
+
+
+class StructureIndex:
+    """Bracket nesting and indentation for every line of a buffer.
+
+    Each line is summarized by a tuple (delta, minAfter, minBefore, indent,
+    brackets): the net change in bracket depth across the line, the lowest
+    depth reached just after / just before any bracket on it (relative to
+    the start of the line), its indentation (infinite for blank lines) and
+    the (col, char) of its brackets. These live in a SummaryTree, so after
+    an edit we only resummarize the edited lines, and finding a matching
+    bracket or the block around a line is logarithmic in the file size.
+
+    In python buffers, brackets inside strings and comments are ignored, as
+    long as the string starts and ends on the same line.
+    """
+    BRACKETS = re.compile(r"[()\[\]{}]")
+    OPENERS = {"(": ")", "[": "]", "{": "}"}
+    CLOSERS = {")": "(", "]": "[", "}": "{"}
+    IDENTITY = (0, INFINITY, INFINITY, INFINITY)
+
+    def __init__(self, lines, maskStrings=False):
+        self.maskStrings = maskStrings
+        self.bracketFreeValues = {}
+        self.tree = SummaryTree(
+            [self.valueFor(line) for line in lines], self.combine, self.IDENTITY
+        )
+
+    @staticmethod
+    def combine(a, b):
+        return (
+            a[0] + b[0],
+            min(a[1], a[0] + b[1]),
+            min(a[2], a[0] + b[2]),
+            min(a[3], b[3])
+        )
+
+    def valueFor(self, line):
+        stripped = line.lstrip(" \t")
+        indent = len(line) - len(stripped) if stripped else INFINITY
+
+        if not self.BRACKETS.search(line):
+            # most lines have no brackets, so share their summaries
+            if indent not in self.bracketFreeValues:
+                self.bracketFreeValues[indent] = (0, INFINITY, INFINITY, indent, ())
+            return self.bracketFreeValues[indent]
+
+        masked = []
+        if self.maskStrings:
+            masked = [
+                (start, start + length) for start, length, kind in PythonHighlighter.lexLine(line, None)[0]
+                if kind in ("string", "comment")
+            ]
+
+        brackets = []
+        depth = 0
+        minAfter = INFINITY
+        minBefore = INFINITY
+
+        for match in self.BRACKETS.finditer(line):
+            col = match.start()
+
+            if any(start <= col < end for start, end in masked):
+                continue
+
+            char = match.group()
+            minBefore = min(minBefore, depth)
+            depth += 1 if char in self.OPENERS else -1
+            minAfter = min(minAfter, depth)
+            brackets.append((col, char))
+
+        return (depth, minAfter, minBefore, indent, tuple(brackets))
+
+    def linesReplaced(self, line0, oldCount, newLines):
+        self.tree.replace(line0, line0 + oldCount, [self.valueFor(line) for line in newLines])
+
+    def indentOf(self, lineIx):
+        return self.tree[lineIx][3]
+
+    def bracketsOf(self, lineIx):
+        return self.tree[lineIx][4]
+
+    def matchingBracket(self, lineIx, col):
+        """If there's a bracket at (lineIx, col), return the (line, col) of its partner, or None."""
+        if not 0 <= lineIx < len(self.tree):
+            return None
+
+        brackets = self.tree[lineIx][4]
+        which = [i for i, (c, _) in enumerate(brackets) if c == col]
+
+        if not which:
+            return None
+
+        k = which[0]
+        char = brackets[k][1]
+
+        depthBefore = self.tree.prefix(lineIx)[0]
+        for _, c in brackets[:k]:
+            depthBefore += 1 if c in self.OPENERS else -1
+
+        if char in self.OPENERS:
+            # the partner is the first bracket after this one that takes us back to depthBefore
+            depth = depthBefore + 1
+            for c, ch in brackets[k + 1:]:
+                depth += 1 if ch in self.OPENERS else -1
+                if depth <= depthBefore:
+                    return (lineIx, c) if ch == self.OPENERS[char] else None
+
+            found = self.tree.findFirst(lineIx + 1, lambda prefix, agg: prefix[0] + agg[1] <= depthBefore)
+            if found is None:
+                return None
+
+            foundLine, prefix = found
+            depth = prefix[0]
+            for c, ch in self.tree[foundLine][4]:
+                depth += 1 if ch in self.OPENERS else -1
+                if depth <= depthBefore:
+                    return (foundLine, c) if ch == self.OPENERS[char] else None
+        else:
+            # the partner is the last bracket before this one that started at depthBefore - 1
+            target = depthBefore - 1
+            depth = depthBefore
+            for c, ch in reversed(brackets[:k]):
+                depth -= 1 if ch in self.OPENERS else -1
+                if depth <= target:
+                    return (lineIx, c) if ch == self.CLOSERS[char] else None
+
+            found = self.tree.findLast(lineIx, lambda prefix, agg: prefix[0] + agg[2] <= target)
+            if found is None:
+                return None
+
+            foundLine, prefix = found
+            depth = prefix[0]
+            depthsBefore = []
+            for c, ch in self.tree[foundLine][4]:
+                depthsBefore.append((depth, c, ch))
+                depth += 1 if ch in self.OPENERS else -1
+
+            for depth, c, ch in reversed(depthsBefore):
+                if depth <= target:
+                    return (foundLine, c) if ch == self.CLOSERS[char] else None
+
+        return None
+
+    def enclosingBlock(self, lineIx):
+        """Return (headerLine, lastLine) of the indented block containing 'lineIx', or None at top level."""
+        if not 0 <= lineIx < len(self.tree):
+            return None
+
+        indent = self.indentOf(lineIx)
+
+        if indent == INFINITY:
+            # a blank line belongs with whatever comes next
+            found = self.tree.findFirst(lineIx, lambda prefix, agg: agg[3] < INFINITY)
+            if found is None:
+                return None
+            indent = self.indentOf(found[0])
+
+        header = self.tree.findLast(lineIx, lambda prefix, agg: agg[3] < indent)
+        if header is None:
+            return None
+
+        headerLine = header[0]
+        headerIndent = self.indentOf(headerLine)
+
+        blockEnd = self.tree.findFirst(lineIx + 1, lambda prefix, agg: agg[3] <= headerIndent)
+        blockEnd = blockEnd[0] if blockEnd is not None else len(self.tree)
+
+        # don't include trailing blank lines
+        lastLine = self.tree.findLast(blockEnd, lambda prefix, agg: agg[3] < INFINITY)[0]
+
+        return headerLine, max(lastLine, headerLine)
+
+    def memoryUsage(self):
+        return self.tree.nodeCount() * 200 + len(self.tree) * 8
+
+
+class FoldMap:
+    """Which lines of a buffer are hidden inside folds.
+
+    Every line has a value of 1 if it's visible and 0 if it's hidden, kept
+    in a SummaryTree. A fold is a visible header line followed by a run of
+    hidden lines. The screen row of a line is the number of visible lines
+    above it, so mapping between rows and lines in either direction is
+    logarithmic no matter how many folds there are.
+    """
+    def __init__(self, lineCount):
+        self.tree = SummaryTree([1] * lineCount, lambda a, b: a + b, 0, sum)
+
+    def __len__(self):
+        return len(self.tree)
+
+    def rowCount(self):
+        return self.tree.prefix(len(self.tree))
+
+    def isHidden(self, lineIx):
+        return 0 <= lineIx < len(self.tree) and self.tree[lineIx] == 0
+
+    def isFolded(self, lineIx):
+        return not self.isHidden(lineIx) and self.isHidden(lineIx + 1)
+
+    def rowOf(self, lineIx):
+        """The screen row of 'lineIx', counting from the top of the buffer."""
+        return self.tree.prefix(min(lineIx, len(self.tree))) + max(0, lineIx - len(self.tree))
+
+    def lineAtRow(self, row):
+        """The line displayed at 'row'. Rows past the end map to lines past the end."""
+        rowCount = self.rowCount()
+
+        if row >= rowCount:
+            return len(self.tree) + row - rowCount
+
+        return self.tree.findFirst(0, lambda prefix, agg: prefix + agg > row)[0]
+
+    def moveLine(self, lineIx, dLine):
+        """Move 'dLine' visible lines from 'lineIx'. May return a line off either end."""
+        row = self.rowOf(lineIx) + dLine
+
+        if row < 0:
+            return row
 
-    def ensureValid(self, lines):
-        l0, c0, l1, c1 = self.line0, self.col0, self.line1, self.col1
+        return self.lineAtRow(row)
 
-        if l0 >= len(lines):
-            l0 = max(0, len(lines) - 1)
+    def nextVisible(self, lineIx, direction):
+        """The nearest visible line to 'lineIx' in 'direction', or 'lineIx' if it's visible."""
+        if not self.isHidden(lineIx):
+            return lineIx
 
-        if l1 >= len(lines):
-            l1 = max(0, len(lines) - 1)
+        if direction > 0:
+            found = self.tree.findFirst(lineIx, lambda prefix, agg: agg > 0)
+            return found[0] if found is not None else len(self.tree)
 
-        return Selection(l0, c0, l1, c1)
+        return self.tree.findLast(lineIx, lambda prefix, agg: agg > 0)[0]
 
+    def fold(self, header, last):
+        """Hide the lines after 'header', up to and including 'last'."""
+        if last > header:
+            self.tree.replace(header + 1, last + 1, [0] * (last - header))
 
-class UndoBuffer:
-    def __init__(self):
-        self.history = []
-        self.currentHistoryPos = None
-        self.topHistoryPosIsInsert = False
+    def unfold(self, header):
+        """Show the lines hidden below 'header', including any folds nested inside."""
+        end = self.tree.findFirst(header + 1, lambda prefix, agg: agg > 0)
+        end = end[0] if end is not None else len(self.tree)
 
-    def pushState(self, state, changeIsNav=False):
-        if not self.history:
-            self.history.append(state)
-            self.currentHistoryPos = 0
-            self.topHistoryPosIsInsert = False
+        if end > header + 1:
+            self.tree.replace(header + 1, end, [1] * (end - header - 1))
+
+    def unfoldAround(self, lineIx):
+        """Make sure 'lineIx' is visible."""
+        if self.isHidden(lineIx):
+            self.unfold(self.nextVisible(lineIx, -1))
+
+    def linesReplaced(self, line0, oldCount, newCount):
+        # text replacing lines that were all hidden stays hidden, so the fold
+        # stays in one piece until somebody unfolds it
+        allHidden = oldCount > 0 and self.tree.prefix(line0 + oldCount) == self.tree.prefix(line0)
+
+        self.tree.replace(line0, line0 + oldCount, [0 if allHidden else 1] * newCount)
+
+    def memoryUsage(self):
+        return self.tree.nodeCount() * 200 + len(self.tree) * 8
+
+
+class LineDiff:
+    """How a buffer's lines differ from a fixed 'base' version of them, kept up to date as it's edited.
+
+    'hunks' is a sorted list of [line0, line1, base0, base1]: lines [line0,
+    line1) of the buffer replace lines [base0, base1) of the base, and
+    everything between hunks is unchanged. An edit only re-diffs the part
+    of the buffer between the unchanged lines on either side of it, so
+    typing costs about the size of the hunk being typed in.
+    """
+    def __init__(self, base, lines):
+        self.rebase(base, lines)
+
+    def rebase(self, base, lines):
+        """Start over, comparing 'lines' against a new 'base'."""
+        self.base = base
+        self.hunks = [list(h) for h in diffLines(lines, base)]
+
+    def toBase(self, line, hunkIx):
+        """The line of the base that unchanged 'line' matches, where hunks[:hunkIx] are the ones before it."""
+        if hunkIx == 0:
+            return line
+
+        previous = self.hunks[hunkIx - 1]
+        return line - previous[1] + previous[3]
+
+    def linesReplaced(self, lines, line0, oldCount, newCount):
+        """Lines [line0, line0 + oldCount) of the buffer were replaced by 'newCount' lines, which are now in 'lines'."""
+        hunks = self.hunks
+        oldEnd = line0 + oldCount
+        delta = newCount - oldCount
+
+        # the hunks that overlap or touch [line0, oldEnd] are hunks[i0:i1]
+        i0 = bisect.bisect_right(hunks, [line0, INFINITY]) - 1
+        if i0 < 0 or hunks[i0][1] < line0:
+            i0 += 1
+        i1 = bisect.bisect_right(hunks, [oldEnd, INFINITY])
+
+        if i1 - i0 == 1 and hunks[i0][2] == hunks[i0][3] and hunks[i0][0] <= line0 and oldEnd <= hunks[i0][1]:
+            # an edit inside lines that were all added can't make any of them match the base
+            hunks[i0][1] += delta
+
+            # unless they've all been removed again, leaving nothing different
+            newHunks = [hunks[i0]] if hunks[i0][0] < hunks[i0][1] else []
         else:
-            if self.currentHistoryPos < len(self.history) - 1:
-                self.history = self.history[:self.currentHistoryPos + 1]
+            if i0 < i1 and hunks[i0][0] <= line0:
+                start, baseStart = hunks[i0][0], hunks[i0][2]
+            else:
+                start, baseStart = line0, self.toBase(line0, i0)
 
-            if changeIsNav:
-                # we navigated - just set the flag
-                self.topHistoryPosIsInsert = False
-                return
+            if i0 < i1 and hunks[i1 - 1][1] >= oldEnd:
+                end, baseEnd = hunks[i1 - 1][1], hunks[i1 - 1][3]
+            else:
+                end, baseEnd = oldEnd, self.toBase(oldEnd, i1)
 
-            if self.topHistoryPosIsInsert:
-                # replace the top history with this
-                self.history[self.currentHistoryPos] = state
+            newHunks = [
+                [h[0] + start, h[1] + start, h[2] + baseStart, h[3] + baseStart]
+                for h in diffLines(lines[start:end + delta], self.base[baseStart:baseEnd])
+            ]
+
+        for h in hunks[i1:]:
+            h[0] += delta
+            h[1] += delta
+
+        hunks[i0:i1] = newHunks
+
+    def markerAt(self, line):
+        """'added', 'modified' or 'deleted' (meaning lines below it were removed) if 'line' differs from the base."""
+        hunkIx = bisect.bisect_right(self.hunks, [line, INFINITY]) - 1
+
+        if hunkIx >= 0 and self.hunks[hunkIx][1] > line:
+            return "added" if self.hunks[hunkIx][2] == self.hunks[hunkIx][3] else "modified"
+
+        # a pure deletion shows on the line above the gap, or the first line if it's at the top
+        for h in self.hunks[max(hunkIx, 0):hunkIx + 2]:
+            if h[0] == h[1] and (h[0] == line + 1 or h[0] == line == 0):
+                return "deleted"
+
+        return None
+
+    def memoryUsage(self):
+        return sys.getsizeof(self.hunks) + len(self.hunks) * 120
+
+
+class Buffer:
+    """Text being edited, shared by every view (TextBufferDisplay) of it.
+
+    All edits go through 'replaceLines' or 'setLines'. Each one bumps
+    'version' and is reported to every listener as (line0, oldLines,
+    newLines, source): the lines that were replaced starting at 'line0',
+    what replaced them, and the view that made the edit, or None if the
+    change didn't come from a view (loading, reverting, recovering...).
+
+    The undo history and caches derived from the text (highlighting, the
+    outline, the bracket and indentation structure) live here too, so
+    views of the same text share them.
+    """
+    def __init__(self, lineStore, isPython=False):
+        self.lineStore = lineStore
+        self.isPython = isPython
+
+        self.lines = []
+        self.version = 0
+        self.listeners = []
+
+        self._undoBuffer = None
+
+        # a PythonHighlighter, if we're highlighting
+        self.highlighter = PythonHighlighter(0) if isPython else None
+
+        # an Outline, once somebody has asked for one
+        self.outline = None
+
+        # a StructureIndex, once somebody has asked for one
+        self.structure = None
+
+        # how many batches of edits we're in the middle of
+        self.batchDepth = 0
+
+    @property
+    def undoBuffer(self):
+        if self._undoBuffer is None:
+            self._undoBuffer = UndoBuffer()
+
+        return self._undoBuffer
+
+    def dropUndoHistory(self):
+        self._undoBuffer = None
+
+    def beginBatch(self):
+        """Start a run of many small edits. Anything that's cheaper to redo once at the end waits for 'endBatch'."""
+        self.batchDepth += 1
+
+    def endBatch(self):
+        self.batchDepth -= 1
+
+    def addListener(self, listener):
+        self.listeners.append(listener)
+
+    def removeListener(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def getOutline(self):
+        if self.outline is None:
+            self.outline = Outline(self.lines)
+        return self.outline
+
+    def getStructure(self):
+        if self.structure is None:
+            self.structure = StructureIndex(self.lines, maskStrings=self.isPython)
+        return self.structure
+
+    def replaceLines(self, line0, line1, newLines, source=None):
+        """Replace lines [line0, line1) with 'newLines'."""
+        newLines = self.lineStore.internLines(newLines)
+        oldLines = self.lines[line0:line1]
+
+        self.lines[line0:line1] = newLines
+
+        self.linesReplaced(line0, oldLines, newLines, source)
+
+    def setLines(self, newLines, source=None):
+        """Replace the entire text with 'newLines'.
+
+        Only the lines that actually differ get interned and reported, so
+        restoring an undo snapshot costs about as much as the edit it's
+        undoing.
+        """
+        oldLines = self.lines
+
+        prefix = commonPrefixLength(oldLines, newLines)
+        suffix = commonSuffixLength(oldLines, newLines, min(len(oldLines), len(newLines)) - prefix)
+
+        if prefix + suffix == len(oldLines) == len(newLines):
+            return
+
+        self.replaceLines(prefix, len(oldLines) - suffix, newLines[prefix:len(newLines) - suffix], source)
+
+    def linesReplaced(self, line0, oldLines, newLines, source):
+        self.version += 1
+
+        if self.highlighter is not None:
+            self.highlighter.linesReplaced(self.lines, line0, len(oldLines), len(newLines))
+
+        if self.outline is not None:
+            self.outline.linesReplaced(line0, len(oldLines), newLines)
+
+        if self.structure is not None:
+            self.structure.linesReplaced(line0, len(oldLines), newLines)
+
+        for listener in list(self.listeners):
+            listener(line0, oldLines, newLines, source)
+
+    def cacheMemoryUsage(self):
+        """Bytes held by any caches derived from the text."""
+        total = 0
+
+        if self.highlighter is not None:
+            total += self.highlighter.memoryUsage()
+
+        if self.outline is not None:
+            total += self.outline.memoryUsage()
+
+        if self.structure is not None:
+            total += self.structure.memoryUsage()
+
+        return total
+
+
+class FileBuffer(Buffer):
+    """The text of a file, along with what's on disk and whether we're holding it in memory at all."""
+    def __init__(self, context, fileName):
+        super().__init__(context.lineStore, isPython=fileName.endswith(".py"))
+
+        self.context = context
+        self.fileName = fileName
+        self.path = context.fileSet.namesToPaths[fileName]
+        self.lastActivated = 0
+        self.lastActiveTime = context.clock()
+
+        self.isLoaded = False
+        self.linesOnDisk = []
+
+        # while we're unloaded, the word counts of the text we had, which
+        # completion goes on counting so that unloading doesn't forget them
+        self.unloadedWords = None
+        context.completions.bufferPaths.add(self.path)
+
+        # a LineDiff of the text against 'linesOnDisk', while we're loaded
+        self.diskDiff = None
+
+        # a LineDiff against the version committed at HEAD, and the blob that came from
+        self.headDiff = None
+        self.headBlobId = None
+
+        # (version, linesOnDisk) -> isChanged, since we ask on every redraw
+        self.changedCache = (None, None, False)
+
+        self.addListener(self.recordChange)
+
+    def recordChange(self, line0, oldLines, newLines, source):
+        # loading and unloading account for their words themselves
+        if self.isLoaded:
+            self.context.completions.linesReplaced(oldLines, newLines)
+
+        if not self.batchDepth:
+            for diff in (self.diskDiff, self.headDiff):
+                if diff is not None:
+                    diff.linesReplaced(self.lines, line0, len(oldLines), len(newLines))
+
+        if self.isLoaded and self.context.swapFiles is not None:
+            self.context.swapFiles.recordChange(
+                self.path, self.linesOnDisk, line0, len(oldLines), newLines, self.lines
+            )
+
+    def load(self):
+        """Read the file from disk if we're not holding it in memory. Returns True if we read it."""
+        if self.isLoaded:
+            return False
+
+        self.setLines(self.context.fileSet.readlines(self.path))
+        self.isLoaded = True
+        self.setLinesOnDisk(list(self.lines))
+        self.refreshHead()
+
+        completions = self.context.completions
+
+        if self.unloadedWords is not None:
+            completions.countsReplaced(self.unloadedWords, completions.wordCounts(self.lines))
+            self.unloadedWords = None
+        elif self.path in completions.projectPaths:
+            # the project pass counted this same text from disk, so it's ours now
+            completions.projectPaths.discard(self.path)
+        else:
+            completions.linesReplaced([], self.lines)
+
+        return True
+
+    def setLinesOnDisk(self, lines):
+        self.linesOnDisk = lines
+        self.diskDiff = LineDiff(lines, self.lines)
+
+    def endBatch(self):
+        super().endBatch()
+
+        # an edit on every line would re-diff a growing hunk each time, so diff once instead
+        if not self.batchDepth:
+            for diff in (self.diskDiff, self.headDiff):
+                if diff is not None:
+                    diff.rebase(diff.base, self.lines)
+
+    def refreshHead(self):
+        """Diff against what's committed at HEAD, reading it again only if it's a different blob than last time."""
+        blobId = self.context.fileSet.headBlobId(self.path)
+
+        if blobId is None:
+            self.headDiff = None
+        elif blobId != self.headBlobId or self.headDiff is None:
+            headLines = self.context.fileSet.readBlobLines(blobId)
+            self.headDiff = LineDiff(headLines, self.lines) if headLines is not None else None
+
+        self.headBlobId = blobId
+
+    def unload(self):
+        """Drop the text and its history. Only legal if there are no unsaved changes."""
+        assert not self.isChanged()
+
+        self.unloadedWords = self.context.completions.wordCounts(self.lines)
+        self.isLoaded = False
+        self.discardSwap()
+
+        self.setLines([])
+        self.linesOnDisk = []
+        self.diskDiff = None
+        self.headDiff = None
+        self.headBlobId = None
+        self.dropUndoHistory()
+
+    def close(self):
+        completions = self.context.completions
+
+        if self.isLoaded:
+            completions.linesReplaced(self.lines, [])
+        elif self.unloadedWords is not None:
+            completions.countsReplaced(self.unloadedWords, {})
+
+        completions.bufferPaths.discard(self.path)
+
+        # the project pass can count it again from disk, which may not be what we had
+        if completions.indexesProject:
+            completions.pendingFiles.append(self.path)
+
+        self.listeners = []
+
+    def discardSwap(self):
+        if self.context.swapFiles is not None:
+            self.context.swapFiles.discard(self.path)
+
+    def isChanged(self):
+        version, linesOnDisk, changed = self.changedCache
+
+        if version != self.version or linesOnDisk is not self.linesOnDisk:
+            changed = self.lines != self.linesOnDisk
+            self.changedCache = (self.version, self.linesOnDisk, changed)
+
+        return changed
+
+    def save(self):
+        if self.isChanged():
+            self.context.fileSet.writelines(self.path, self.lines)
+            self.setLinesOnDisk(list(self.lines))
+            self.discardSwap()
+
+            self.context.fileHistory.record(self.fileName, FileHistory.SAVE_WEIGHT)
+
+            if self.context.symbolIndex is not None and self.isPython:
+                self.context.symbolIndex.updateFile(self.fileName, self.lines)
+
+    def checkDisk(self):
+        """Pick up changes made on disk if we don't have any of our own. Returns True if there were any."""
+        if self.isLoaded:
+            # someone may have committed since we last looked
+            self.refreshHead()
+
+        if self.isLoaded and not self.isChanged():
+            newLines = self.context.fileSet.readlines(self.path)
+
+            if newLines != self.lines:
+                self.setLines(newLines)
+                self.setLinesOnDisk(list(self.lines))
+                self.discardSwap()
+                return True
+
+        return False
+
+    def memoryUsage(self):
+        """Return a dict from category to bytes used by this buffer.
+
+        Strings shared between the text, the saved copy and the undo history
+        are charged to the first of those that holds them.
+        """
+        seen = set()
+
+        return {
+            "text": linesMemoryUsage(self.lines, seen),
+            "saved": linesMemoryUsage(self.linesOnDisk, seen),
+            "undo": self.undoBuffer.memoryUsage(seen),
+            "caches": self.cacheMemoryUsage()
+        }
+
+    def cacheMemoryUsage(self):
+        total = super().cacheMemoryUsage()
+
+        for diff in (self.diskDiff, self.headDiff):
+            if diff is not None:
+                total += diff.memoryUsage()
+
+        return total
+
+
+class TextBufferDisplay(Display):
+    """A view onto a Buffer: selections, scroll position and folds.
+
+    Several views can share a buffer. Each one listens for changes to it,
+    and shifts its selections to follow edits made through other views.
+    """
+    def __init__(self, context, buffer=None):
+        super().__init__(context)
+
+        self.buffer = buffer if buffer is not None else Buffer(context.lineStore)
+        self.buffer.addListener(self.linesReplaced)
+
+        self.topLine = 0
+        self.leftmostCol = 0
+
+        self.selections = [Selection(0, 0, 0, 0)]
+
+        # a BlockSelection, while we're selecting a rectangle. 'selections' then
+        # only holds the cursor at its head, until something needs the rest.
+        self.block = None
+
+        # while set, keys don't redraw, scroll or take undo snapshots
+        self.isPlayingMacro = False
+
+        # a PipeJob filtering our selections, and (version, selections) when it started
+        self.pipeJob = None
+        self.pipeStart = None
+
+        # a note shown next to our title until the next key
+        self.status = None
+
+        self.linecountWidth = 5
+
+        self.isReadOnly = False
+
+        # line -> columns of the bracket pair to highlight, set by 'redraw'
+        self.bracketHighlights = {}
+
+        # a FoldMap, while anything is folded
+        self.folds = None
+
+        # (x, y, width, height) of the part of the window we draw in, if we're
+        # in a split pane. None means the whole window.
+        self.rect = None
+
+        # False while we're being drawn in a pane that doesn't have the focus
+        self.isActive = True
+
+        # if set, long lines wrap onto several screen rows instead of scrolling sideways
+        self.wrapLines = False
+
+        # line -> wrapPoints() for it at 'wrapWidth' (None until we've drawn
+        # it), kept in step with the text as it changes
+        self.wrapCache = None
+        self.wrapWidth = None
+
+        # (line, row): when wrapping and 'line' is 'topLine', the screen starts
+        # at that row of it rather than its first one
+        self.topWrap = (0, 0)
+
+    @property
+    def lines(self):
+        return self.buffer.lines
+
+    @property
+    def undoBuffer(self):
+        return self.buffer.undoBuffer
+
+    @property
+    def highlighter(self):
+        return self.buffer.highlighter
+
+    @property
+    def outline(self):
+        return self.buffer.outline
+
+    @property
+    def structure(self):
+        return self.buffer.structure
+
+    def isPythonFile(self):
+        return self.buffer.isPython
+
+    def getOutline(self):
+        return self.buffer.getOutline()
+
+    def getStructure(self):
+        return self.buffer.getStructure()
+
+    def newView(self):
+        """Another view of our buffer, looking at the same place."""
+        view = TextBufferDisplay(self.context, self.buffer)
+        view.isReadOnly = self.isReadOnly
+        view.wrapLines = self.wrapLines
+        view.restoreViewport(self.saveViewport())
+        return view
+
+    def detach(self):
+        """Stop following the buffer. Called when the view is thrown away."""
+        self.buffer.removeListener(self.linesReplaced)
+
+    def getTitle(self):
+        return None
+
+    def changeMarkerAt(self, lineIx):
+        """The kind of change to flag 'lineIx' with in the gutter (a key of CHANGE_MARKERS), or None."""
+        return None
+
+    def save(self):
+        pass
+
+    def revert(self):
+        pass
+
+    def checkDisk(self):
+        pass
+
+    def cacheMemoryUsage(self):
+        """Bytes held by any caches derived from the text, including our folds."""
+        total = self.buffer.cacheMemoryUsage()
+
+        if self.folds is not None:
+            total += self.folds.memoryUsage()
+
+        if self.wrapCache is not None:
+            total += sys.getsizeof(self.wrapCache) + sum(
+                sys.getsizeof(points) for points in self.wrapCache if points is not None
+            )
+
+        return total
+
+    # ctrl-alt-arrows start a block selection, or move its head corner
+    BLOCK_MOVES = {
+        KEY_CTRL_ALT_UP: (-1, 0),
+        KEY_CTRL_ALT_DOWN: (1, 0),
+        KEY_CTRL_ALT_LEFT: (0, -1),
+        KEY_CTRL_ALT_RIGHT: (0, 1),
+    }
+
+    def receiveBlockChar(self, char):
+        """Start, grow or edit the block selection. Returns False if 'char' isn't one of ours.
+
+        Typing, backspace and delete on a block rewrite all of its lines as
+        one splice, and it's drawn straight from the rectangle, so neither
+        costs a Selection per line. Any other key gets the block as one
+        Selection per line for the ordinary code to work on, and all but
+        copying drop it.
+        """
+        if char in TextBufferDisplay.BLOCK_MOVES:
+            if self.block is None:
+                cursor = self.selections[-1] if self.selections else Selection(0, 0, 0, 0)
+                text = self.lines[cursor.line1] if cursor.line1 < len(self.lines) else ""
+                cell = cellOfCol(text, cursor.col1)
+                self.block = BlockSelection(cursor.line1, cell, cursor.line1, cell)
+
+            self.block = self.block.moved(self.lines, *TextBufferDisplay.BLOCK_MOVES[char])
+            self.selections = [self.block.selectionOn(self.lines, self.block.headLine)]
+            self.pushUndoState(True)
+
+        elif self.block is None:
+            return False
+
+        elif not self.isReadOnly and (char in ("KEY_BACKSPACE", "KEY_DC") or len(char) == 1 and char.isprintable()):
+            newLines, self.block = self.block.edited(self.lines, char)
+            self.replaceLines(self.block.top, self.block.bottom + 1, newLines)
+            self.selections = [self.block.selectionOn(self.lines, self.block.headLine)]
+            self.pushUndoState()
+
+        else:
+            self.selections = self.block.selections(self.lines)
+            if char != KEY_CTRL_C:
+                self.block = None
+            return False
+
+        self.ensureOnScreen(self.selections[-1])
+        self.redraw()
+        return True
+
+    def pushUndoState(self, changeIsNav=False):
+        """Snapshot the text and selections for undo. A macro takes one snapshot when it's done instead."""
+        if not self.isPlayingMacro:
+            self.undoBuffer.pushState((list(self.lines), list(self.selections)), changeIsNav)
+
+    def receiveMacroChar(self, char):
+        """Handle the keys that record and play macros. Returns False for any other key, recording it if we're recording."""
+        if char == KEY_F9:
+            if self.context.macroRecording is None:
+                self.context.macroRecording = []
             else:
-                self.history.append(state)
-                self.currentHistoryPos += 1
-                self.topHistoryPosIsInsert = True
+                self.context.macro = self.context.macroRecording
+                self.context.macroRecording = None
+            self.redraw()
+            return True
+
+        if char == KEY_F10:
+            self.playMacro(self.context.macro)
+            return True
+
+        if char == KEY_SHIFT_F10:
+            if self.context.macro:
+                self.context.pushDisplay(RepeatMacroDisplay(self.context, self))
+            return True
+
+        if self.context.macroRecording is not None and not self.isPlayingMacro:
+            self.context.macroRecording.append(char)
+
+        return False
+
+    # playback can't be interrupted, so a mistyped count stops here rather than hanging the editor
+    MAX_MACRO_PLAYS = 100000
+
+    def playMacro(self, keys, count=None):
+        """Play 'keys' 'count' times, or if that's None and a selection covers several lines, once at the start of each.
+
+        Nothing is drawn, and no undo snapshots taken, until the end: the
+        whole thing is one undo step. A count over MAX_MACRO_PLAYS plays
+        that many times.
+        """
+        if not keys or self.isReadOnly:
+            return
+
+        # finish any run of typing, so undo takes back just the macro
+        self.pushUndoState(True)
+
+        self.isPlayingMacro = True
+        self.buffer.beginBatch()
+
+        try:
+            selection = self.selections[-1]
+            if count is None and len(self.selections) == 1 and selection.line0 != selection.line1:
+                line = min(selection.line0, selection.line1)
+                lastLine = max(selection.line0, selection.line1)
+                if (selection.col1 if selection.isOrdered() else selection.col0) == 0:
+                    # a selection of whole lines ends at the start of the next one
+                    lastLine -= 1
+
+                # the macro can add or remove lines, so count from the bottom
+                linesAfter = len(self.lines) - lastLine - 1
+
+                while line < len(self.lines) - linesAfter:
+                    linesBelow = len(self.lines) - line - 1
+                    self.selections = [Selection(line, 0, line, 0)]
+                    self.playKeys(keys)
+                    line = len(self.lines) - linesBelow
+            else:
+                if count is None:
+                    count = 1
+
+                for _ in range(min(count, TextBufferDisplay.MAX_MACRO_PLAYS)):
+                    self.playKeys(keys)
+        finally:
+            self.buffer.endBatch()
+            self.isPlayingMacro = False
+
+        self.pushUndoState()
+        self.pushUndoState(True)
+
+        if count is not None and count > TextBufferDisplay.MAX_MACRO_PLAYS:
+            self.status = "stopped the macro after %d plays" % TextBufferDisplay.MAX_MACRO_PLAYS
+
+        self.ensureOnScreen(self.selections[-1])
+        self.redraw()
+
+    def playKeys(self, keys):
+        for key in keys:
+            self.receiveChar(key)
+
+            # what was typed into a popup (go to line, completions...) isn't
+            # part of the macro, so don't leave one open
+            while self in self.context.displays and self.context.displays[-1] is not self:
+                self.context.removeDisplay(self.context.displays[-1])
+
+    def startPipe(self, command):
+        """Filter the selected text, or all of it if nothing is selected, through a shell command in the background."""
+        if self.isReadOnly or self.pipeJob is not None or not command.strip():
+            return
+
+        selections = sorted(s.clipToReal(self.lines) for s in self.selections if not s.isSingle())
+        if not selections:
+            lastLine = max(len(self.lines) - 1, 0)
+            selections = [Selection(0, 0, lastLine, len(self.lines[lastLine]) if self.lines else 0)]
 
-    def undo(self):
-        if not self.history:
-            return None
+        self.pipeStart = (self.buffer.version, selections)
+        self.pipeJob = PipeJob(command, [s.selectedText(self.lines) for s in selections], self.workingDirectory())
+        self.context.pipeJobs.append((self, self.pipeJob))
 
-        self.currentHistoryPos = max(0, self.currentHistoryPos - 1)
+        self.redraw()
 
-        return self.history[self.currentHistoryPos]
+    def pipeFinished(self, job):
+        """Replace the text a PipeJob was given with what it produced, as one undo step."""
+        version, selections = self.pipeStart
+        self.pipeJob = None
+        self.pipeStart = None
 
-    def redo(self):
-        if not self.history:
-            return None
+        if job.error is not None:
+            self.status = "%s: %s" % (job.command, job.error)
+            return
 
-        self.currentHistoryPos = min(len(self.history) - 1, self.currentHistoryPos + 1)
+        if version != self.buffer.version:
+            self.status = "%s: the text changed while it ran, so its output was dropped" % job.command
+            return
 
-        return self.history[self.currentHistoryPos]
+        self.pushUndoState(True)
+        self.buffer.beginBatch()
 
+        try:
+            # bottom to top, so each replacement leaves the ones above it where they were
+            self.selections = []
+            for selection, output in reversed(list(zip(selections, job.outputs))):
+                self.replaceText(selection, output)
+        finally:
+            self.buffer.endBatch()
 
-class TextBufferDisplay(Display):
-    def __init__(self, context):
-        super().__init__(context)
+        self.selections = [Selection(selections[0].line0, selections[0].col0, selections[0].line0, selections[0].col0)]
+        self.pushUndoState()
+        self.pushUndoState(True)
 
-        self.topLine = 0
-        self.leftmostCol = 0
+        self.ensureOnScreen(self.selections[-1])
 
-        self.selections = [Selection(0, 0, 0, 0)]
+    def workingDirectory(self):
+        """Where to run commands from."""
+        return None
 
-        self.linecountWidth = 5
+    def selectedLineRange(self):
+        """The lines [line0, line1) the selections cover, or all of them if nothing is selected.
 
-        self.lines = []
+        A selection that ends at the start of a line doesn't include it.
+        """
+        selections = [s for s in self.selections if not s.isSingle()]
 
-        self.isReadOnly = False
+        if not selections:
+            return 0, len(self.lines)
 
-        self._undoBuffer = None
+        line0 = min(min(s.line0, s.line1) for s in selections)
+        line1 = 0
+        for s in selections:
+            lastLine, lastCol = (s.line1, s.col1) if s.isOrdered() else (s.line0, s.col0)
+            line1 = max(line1, lastLine + (1 if lastCol else 0))
 
-    def isPythonFile(self):
-        return False
+        return line0, min(max(line1, line0 + 1), len(self.lines))
 
-    @property
-    def undoBuffer(self):
-        if self._undoBuffer is None:
-            self._undoBuffer = UndoBuffer()
+    def transformLines(self, transform):
+        """Replace the selected lines with 'transform' of them, in a single edit and undo step."""
+        if self.isReadOnly or not self.lines:
+            return
 
-        return self._undoBuffer
+        line0, line1 = self.selectedLineRange()
+        newLines = transform(self.lines[line0:line1])
 
-    def getTitle(self):
-        return None
+        self.pushUndoState(True)
+        self.replaceLines(line0, line1, newLines)
 
-    def save(self):
-        pass
+        if newLines:
+            self.selections = [Selection(line0, 0, line0 + len(newLines) - 1, len(newLines[-1])).clipToReal(self.lines)]
+        else:
+            self.selections = [Selection(line0, 0, line0, 0).clipToReal(self.lines)]
 
-    def revert(self):
-        pass
+        self.pushUndoState()
+        self.pushUndoState(True)
 
-    def checkDisk(self):
-        pass
+        self.ensureOnScreen(self.selections[-1])
+        self.redraw()
 
     def receiveChar(self, char):
+        self.status = None
+
+        if char == KEY_F4:
+            if not self.isReadOnly:
+                self.context.newWindow(LineOperationSelector(self.context, self))
+            return
+
+        if char == KEY_CTRL_BACKSLASH:
+            if self.pipeJob is not None:
+                self.pipeJob.cancel()
+            elif not self.isReadOnly:
+                self.context.pushDisplay(PipeCommandDisplay(self.context, self))
+            return
+
+        if self.receiveMacroChar(char):
+            return
+
+        if self.receiveBlockChar(char):
+            return
+
         if char == KEY_CTRL_F:
             if not self.context.findBox.visible:
                 self.context.findBox.visible = True
@@ -872,11 +4943,42 @@ class TextBufferDisplay(Display):
                 self.redraw()
             return
 
+        if char == KEY_CTRL_RIGHT_BRACKET:
+            self.jumpToMatchingBracket()
+            self.redraw()
+            return
+
+        if char == KEY_CTRL_B:
+            self.expandSelectionToBlock()
+            self.redraw()
+            return
+
+        if char == KEY_CTRL_K:
+            self.toggleFold()
+            self.redraw()
+            return
+
+        if char == KEY_CTRL_SPACE:
+            if not self.isReadOnly:
+                self.complete()
+            return
+
+        if char == KEY_CTRL_U:
+            self.unfoldAll()
+            self.redraw()
+            return
+
+        if char == KEY_CTRL_L:
+            self.toggleWrap()
+            self.redraw()
+            return
+
         # make sure we have an undo buffer
         if char == KEY_CTRL_Z:
             newState = self.undoBuffer.undo()
             if newState is not None:
-                self.lines, self.selections = list(newState[0]), list(newState[1])
+                self.setLines(list(newState[0]))
+                self.selections = list(newState[1])
 
                 self.ensureOnScreen(self.selections[-1])
                 self.redraw()
@@ -885,7 +4987,8 @@ class TextBufferDisplay(Display):
         if char == KEY_CTRL_Y:
             newState = self.undoBuffer.redo()
             if newState is not None:
-                self.lines, self.selections = list(newState[0]), list(newState[1])
+                self.setLines(list(newState[0]))
+                self.selections = list(newState[1])
 
                 self.ensureOnScreen(self.selections[-1])
                 self.redraw()
@@ -900,7 +5003,7 @@ class TextBufferDisplay(Display):
                     self.context.clipboardIsWholeLine = True
 
                     if char == KEY_CTRL_X:
-                        self.deleteSelection(Selection(self.line0, 0, self.line1, 0))
+                        self.deleteSelection(Selection(sel.line0, 0, sel.line0 + 1, 0))
                 else:
                     self.context.clipboardIsWholeLine = False
                     self.context.clipboard = None
@@ -916,7 +5019,7 @@ class TextBufferDisplay(Display):
                         self.deleteSelection(self.selections[i])
 
             if char == KEY_CTRL_X:
-                self.undoBuffer.pushState((list(self.lines), list(self.selections)))
+                self.pushUndoState()
                 self.ensureOnScreen(self.selections[-1])
                 self.redraw()
 
@@ -932,7 +5035,7 @@ class TextBufferDisplay(Display):
                     for i in range(len(self.selections)):
                         self.replaceText(self.selections[i], self.context.clipboard[i % len(self.context.clipboard)])
 
-                self.undoBuffer.pushState((list(self.lines), list(self.selections)))
+                self.pushUndoState()
                 self.ensureOnScreen(self.selections[-1])
                 self.redraw()
             return
@@ -965,80 +5068,80 @@ class TextBufferDisplay(Display):
                 self.selections = self.selections[-1:]
 
             if char == "KEY_LEFT":
-                self.selections = [d.delta(self.lines, 0, -1) for d in self.selections]
+                self.selections = [d.delta(self.lines, 0, -1, folds=self.folds) for d in self.selections]
 
             if char == "KEY_RIGHT":
-                self.selections = [d.delta(self.lines, 0, 1) for d in self.selections]
+                self.selections = [d.delta(self.lines, 0, 1, folds=self.folds) for d in self.selections]
 
             if char == "KEY_UP":
-                self.selections = [d.delta(self.lines, -1, 0) for d in self.selections]
+                self.selections = [d.delta(self.lines, -1, 0, folds=self.folds) for d in self.selections]
 
             if char == "KEY_DOWN":
-                self.selections = [d.delta(self.lines, 1, 0) for d in self.selections]
+                self.selections = [d.delta(self.lines, 1, 0, folds=self.folds) for d in self.selections]
 
             if char == "KEY_PPAGE":
-                self.selections = [d.delta(self.lines, -self.context.windowY, 0) for d in self.selections]
+                self.selections = [d.delta(self.lines, -self.pageRows(), 0, folds=self.folds) for d in self.selections]
 
             if char == "KEY_NPAGE":
-                self.selections = [d.delta(self.lines, self.context.windowY, 0) for d in self.selections]
+                self.selections = [d.delta(self.lines, self.pageRows(), 0, folds=self.folds) for d in self.selections]
 
             if char == "KEY_SPREVIOUS":
-                self.selections = [d.delta(self.lines, -self.context.windowY, 0, extend=True) for d in self.selections]
+                self.selections = [d.delta(self.lines, -self.pageRows(), 0, extend=True, folds=self.folds) for d in self.selections]
 
             if char == "KEY_SNEXT":
-                self.selections = [d.delta(self.lines, self.context.windowY, 0, extend=True) for d in self.selections]
+                self.selections = [d.delta(self.lines, self.pageRows(), 0, extend=True, folds=self.folds) for d in self.selections]
 
             if char == KEY_SHIFT_UP:
-                self.selections = [d.delta(self.lines, -1, 0, extend=True) for d in self.selections]
+                self.selections = [d.delta(self.lines, -1, 0, extend=True, folds=self.folds) for d in self.selections]
 
             if char == KEY_SHIFT_RIGHT:
-                self.selections = [d.delta(self.lines, 0, 1, extend=True) for d in self.selections]
+                self.selections = [d.delta(self.lines, 0, 1, extend=True, folds=self.folds) for d in self.selections]
 
             if char == KEY_SHIFT_LEFT:
-                self.selections = [d.delta(self.lines, 0, -1, extend=True) for d in self.selections]
+                self.selections = [d.delta(self.lines, 0, -1, extend=True, folds=self.folds) for d in self.selections]
 
             if char == KEY_SHIFT_DOWN:
-                self.selections = [d.delta(self.lines, 1, 0, extend=True) for d in self.selections]
+                self.selections = [d.delta(self.lines, 1, 0, extend=True, folds=self.folds) for d in self.selections]
 
             if char == "KEY_HOME":
                 self.selections = [
-                    d.delta(self.lines, 0, -d.col1)
-                    if d.col1 else d.delta(self.lines, 0, 1, isHomeKey=True)
+                    d.delta(self.lines, 0, -d.col1, folds=self.folds)
+                    if d.col1 else d.delta(self.lines, 0, 1, isHomeKey=True, folds=self.folds)
                     for d in self.selections
                 ]
 
             if char == "KEY_SHOME":
                 self.selections = [
-                    d.delta(self.lines, 0, -d.col1, extend=True)
-                    if d.col1 else d.delta(self.lines, 0, 1, isHomeKey=True, extend=True)
+                    d.delta(self.lines, 0, -d.col1, extend=True, folds=self.folds)
+                    if d.col1 else d.delta(self.lines, 0, 1, isHomeKey=True, extend=True, folds=self.folds)
                     for d in self.selections
                 ]
 
             if char == "KEY_END":
-                self.selections = [d.delta(self.lines, 0, MAX_COL) for d in self.selections]
+                self.selections = [d.delta(self.lines, 0, MAX_COL, folds=self.folds) for d in self.selections]
 
             if char == "KEY_SEND":
-                self.selections = [d.delta(self.lines, 0, MAX_COL, extend=True) for d in self.selections]
+                self.selections = [d.delta(self.lines, 0, MAX_COL, extend=True, folds=self.folds) for d in self.selections]
 
             if char == KEY_CTRL_RIGHT:
-                self.selections = [d.delta(self.lines, 0, 1, word=True) for d in self.selections]
+                self.selections = [d.delta(self.lines, 0, 1, word=True, folds=self.folds) for d in self.selections]
 
             if char == KEY_CTRL_SHIFT_RIGHT:
-                self.selections = [d.delta(self.lines, 0, 1, word=True, extend=True) for d in self.selections]
+                self.selections = [d.delta(self.lines, 0, 1, word=True, extend=True, folds=self.folds) for d in self.selections]
 
             if char == KEY_CTRL_LEFT:
-                self.selections = [d.delta(self.lines, 0, -1, word=True) for d in self.selections]
+                self.selections = [d.delta(self.lines, 0, -1, word=True, folds=self.folds) for d in self.selections]
 
             if char == KEY_CTRL_SHIFT_LEFT:
-                self.selections = [d.delta(self.lines, 0, -1, word=True, extend=True) for d in self.selections]
+                self.selections = [d.delta(self.lines, 0, -1, word=True, extend=True, folds=self.folds) for d in self.selections]
 
             if char == KEY_SHIFT_ALT_UP:
                 # shift-alt-up
-                self.selections = self.selections + [d.delta(self.lines, -1, 0) for d in self.selections]
+                self.selections = self.selections + [d.delta(self.lines, -1, 0, folds=self.folds) for d in self.selections]
 
             if char == KEY_SHIFT_ALT_DOWN:
                 # shift-alt-down
-                self.selections = self.selections + [d.delta(self.lines, 1, 0) for d in self.selections]
+                self.selections = self.selections + [d.delta(self.lines, 1, 0, folds=self.folds) for d in self.selections]
 
             if char == KEY_CTRL_D:
                 newSelection = [d.selectWord(self.lines) for d in self.selections]
@@ -1055,152 +5158,458 @@ class TextBufferDisplay(Display):
 
             self.selections = Selection.mergeContiguous(self.selections)
 
-            self.undoBuffer.pushState((list(self.lines), list(self.selections)), True)
+            self.pushUndoState(True)
+
+            self.ensureOnScreen(self.selections[-1])
+            self.redraw()
+            return
+
+        if not self.isReadOnly:
+            if char == "KEY_BACKSPACE":
+                self.selections = [
+                    s.delta(self.lines, 0, -1, extend=True, isTabBackspace=self.isPythonFile())
+                    if s.isSingle() else s for s in self.selections
+                ]
+
+                for i in range(len(self.selections)):
+                    self.deleteSelection(self.selections[i])
+
+                self.selections = Selection.mergeContiguous(self.selections)
+
+                self.pushUndoState()
+
+                self.ensureOnScreen(self.selections[-1])
+                self.redraw()
+                return
+
+            if char == "KEY_DC":
+                self.selections = [s.delta(self.lines, 0, 1, extend=True) if s.isSingle() else s for s in self.selections]
+
+                for i in range(len(self.selections)):
+                    self.deleteSelection(self.selections[i])
+
+                self.selections = Selection.mergeContiguous(self.selections)
+
+                self.pushUndoState()
+
+                self.ensureOnScreen(self.selections[-1])
+                self.redraw()
+                return
+
+            if char == "\n":
+                for i in range(len(self.selections)):
+                    self.deleteSelection(self.selections[i])
+
+                for i in range(len(self.selections)):
+                    self.insertNewlineWithIndent(self.selections[i].line1, self.selections[i].col1)
+
+                self.selections = Selection.mergeContiguous(self.selections)
+
+                self.pushUndoState()
+
+                self.ensureOnScreen(self.selections[-1])
+                self.redraw()
+                return
+
+            if char == "KEY_BTAB":
+                if len(self.selections) == 1 and self.selections[0].line0 != self.selections[0].line1:
+                    for i in range(self.selections[0].line0, self.selections[0].line1 + (1 if self.selections[0].col1 else 0)):
+                        if self.lines[i][:4] == "    ":
+                            self.deleteSelection(Selection(i, 0, i, 4))
+
+                    self.ensureOnScreen(self.selections[0])
+                    self.redraw()
+                    return True
+
+            if char == "\t":
+                if len(self.selections) == 1 and self.selections[0].line0 != self.selections[0].line1:
+                    for i in range(self.selections[0].line0, self.selections[0].line1 + (1 if self.selections[0].col1 else 0)):
+                        self.insert(i, 0, "    ")
+
+                    self.ensureOnScreen(self.selections[0])
+                    self.redraw()
+                    return True
+                else:
+                    for i in range(len(self.selections)):
+                        self.deleteSelection(self.selections[i])
+
+                    for i in range(len(self.selections)):
+                        self.insertTabWithIndent(self.selections[i].line1, self.selections[i].col1)
+
+                    self.selections = Selection.mergeContiguous(self.selections)
+
+                    self.pushUndoState()
+
+                    self.ensureOnScreen(self.selections[-1])
+                    self.redraw()
+                    return
+
+            if len(char) == 1 and char.isprintable():
+                # we're typing
+                for i in range(len(self.selections)):
+                    self.replaceText(self.selections[i], char)
+
+                self.selections = Selection.mergeContiguous(self.selections)
+
+                self.pushUndoState()
+
+                self.ensureOnScreen(self.selections[-1])
+                self.redraw()
+                return
+
+        # display the character
+        self.text(self.context.windowX - len(repr(char)) - 2, 0, repr(char))
+
+    def replaceText(self, selection, newContents):
+        selection = selection.clipToReal(self.lines)
+
+        self.deleteSelection(selection)
+        selection = selection.rangeDeleted(selection)
+
+        self.insert(selection.line1, selection.col1, newContents)
+
+    def replaceLines(self, line0, line1, newLines):
+        """Replace lines [line0, line1) with 'newLines'.
+
+        All edits to the text go through here or through 'setLines'.
+        """
+        self.buffer.replaceLines(line0, line1, newLines, source=self)
+
+    def setLines(self, newLines):
+        self.buffer.setLines(newLines, source=self)
+
+    def linesReplaced(self, line0, oldLines, newLines, source):
+        """Called after the lines 'oldLines' starting at 'line0' of our buffer were replaced by 'newLines'."""
+        if self.folds is not None:
+            self.folds.linesReplaced(line0, len(oldLines), len(newLines))
+
+        if self.wrapCache is not None:
+            self.wrapCache[line0:line0 + len(oldLines)] = [None] * len(newLines)
+
+        if source is not self:
+            self.block = None
+
+        if source is self or not self.lines:
+            # we keep our own selections up to date as we edit, and an
+            # unloaded buffer keeps them for when it comes back
+            return
+
+        if source is None:
+            # the whole text may have changed, so just make sure we're still inside it
+            self.selections = [s.clipToReal(self.lines) for s in self.selections]
+            self.topLine = min(self.topLine, len(self.lines) - 1)
+            return
+
+        # another view edited the text: stay on the same lines of it
+        oldEnd = line0 + len(oldLines)
+        lastNewLine = line0 + max(len(newLines) - 1, 0)
+
+        def shifted(line):
+            if line < line0:
+                return line
+            if line >= oldEnd:
+                return line + len(newLines) - len(oldLines)
+            return min(line, lastNewLine)
+
+        self.selections = [
+            Selection(shifted(s.line0), s.col0, shifted(s.line1), s.col1).clipToReal(self.lines)
+            for s in self.selections
+        ]
+        self.topLine = min(shifted(self.topLine), len(self.lines) - 1)
+
+    def deleteSelection(self, selection):
+        if selection.isSingle():
+            return
+
+        selection = selection.clipToReal(self.lines)
+
+        self.replaceLines(
+            selection.line0,
+            selection.line1 + 1,
+            [self.lines[selection.line0][:selection.col0] + self.lines[selection.line1][selection.col1:]]
+        )
+
+        for i in range(len(self.selections)):
+            self.selections[i] = self.selections[i].rangeDeleted(selection)
+
+    def insertNewlineWithIndent(self, line, col):
+        indent = ""
+
+        # implement python newlines
+        if self.isPythonFile():
+            if 0 <= line < len(self.lines):
+                indent = self.lines[line][:len(self.lines[line]) - len(self.lines[line].lstrip())]
+                if len(indent) > col:
+                    indent = indent[:col]
+
+                if self.lines[line].endswith(":") and col >= len(self.lines[line]):
+                    indent += "    "
+                elif self.opensBracketAt(line, col):
+                    indent += "    "
+
+        self.insert(line, col, "\n")
+        if indent:
+            self.insert(line + 1, 0, indent)
+
+    def opensBracketAt(self, line, col):
+        """Is the last thing before 'col' on 'line' an opening bracket (outside any string)?"""
+        before = self.lines[line][:col].rstrip()
+
+        if not before or before[-1] not in StructureIndex.OPENERS:
+            return False
+
+        return (len(before) - 1, before[-1]) in self.getStructure().bracketsOf(line)
+
+    def matchingBracketNearCursor(self):
+        """Return ((line, col), (line, col)) for the bracket at or just before the cursor and its partner."""
+        sel = self.selections[-1]
+
+        if not sel.isSingle() or not 0 <= sel.line1 < len(self.lines):
+            return None
+
+        sel = sel.clipToReal(self.lines)
+
+        line = self.lines[sel.line1]
+
+        for col in (sel.col1, sel.col1 - 1):
+            if 0 <= col < len(line) and line[col] in "()[]{}":
+                partner = self.getStructure().matchingBracket(sel.line1, col)
+                if partner is not None:
+                    return (sel.line1, col), partner
+
+        return None
+
+    def jumpToMatchingBracket(self):
+        match = self.matchingBracketNearCursor()
+
+        if match is None:
+            return
+
+        (line, col), (partnerLine, partnerCol) = match
+
+        # land on the same side of the bracket we started on
+        if col < self.selections[-1].clipToReal(self.lines).col1:
+            partnerCol += 1
+
+        self.selections = [Selection(partnerLine, partnerCol, partnerLine, partnerCol)]
+        self.ensureOnScreen(self.selections[-1])
+
+    def expandSelectionToBlock(self):
+        """Select the indented block around the cursor, including its header.
+
+        If that's already selected, select the block around that instead.
+        """
+        sel = self.selections[-1]
+        structure = self.getStructure()
+
+        block = structure.enclosingBlock(min(sel.line0, sel.line1))
+
+        while block is not None:
+            header, last = block
+            candidate = Selection(header, 0, last, len(self.lines[last]))
+
+            if candidate != sel:
+                self.selections = [candidate]
+                self.ensureOnScreen(Selection(header, 0, header, 0))
+                return
+
+            block = structure.enclosingBlock(header)
+
+    def viewRect(self):
+        """Return (x, y, width, height) of the area we draw in."""
+        if self.rect is not None:
+            return self.rect
+
+        findBoxRows = self.context.findBox.curHeight() if self.context.findBox.visible else 0
+
+        return (0, 0, self.context.windowX, self.context.windowY - findBoxRows)
+
+    def pageRows(self):
+        return self.viewRect()[3]
+
+    def textWidth(self):
+        return max(0, self.viewRect()[2] - self.linecountWidth - 5)
+
+    def saveViewport(self):
+        return (self.topLine, self.leftmostCol, list(self.selections))
+
+    def restoreViewport(self, viewport):
+        self.topLine, self.leftmostCol, selections = viewport
+
+        # the text may have changed since we saved it
+        self.selections = [s.clipToReal(self.lines) for s in selections] if self.lines else [Selection(0, 0, 0, 0)]
+        self.topLine = min(self.topLine, max(0, len(self.lines) - 1))
+
+    def rowOfLine(self, lineIx):
+        """The screen row, counting from the top of the buffer, that shows 'lineIx'."""
+        return self.folds.rowOf(lineIx) if self.folds is not None else lineIx
+
+    def lineAtRow(self, row):
+        return self.folds.lineAtRow(row) if self.folds is not None else row
+
+    def rowCount(self):
+        return self.folds.rowCount() if self.folds is not None else len(self.lines)
+
+    def toggleWrap(self):
+        self.wrapLines = not self.wrapLines
+        self.wrapCache = None
+        self.leftmostCol = 0
+
+        self.ensureOnScreen(self.selections[-1])
+
+    def wrapPointsFor(self, lineIx):
+        width = self.textWidth()
+
+        if self.wrapCache is None or self.wrapWidth != width:
+            self.wrapCache = [None] * len(self.lines)
+            self.wrapWidth = width
+
+        if self.wrapCache[lineIx] is None:
+            self.wrapCache[lineIx] = wrapPoints(self.lines[lineIx], width)
+
+        return self.wrapCache[lineIx]
+
+    def screenRows(self, count):
+        """Return (lineIx, startCol, endCol, startCell) for each of the first 'count' rows of text on the screen.
 
-            self.ensureOnScreen(self.selections[-1])
-            self.redraw()
-            return
+        The row shows columns [startCol, endCol) of the line, and its left edge
+        is cell 'startCell' of the line. Without wrapping that's one row per
+        visible line, starting at cell 'leftmostCol'. With it, a line gets a
+        row per wrapped piece.
+        """
+        width = self.textWidth()
+        rows = []
+        row = self.rowOfLine(self.topLine)
+        skip = self.topWrapRow()
 
-        if not self.isReadOnly:
-            if char == "KEY_BACKSPACE":
-                self.selections = [
-                    s.delta(self.lines, 0, -1, extend=True, isTabBackspace=self.isPythonFile())
-                    if s.isSingle() else s for s in self.selections
-                ]
+        while len(rows) < count:
+            lineIx = self.lineAtRow(row)
+            row += 1
 
-                for i in range(len(self.selections)):
-                    self.deleteSelection(self.selections[i])
+            if lineIx >= len(self.lines):
+                rows.append((lineIx, self.leftmostCol, self.leftmostCol + width, self.leftmostCol))
+                continue
 
-                self.selections = Selection.mergeContiguous(self.selections)
+            text = self.lines[lineIx]
 
-                self.undoBuffer.pushState((list(self.lines), list(self.selections)))
+            if not self.wrapLines:
+                rows.append((
+                    lineIx,
+                    colOfCell(text, self.leftmostCol),
+                    colOfCell(text, self.leftmostCol + width),
+                    self.leftmostCol
+                ))
+                continue
 
-                self.ensureOnScreen(self.selections[-1])
-                self.redraw()
-                return
+            points = self.wrapPointsFor(lineIx)
 
-            if char == "KEY_DC":
-                self.selections = [s.delta(self.lines, 0, 1, extend=True) if s.isSingle() else s for s in self.selections]
+            for i in range(min(skip, len(points) - 1), min(len(points), skip + count - len(rows))):
+                rows.append((
+                    lineIx,
+                    points[i],
+                    points[i + 1] if i + 1 < len(points) else points[i] + width,
+                    cellOfCol(text, points[i])
+                ))
 
-                for i in range(len(self.selections)):
-                    self.deleteSelection(self.selections[i])
+            skip = 0
 
-                self.selections = Selection.mergeContiguous(self.selections)
+        return rows
 
-                self.undoBuffer.pushState((list(self.lines), list(self.selections)))
+    def topWrapRow(self):
+        line, row = self.topWrap
+        return row if self.wrapLines and line == self.topLine else 0
 
-                self.ensureOnScreen(self.selections[-1])
-                self.redraw()
-                return
+    def screenCellOf(self, line, col):
+        """Return (row, x) of the cell showing column 'col' of 'line', relative to the top left of the text.
 
-            if char == "\n":
-                for i in range(len(self.selections)):
-                    self.deleteSelection(self.selections[i])
+        None if it's not on the screen.
+        """
+        for row, (lineIx, startCol, endCol, startCell) in enumerate(self.screenRows(self.pageRows() - 2)):
+            if lineIx == line and startCol <= col < endCol:
+                return row, cellOfCol(self.lines[line] if line < len(self.lines) else "", col) - startCell
 
-                for i in range(len(self.selections)):
-                    self.insertNewlineWithIndent(self.selections[i].line1, self.selections[i].col1)
+        return None
 
-                self.selections = Selection.mergeContiguous(self.selections)
+    def blockHeadedBy(self, lineIx):
+        """Return (header, last) for the block we'd fold with the cursor on 'lineIx'.
 
-                self.undoBuffer.pushState((list(self.lines), list(self.selections)))
+        That's the block 'lineIx' introduces if it's a header, otherwise the one it's in.
+        """
+        structure = self.getStructure()
 
-                self.ensureOnScreen(self.selections[-1])
-                self.redraw()
-                return
+        if lineIx + 1 < len(self.lines):
+            found = structure.tree.findFirst(lineIx + 1, lambda prefix, agg: agg[3] < INFINITY)
 
-            if char == "KEY_BTAB":
-                if len(self.selections) == 1 and self.selections[0].line0 != self.selections[0].line1:
-                    for i in range(self.selections[0].line0, self.selections[0].line1 + (1 if self.selections[0].col1 else 0)):
-                        if self.lines[i][:4] == "    ":
-                            self.deleteSelection(Selection(i, 0, i, 4))
+            if found is not None and structure.indentOf(found[0]) > structure.indentOf(lineIx):
+                return structure.enclosingBlock(found[0])
 
-                    self.ensureOnScreen(self.selections[0])
-                    self.redraw()
-                    return True
+        return structure.enclosingBlock(lineIx)
 
-            if char == "\t":
-                if len(self.selections) == 1 and self.selections[0].line0 != self.selections[0].line1:
-                    for i in range(self.selections[0].line0, self.selections[0].line1 + (1 if self.selections[0].col1 else 0)):
-                        self.insert(i, 0, "    ")
+    def toggleFold(self):
+        """Fold the block at the cursor, or unfold it if it's folded."""
+        line = self.selections[-1].clipToReal(self.lines).line1
 
-                    self.ensureOnScreen(self.selections[0])
-                    self.redraw()
-                    return True
-                else:
-                    for i in range(len(self.selections)):
-                        self.deleteSelection(self.selections[i])
+        if self.folds is not None and self.folds.isFolded(line):
+            self.folds.unfold(line)
+        else:
+            block = self.blockHeadedBy(line)
 
-                    for i in range(len(self.selections)):
-                        self.insertTabWithIndent(self.selections[i].line1, self.selections[i].col1)
+            if block is None:
+                return
 
-                    self.selections = Selection.mergeContiguous(self.selections)
+            header, last = block
 
-                    self.undoBuffer.pushState((list(self.lines), list(self.selections)))
+            if self.folds is None:
+                self.folds = FoldMap(len(self.lines))
 
-                    self.ensureOnScreen(self.selections[-1])
-                    self.redraw()
-                    return
+            self.folds.fold(header, last)
+            self.selections = [Selection(header, len(self.lines[header]), header, len(self.lines[header]))]
 
-            if len(char) == 1 and char.isprintable():
-                # we're typing
-                for i in range(len(self.selections)):
-                    self.replaceText(self.selections[i], char)
+        if self.folds.rowCount() == len(self.lines):
+            self.folds = None
 
-                self.selections = Selection.mergeContiguous(self.selections)
+        self.ensureOnScreen(self.selections[-1])
 
-                self.undoBuffer.pushState((list(self.lines), list(self.selections)))
+    def unfoldAll(self):
+        self.folds = None
+        self.ensureOnScreen(self.selections[-1])
 
-                self.ensureOnScreen(self.selections[-1])
-                self.redraw()
-                return
+    def wordBeforeCursor(self):
+        sel = self.selections[-1].clipToReal(self.lines)
 
-        # display the character
-        self.text(self.context.windowX - len(repr(char)) - 2, 0, repr(char))
+        if not sel.isSingle() or not self.lines:
+            return ""
 
-    def replaceText(self, selection, newContents):
-        selection = selection.clipToReal(self.lines)
+        match = re.search(r"[A-Za-z_][A-Za-z0-9_]*$", self.lines[sel.line1][:sel.col1])
 
-        self.deleteSelection(selection)
-        selection = selection.rangeDeleted(selection)
+        return match.group() if match else ""
 
-        self.insert(selection.line1, selection.col1, newContents)
+    def complete(self):
+        """Offer the commonest identifiers starting with the word before the cursor."""
+        prefix = self.wordBeforeCursor()
 
-    def deleteSelection(self, selection):
-        if selection.isSingle():
+        if not prefix:
             return
 
-        selection = selection.clipToReal(self.lines)
-
-        if selection.line0 == selection.line1:
-            self.lines[selection.line0] = (
-                self.lines[selection.line0][:selection.col0] + self.lines[selection.line0][selection.col1:]
-            )
-        else:
-            self.lines = (
-                self.lines[:selection.line0]
-                + [self.lines[selection.line0][:selection.col0] + self.lines[selection.line1][selection.col1:]]
-                + self.lines[selection.line1 + 1:]
-            )
+        words = [word for _, word in self.context.completions.complete(prefix) if word != prefix]
 
-        for i in range(len(self.selections)):
-            self.selections[i] = self.selections[i].rangeDeleted(selection)
+        if len(words) == 1:
+            self.insertCompletion(prefix, words[0])
+            self.redraw()
+        elif words:
+            self.context.newWindow(CompletionPopup(self.context, self, prefix, words))
 
-    def insertNewlineWithIndent(self, line, col):
-        indent = ""
+    def insertCompletion(self, prefix, word):
+        # end the run of typing, so undo takes back just the completion
+        self.pushUndoState(True)
 
-        # implement python newlines
-        if self.isPythonFile():
-            if 0 <= line < len(self.lines):
-                indent = self.lines[line][:len(self.lines[line]) - len(self.lines[line].lstrip())]
-                if len(indent) > col:
-                    indent = indent[:col]
+        for i in range(len(self.selections)):
+            self.replaceText(self.selections[i], word[len(prefix):])
 
-                if self.lines[line].endswith(":") and col >= len(self.lines[line]):
-                    indent += "    "
+        self.selections = Selection.mergeContiguous(self.selections)
 
-        self.insert(line, col, "\n")
-        if indent:
-            self.insert(line + 1, 0, indent)
+        self.pushUndoState()
+        self.ensureOnScreen(self.selections[-1])
 
     def insertTabWithIndent(self, line, col):
         if not self.isPythonFile() or not (0 <= line < len(self.lines)):
@@ -1221,12 +5630,10 @@ class TextBufferDisplay(Display):
             for i in range(len(self.selections)):
                 self.selections[i] = self.selections[i].insertedLines(line, col, len(newText))
 
-            self.lines = (
-                self.lines[:line]
-                + [self.lines[line][:col]]
-                + ([""] * (len(newText) - 1))
-                + [self.lines[line][col:]]
-                + self.lines[line+1:]
+            self.replaceLines(
+                line,
+                line + 1,
+                [self.lines[line][:col]] + [""] * (len(newText) - 1) + [self.lines[line][col:]]
             )
         elif "\n" in newText:
             lines = newText.split("\n")
@@ -1235,13 +5642,12 @@ class TextBufferDisplay(Display):
             self.insert(line, col + len(lines[0]), "\n" * (len(lines) - 1))
             self.insert(line + len(lines) - 1, 0, lines[-1])
 
-            for internalLineIx in range(1, len(lines) - 1):
-                self.lines[line + internalLineIx] = lines[internalLineIx]
+            self.replaceLines(line + 1, line + len(lines) - 1, lines[1:-1])
         else:
             for i in range(len(self.selections)):
                 self.selections[i] = self.selections[i].insertedChars(line, col, len(newText))
 
-            self.lines[line] = self.lines[line][:col] + newText + self.lines[line][col:]
+            self.replaceLines(line, line + 1, [self.lines[line][:col] + newText + self.lines[line][col:]])
 
     def findAll(self, searchFor, maxCount=1000):
         result = []
@@ -1296,98 +5702,323 @@ class TextBufferDisplay(Display):
             return None
 
     def ensureOnScreen(self, lineAndCol):
+        if self.isPlayingMacro:
+            return
+
         line, col = lineAndCol.line1, lineAndCol.col1
 
-        windowY = self.context.windowY
+        if self.folds is not None:
+            # the cursor can't sit inside a fold
+            self.folds.unfoldAround(line)
 
-        if line < self.topLine:
-            if self.topLine - line > 5:
-                self.topLine = max(0, line - windowY // 2)
+        windowY = self.viewRect()[3]
+
+        # work in screen rows, which are buffer lines with the folded ones left out
+        row = self.rowOfLine(line)
+        topRow = self.rowOfLine(self.topLine)
+        rowCount = self.rowCount()
+
+        if row < topRow:
+            if topRow - row > 5:
+                topRow = max(0, row - windowY // 2)
             else:
-                self.topLine = max(0, line - 1)
+                topRow = max(0, row - 1)
 
-        if line > self.topLine + windowY - 3:
-            if line - (self.topLine + windowY - 1) > 8:
-                self.topLine = max(0, min(len(self.lines) - 1, line - windowY // 2))
+        if row > topRow + windowY - 3:
+            if row - (topRow + windowY - 1) > 8:
+                topRow = max(0, min(rowCount - 1, row - windowY // 2))
             else:
-                self.topLine = max(0, min(len(self.lines) - 1, line - windowY + 3))
+                topRow = max(0, min(rowCount - 1, row - windowY + 3))
+
+        self.topLine = self.lineAtRow(topRow)
+
+        if line >= len(self.lines):
+            return
+
+        col = min(col, len(self.lines[line]))
+
+        if self.wrapLines:
+            # lines can take several rows, so count the rows down to the
+            # cursor and scroll down until it's on the screen too
+            cursorRow = bisect.bisect_right(self.wrapPointsFor(line), col) - 1
+            skip = self.topWrapRow()
+
+            if line == self.topLine and cursorRow < skip:
+                skip = cursorRow
+
+            rows = cursorRow - skip
+            for r in range(self.rowOfLine(self.topLine), row):
+                rows += len(self.wrapPointsFor(self.lineAtRow(r)))
+
+            while rows > windowY - 3:
+                rest = len(self.wrapPointsFor(self.topLine)) - skip
+
+                if self.topLine < line and rows - rest >= 0:
+                    rows -= rest
+                    self.topLine = self.lineAtRow(self.rowOfLine(self.topLine) + 1)
+                    skip = 0
+                else:
+                    skip += rows - (windowY - 3)
+                    rows = windowY - 3
+
+            self.topWrap = (self.topLine, skip)
+        else:
+            # scroll sideways, leaving a bit of room on the side we're moving towards
+            width = self.textWidth()
+            text = self.lines[line]
+            cell = cellOfCol(text, col)
+            cellEnd = max(cell + 1, cellOfCol(text, col + 1))
+
+            if cell < self.leftmostCol:
+                self.leftmostCol = max(0, cell - width // 4)
+            elif cellEnd > self.leftmostCol + width:
+                self.leftmostCol = cellEnd - width + width // 4
 
     def redraw(self):
+        if self.isPlayingMacro:
+            return
+
         cursorsByLine = {}
 
-        for selection in self.selections:
-            selection.extendCursors(cursorsByLine, self.lines)
+        self.bracketHighlights = {}
+        match = self.matchingBracketNearCursor()
+        if match is not None:
+            for line, col in match:
+                self.bracketHighlights.setdefault(line, []).append(col)
 
-        if self.context.findBox.visible:
-            bottomRows = 2 + self.context.findBox.curHeight()
-        else:
-            bottomRows = 2
+        x0, y0, width, height = self.viewRect()
+
+        rows = self.screenRows(height - 2)
+
+        if rows and self.isActive:
+            if self.block is not None:
+                # a block can cover thousands of lines, so only lay out the ones on screen
+                for line in range(max(self.block.top, rows[0][0]), min(self.block.bottom, rows[-1][0]) + 1):
+                    self.block.selectionOn(self.lines, line).extendCursors(cursorsByLine, self.lines)
+            else:
+                for selection in self.selections:
+                    selection.extendCursors(cursorsByLine, self.lines, rows[0][0], rows[-1][0])
+
+        for screenRow, (lineIx, startCol, endCol, startCell) in enumerate(rows):
+            marker = None
+
+            if self.wrapLines and startCol > 0:
+                gutter = ""
+            else:
+                marker = self.changeMarkerAt(lineIx) if lineIx < len(self.lines) else None
+
+                gutter = pad(str(lineIx + 1), self.linecountWidth) + CHANGE_MARKERS.get(marker, " ")
+                if self.folds is not None and self.folds.isFolded(lineIx):
+                    gutter += "+"
+
+            self.lightText(x0, y0 + screenRow + 1, pad(gutter, self.linecountWidth + 2))
+
+            if marker is not None:
+                stdscr = self.context.stdscr
+                stdscr.chgat(y0 + screenRow + 1, x0 + self.linecountWidth, 1, stdscr.syntaxAttr(marker))
 
-        for screenRow in range(self.context.windowY - bottomRows):
-            lineNumber = self.topLine + screenRow + 1
+            text = self.lines[lineIx] if lineIx < len(self.lines) else ""
 
-            self.lightText(0, screenRow + 1, pad(str(lineNumber), self.linecountWidth + 2))
+            cursors = []
+            for start, end in cursorsByLine.get(lineIx, ()):
+                start, end = max(start, startCol), min(end, endCol)
+
+                if start < end:
+                    cell0 = cellOfCol(text, start) - startCell
+                    cell1 = max(cellOfCol(text, end) - startCell, cell0 + 1)
+                    cursors.extend(range(cell0, min(cell1, self.textWidth())))
 
             self.textWithCursors(
-                self.linecountWidth + 2,
-                screenRow + 1,
-                self.visibleTextForLine(lineNumber - 1),
-                cursorsByLine.get(lineNumber - 1, [])
+                x0 + self.linecountWidth + 2,
+                y0 + screenRow + 1,
+                self.visibleTextForLine(lineIx, startCol, endCol, startCell),
+                cursors,
+                self.attributeRunsForLine(lineIx, startCol, endCol, startCell)
             )
 
-        if self.context.findBox.visible:
+        if self.context.findBox.visible and self.isActive:
             self.context.findBox.redraw()
 
         if self.getTitle() is not None:
-            self.textBold(0, 0, pad(str(self.getTitle()), self.context.windowX - 20))
+            title = str(self.getTitle())
+            if self.context.macroRecording is not None:
+                title += "  (recording a macro: F9 to stop)"
+            if self.pipeJob is not None:
+                title += "  (running %s: ctrl-\\ cancels)" % self.pipeJob.command
+            elif self.status is not None:
+                title += "  (" + self.status + ")"
+            title = pad(title, max(0, width - 20))
+
+            if self.isActive:
+                self.textBold(x0, y0, title)
+            else:
+                self.lightText(x0, y0, title)
+
+    def attributeRunsForLine(self, lineIndex, startCol=None, endCol=None, startCell=None):
+        """Return (x, cells, attr) runs for the columns [startCol, endCol) of a line.
+
+        'x' counts screen cells from 'startCell'. By default we show what fits
+        from cell 'leftmostCol' on.
+        """
+        if lineIndex < 0 or lineIndex >= len(self.lines):
+            return []
+
+        text = self.lines[lineIndex]
+
+        if startCell is None:
+            startCell = self.leftmostCol
+            startCol = colOfCell(text, startCell)
+            endCol = colOfCell(text, startCell + self.textWidth())
+
+        width = min(self.textWidth(), cellOfCol(text, endCol) - startCell)
+        stdscr = self.context.stdscr
+
+        runs = []
+
+        if self.highlighter is not None:
+            runs.extend(self.highlighter.runsFor(self.lines, lineIndex))
+
+        for col in self.bracketHighlights.get(lineIndex, ()):
+            runs.append((col, 1, "bracket"))
+
+        result = []
+
+        for start, length, kind in runs:
+            start, end = cellOfCol(text, start) - startCell, cellOfCol(text, start + length) - startCell
+            end = min(end, width)
+            start = max(start, 0)
+
+            if start < end:
+                result.append((start, end - start, stdscr.syntaxAttr(kind)))
 
-    def visibleTextForLine(self, lineIndex):
-        width = self.context.windowX - self.linecountWidth - 5
+        return result
+
+    def visibleTextForLine(self, lineIndex, startCol=None, endCol=None, startCell=None):
+        """The columns [startCol, endCol) of a line as they appear on the screen, starting at cell 'startCell'.
+
+        By default we show what fits from cell 'leftmostCol' on.
+        """
+        width = self.textWidth()
 
         if lineIndex < 0 or lineIndex >= len(self.lines):
             return pad("", width)
 
-        return pad(self.lines[lineIndex][self.leftmostCol:], width)
+        text = self.lines[lineIndex]
+
+        if startCell is None:
+            startCell = self.leftmostCol
+            startCol = colOfCell(text, startCell)
+            endCol = colOfCell(text, startCell + width)
+
+        # only lay out what fits, since a line can be megabytes long
+        return cellText(text, startCol, endCol, startCell, width)
 
 
 class FileDisplay(TextBufferDisplay):
-    def __init__(self, context, fileName):
-        super().__init__(context)
+    """A view of a FileBuffer. 'context.openFiles' holds the first view of each file.
+
+    With loadNow=False the file isn't read until somebody calls 'load'.
+    """
+    def __init__(self, context, fileName, buffer=None, loadNow=True):
+        super().__init__(context, buffer if buffer is not None else FileBuffer(context, fileName))
 
         self.fileName = fileName
-        self.path = context.fileSet.namesToPaths[fileName]
 
-        self.lines = self.context.fileSet.readlines(self.path)
-        self.linesOnDisk = list(self.lines)
+        if loadNow:
+            self.load()
 
-        self.undoBuffer.pushState((list(self.lines), list(self.selections)))
+    @property
+    def path(self):
+        return self.buffer.path
 
-    def isPythonFile(self):
-        return self.fileName.endswith(".py")
+    @property
+    def isLoaded(self):
+        return self.buffer.isLoaded
+
+    @property
+    def linesOnDisk(self):
+        return self.buffer.linesOnDisk
+
+    @property
+    def lastActivated(self):
+        return self.buffer.lastActivated
+
+    @lastActivated.setter
+    def lastActivated(self, value):
+        self.buffer.lastActivated = value
+
+    @property
+    def lastActiveTime(self):
+        return self.buffer.lastActiveTime
+
+    @lastActiveTime.setter
+    def lastActiveTime(self, value):
+        self.buffer.lastActiveTime = value
+
+    def newView(self):
+        view = FileDisplay(self.context, self.fileName, self.buffer)
+        view.wrapLines = self.wrapLines
+        view.restoreViewport(self.saveViewport())
+        return view
+
+    def load(self):
+        """Read the file from disk if we're not holding it in memory.
+
+        Selections and the scroll position survive an unload/load cycle, clipped
+        to the new text in case the file changed on disk in the meantime.
+        """
+        if self.buffer.load():
+            self.pushUndoState()
+
+    def unload(self):
+        """Drop the text and its history, keeping selections and scroll position.
+
+        Only legal if there are no unsaved changes.
+        """
+        self.buffer.unload()
+
+    def discardSwap(self):
+        self.buffer.discardSwap()
+
+    def recoverFrom(self, lines):
+        """Replace our text with unsaved text recovered from a previous session."""
+        self.buffer.setLines(list(lines))
+        self.pushUndoState()
+
+    def memoryUsage(self):
+        return self.buffer.memoryUsage()
 
     def isChanged(self):
-        return self.lines != self.linesOnDisk
+        return self.buffer.isChanged()
+
+    def changeMarkerAt(self, lineIx):
+        # unsaved changes take precedence over ones that are saved but not committed
+        if self.buffer.diskDiff is not None:
+            marker = self.buffer.diskDiff.markerAt(lineIx)
+            if marker is not None:
+                return marker
+
+        if self.buffer.headDiff is not None:
+            marker = self.buffer.headDiff.markerAt(lineIx)
+            if marker is not None:
+                return "head" + marker.capitalize()
+
+        return None
 
     def getTitle(self):
         return ("* " if self.isChanged() else "  ") + self.fileName
 
     def save(self):
-        if self.isChanged():
-            self.context.fileSet.writelines(self.path, self.lines)
-            self.linesOnDisk = list(self.lines)
-
-    def checkDisk(self):
-        if not self.isChanged():
-            newLines = self.context.fileSet.readlines(self.path)
+        self.buffer.save()
 
-            if newLines != self.lines:
-                self.lines = newLines
-                self.linesOnDisk = list(newLines)
+    def workingDirectory(self):
+        return os.path.dirname(os.path.abspath(self.path))
 
-                self.selections = [s.ensureValid(lines) for s in self.selections]
+    def checkDisk(self):
+        self.buffer.checkDisk()
 
     def revert(self):
-        self.lines = list(self.linesOnDisk)
+        self.setLines(list(self.linesOnDisk))
         self.checkDisk()
 
     def receiveChar(self, char):
@@ -1400,8 +6031,38 @@ class FileDisplay(TextBufferDisplay):
                 GoToLineDisplay(self.context, self)
             )
 
+        if char == KEY_F12:
+            self.goToDefinition()
+            return
+
+        if char == KEY_CTRL_E:
+            if self.isPythonFile():
+                self.context.newWindow(OutlineSelector(self.context, self))
+            return
+
         return super().receiveChar(char)
 
+    def goToDefinition(self):
+        """Jump to the definition of the word under the cursor."""
+        if self.context.symbolIndex is None or not self.lines:
+            return
+
+        word = self.selections[-1].selectWord(self.lines).selectedText(self.lines)
+
+        if not word.isidentifier():
+            return
+
+        definitions = self.context.symbolIndex.definitionsOf(word)
+
+        if len(definitions) == 1:
+            _, _, fileName, lineNumber = definitions[0]
+            self.context.openFileAtLine(fileName, lineNumber - 1)
+        elif definitions:
+            selector = SymbolSelector(self.context)
+            selector.setFilter(word)
+            selector.cursor = len(word)
+            self.context.newWindow(selector)
+
     def close(self):
         if self.isChanged():
             self.context.pushDisplay(
@@ -1412,7 +6073,8 @@ class FileDisplay(TextBufferDisplay):
 
     def completeClose(self):
         self.context.openFiles.pop(self.fileName)
-        self.context.removeDisplay(self)
+        self.buffer.close()
+        self.context.closeViewsOf(self.buffer)
 
 
 class DefaultDisplay(TextBufferDisplay):
@@ -1421,7 +6083,7 @@ class DefaultDisplay(TextBufferDisplay):
 
         self.isReadOnly = True
 
-        self.lines = [
+        self.setLines([
             "",
             "                    Welcome to braxblime",
             "",
@@ -1429,19 +6091,29 @@ class DefaultDisplay(TextBufferDisplay):
             "    Ctrl-Q to quit",
             "    Ctrl-P to open files",
             "    Ctrl-O to see open files",
+            "    Ctrl-T to go to a class or function anywhere in the project",
             "    Alt-PageDn to go to next open file",
             "    Alt-PageUp to go to prior open file",
+            "    F7 to split the window side by side, Shift-F7 to split it top and bottom",
+            "    F6 to move to the next pane, F8 to close the current pane",
             "",
             "within a file:",
             "    Ctrl-W to close",
             "    Ctrl-S to save",
             "    Ctrl-R to revert",
             "    Ctrl-D to select words",
+            "    F12 to go to the definition of the word under the cursor",
+            "    Ctrl-E (or @ in Ctrl-G) to go to a class or def in this file",
+            "    Ctrl-] to jump to the matching bracket",
+            "    Ctrl-B to select the enclosing block (again for the block around that)",
+            "    Ctrl-K to fold or unfold the block at the cursor, Ctrl-U to unfold everything",
+            "    Ctrl-Space to complete the word before the cursor",
+            "    Ctrl-L to wrap long lines (again to scroll sideways instead)",
             "    Ctrl-F to find",
             "        Ctrl-A to select all finds simultaneously",
             "    F3 to go to next find item",
             "    Shift-F3 to go to prior find item"
-        ]
+        ])
 
 
 class CloseBeforeSavingDialog(Display):
@@ -1469,16 +6141,50 @@ class CloseBeforeSavingDialog(Display):
         if char in "yYn\n":
             if char != "n":
                 self.file.save()
+            else:
+                self.file.discardSwap()
 
             self.context.removeDisplay(self)
             self.postAction()
 
 
+class RecoverSwapDialog(Display):
+    def __init__(self, context, file, recoveredLines):
+        super().__init__(context)
+        self.file = file
+        self.recoveredLines = recoveredLines
+
+        self.resized()
+
+    def resized(self):
+        self.width = min(self.context.windowX - 30, 150)
+        self.xPos = self.context.windowX // 2 - self.width // 2
+        self.yPos = 5
+
+    def redraw(self):
+        self.box(self.xPos, self.yPos, self.xPos + self.width, self.yPos + 6, clear=True)
+        self.text(
+            self.xPos + 2, self.yPos + 2,
+            pad("File " + self.file.fileName + " has unsaved changes from a crashed session", self.width - 10)
+        )
+        self.text(self.xPos + 2, self.yPos + 4, pad("Recover them? [Y/n]", self.width - 10))
+
+    def receiveChar(self, char):
+        if char in "yYn\n":
+            if char != "n":
+                self.file.recoverFrom(self.recoveredLines)
+            else:
+                self.file.discardSwap()
+
+            self.context.removeDisplay(self)
+
+
 class OpenFiles(Display):
     def __init__(self, context, whichFileIx=0):
         self.context = context
         self.whichFileIx = whichFileIx
         self.topLineIx = 0
+        self.lineStoreStats = None
 
     def redraw(self):
         text = "Open Files"
@@ -1494,14 +6200,49 @@ class OpenFiles(Display):
 
         openFilesList = sorted(self.context.openFiles)
 
+        memoryWidth = 52
+        titleWidth = max(0, self.context.windowX - memoryWidth - 4)
+
         for screenRow in range(self.context.windowY - 4):
             fileIx = screenRow + self.topLineIx
 
             if fileIx >= 0 and fileIx < len(openFilesList):
+                openFile = self.context.openFiles[openFilesList[fileIx]]
+                title = pad(openFile.getTitle(), titleWidth)
+
                 if fileIx == self.whichFileIx:
-                    self.highlightedText(2, screenRow + 2, self.context.openFiles[openFilesList[fileIx]].getTitle())
+                    self.highlightedText(2, screenRow + 2, title)
                 else:
-                    self.text(2, screenRow + 2, self.context.openFiles[openFilesList[fileIx]].getTitle())
+                    self.text(2, screenRow + 2, title)
+
+                if titleWidth:
+                    self.lightText(2 + titleWidth, screenRow + 2, self.memoryText(openFile, memoryWidth))
+
+        if self.lineStoreStats is None:
+            self.lineStoreStats = self.context.sweepLineStore()
+
+        stats = self.lineStoreStats
+        self.lightText(
+            0,
+            self.context.windowY - 1,
+            pad(
+                f"  {stats['uniqueLines']} unique lines, {stats['references']} references, "
+                f"dedup ratio {stats['dedupRatio']:.2f}, {formatBytes(stats['bytesSaved'])} saved",
+                self.context.windowX - 1
+            )
+        )
+
+    @staticmethod
+    def memoryText(openFile, width):
+        if not openFile.isLoaded:
+            return pad("unloaded", width)
+
+        usage = openFile.memoryUsage()
+
+        return pad(
+            " ".join(f"{category} {formatBytes(usage[category]):>6s}" for category in ["text", "saved", "undo", "caches"]),
+            width
+        )
 
     def receiveChar(self, char):
         res = self._receiveChar(char)
@@ -1626,56 +6367,147 @@ class GoToLineDisplay(Display):
             self.setContents(self.contents[:self.cursor] + self.contents[self.cursor + 1:])
             return True
 
-        if char == "KEY_LEFT":
-            self.cursor = max(0, self.cursor - 1)
-            return True
+        if char == "KEY_LEFT":
+            self.cursor = max(0, self.cursor - 1)
+            return True
+
+        if char == "KEY_RIGHT":
+            self.cursor = min(len(self.contents), self.cursor + 1)
+            return True
+
+        if char == "\n":
+            try:
+                line = int(self.contents)
+            except Exception:
+                line = 1
+
+            line -= 1
+
+            self.file.selections = [Selection(line, 0, line, 0)]
+            self.file.ensureOnScreen(self.file.selections[-1])
+
+            self.context.removeDisplay(self)
+            return False
+
+        if char == "@" and not self.contents and self.file.isPythonFile():
+            # '@' switches to going to a symbol
+            self.context.removeDisplay(self)
+            self.context.newWindow(OutlineSelector(self.context, self.file))
+            return False
+
+        if len(char) == 1 and (char.isalnum() or char in ("/ _.")):
+            self.setContents(self.contents[:self.cursor] + char + self.contents[self.cursor:])
+            self.cursor += 1
+            return True
+
 
-        if char == "KEY_RIGHT":
-            self.cursor = min(len(self.contents), self.cursor + 1)
-            return True
+class RepeatMacroDisplay(GoToLineDisplay):
+    """Asks how many times to play the last keyboard macro."""
+    def redraw(self):
+        self.box(self.xPos, self.yPos, self.xPos + self.width, self.yPos + 6, clear=True)
+        self.text(self.xPos + 2, self.yPos + 2, pad("Play the macro how many times:", self.width - 10))
+        self.text(self.xPos + 2, self.yPos + 4, pad(self.contents, self.width - 10))
 
+    def _receiveChar(self, char):
         if char == "\n":
             try:
-                line = int(self.contents)
-            except Exception:
-                line = 1
+                count = max(int(self.contents), 0)
+            except ValueError:
+                count = 1
 
-            line -= 1
+            self.context.removeDisplay(self)
+            self.file.playMacro(self.context.macro, count)
+            return False
 
-            self.file.selections = [Selection(line, 0, line, 0)]
-            self.file.ensureOnScreen(self.file.selections[-1])
+        if char == "@":
+            return False
+
+        return super()._receiveChar(char)
+
+
+class PipeCommandDisplay(GoToLineDisplay):
+    """Asks for a shell command to filter the selected text through."""
+    def __init__(self, context, file):
+        super().__init__(context, file)
+        self.contents = context.lastPipeCommand
+        self.cursor = len(self.contents)
+
+    def redraw(self):
+        self.box(self.xPos, self.yPos, self.xPos + self.width, self.yPos + 6, clear=True)
+        self.text(self.xPos + 2, self.yPos + 2, pad("Pipe the selection through:", self.width - 10))
+        self.text(self.xPos + 2, self.yPos + 4, pad(self.contents, self.width - 10))
 
+    def _receiveChar(self, char):
+        if char == "\n":
             self.context.removeDisplay(self)
+            self.context.lastPipeCommand = self.contents
+            self.file.startPipe(self.contents)
             return False
 
-        if len(char) == 1 and (char.isalnum() or char in ("/ _.")):
+        if len(char) == 1 and char.isprintable():
             self.setContents(self.contents[:self.cursor] + char + self.contents[self.cursor:])
             self.cursor += 1
             return True
 
+        return super()._receiveChar(char)
+
 
-class FileSelector(Display):
+class FuzzySelector(Display):
+    """A popup that filters a list of strings as you type and does something with the one you pick.
+
+    Subclasses implement 'allItems' and 'accept'.
+    """
     def __init__(self, context):
         self.context = context
         self.filterText = ""
         self.cursor = 0
         self.selectedMatchIx = None
-        self.matches = self.context.fileSet.sortedNames
+
+        # why we wouldn't accept the last item picked, shown at the bottom
+        self.message = None
+
+        # the items that pass the filter, in 'allItems' order, and the same
+        # items in the order we show them
+        self.filtered = self.allItems()
+        self.matches = self.rank(self.filtered)
 
         self.resized()
 
+    def allItems(self):
+        raise NotImplementedError(self)
+
+    def accept(self, item):
+        raise NotImplementedError(self)
+
+    def refusal(self, item):
+        """A message saying why we can't accept 'item', or None if we can."""
+        return None
+
+    def rank(self, matches):
+        """Put the items that pass the filter in the order we show them. By default, as they are."""
+        return matches
+
     def resized(self):
         self.width = min(self.context.windowX - 30, 150)
         self.xPos = self.context.windowX // 2 - self.width // 2
         self.yPos = 5
 
     def setFilter(self, filterText):
+        # typing on the end of the filter only ever narrows it, so we only
+        # need to look at what passed last time
+        if filterText.startswith(self.filterText):
+            candidates = self.filtered
+        else:
+            candidates = self.allItems()
+
         self.filterText = filterText
 
         filterFun = self.buildFilter(self.filterText)
 
-        self.matches = [x for x in self.context.fileSet.sortedNames if filterFun(x)]
+        self.filtered = [x for x in candidates if filterFun(x)]
+        self.matches = self.rank(self.filtered)
         self.selectedMatchIx = None
+        self.message = None
 
     def buildFilter(self, filterText):
         if not filterText:
@@ -1727,6 +6559,8 @@ class FileSelector(Display):
             else:
                 self.text(self.xPos + 2, self.yPos + 3 + lineIx, pad("", self.width - 4))
 
+        self.lightText(self.xPos + 2, self.yPos + 19, pad(self.message or "", self.width - 4))
+
     def receiveChar(self, char):
         res = self._receiveChar(char)
 
@@ -1784,8 +6618,14 @@ class FileSelector(Display):
             if not self.matches:
                 return False
 
+            item = self.matches[min(self.selectedMatchIx or 0, len(self.matches) - 1)]
+
+            self.message = self.refusal(item)
+            if self.message is not None:
+                return True
+
             self.context.removeDisplay(self)
-            self.context.openFile(self.matches[self.selectedMatchIx or 0])
+            self.accept(item)
             return False
 
         if len(char) == 1 and (char.isalnum() or char in ("/ _.")):
@@ -1794,6 +6634,210 @@ class FileSelector(Display):
             return True
 
 
+class FileSelector(FuzzySelector):
+    def allItems(self):
+        return self.context.fileSet.sortedNames
+
+    def accept(self, item):
+        self.context.openFile(item)
+
+    def refusal(self, item):
+        if item not in self.context.openFiles and self.context.fileSet.isBinary(self.context.fileSet.namesToPaths[item]):
+            return "can't open %s: it looks like a binary file" % item
+
+        return None
+
+    def rank(self, matches):
+        """Files we use a lot or used recently first, especially if the filter is in their name.
+
+        Everything else stays in alphabetical order after them.
+        """
+        history = self.context.fileHistory
+        now = self.context.clock()
+        filterText = self.filterText.lower()
+
+        def score(name):
+            result = 2 * math.log1p(history.scoreOf(name, now))
+
+            if filterText:
+                baseName = name[name.rfind("/") + 1:].lower()
+
+                if baseName.startswith(filterText):
+                    result += 2
+                elif filterText in baseName:
+                    result += 1
+
+            return result
+
+        if filterText:
+            candidates = matches
+        else:
+            # only the history can move anything, so don't score every file in the project
+            matchSet = set(matches)
+            candidates = [name for name in history.entries if name in matchSet]
+
+        scores = {}
+        for name in candidates:
+            s = score(name)
+            if s > 0:
+                scores[name] = s
+
+        if not scores:
+            return matches
+
+        return sorted(scores, key=lambda name: (-scores[name], name)) + [
+            name for name in matches if name not in scores
+        ]
+
+
+class SymbolSelector(FuzzySelector):
+    """Pick a class or function from the project's SymbolIndex and jump to it."""
+    def __init__(self, context):
+        self.labelToLocation = {}
+
+        for qualname, kind, fileName, lineNumber in context.symbolIndex.allSymbols():
+            label = f"{qualname}  ({kind} in {fileName}:{lineNumber})"
+            self.labelToLocation[label] = (fileName, lineNumber - 1)
+
+        self.labels = sorted(self.labelToLocation)
+
+        super().__init__(context)
+
+    def allItems(self):
+        return self.labels
+
+    def accept(self, item):
+        self.context.openFileAtLine(*self.labelToLocation[item])
+
+
+class OutlineSelector(FuzzySelector):
+    """Pick a class or def in the current file and jump to it."""
+    def __init__(self, context, file):
+        self.file = file
+        self.labelToLine = {}
+
+        for qualname, kind, lineIx in file.getOutline().symbols():
+            self.labelToLine[f"{qualname}  ({kind}, line {lineIx + 1})"] = lineIx
+
+        # keep file order rather than sorting
+        self.labels = list(self.labelToLine)
+
+        super().__init__(context)
+
+    def allItems(self):
+        return self.labels
+
+    def accept(self, item):
+        lineIx = self.labelToLine[item]
+        self.file.selections = [Selection(lineIx, 0, lineIx, 0).clipToReal(self.file.lines)]
+        self.file.ensureOnScreen(self.file.selections[-1])
+        self.context.fullRedraw()
+
+
+class LineOperationSelector(FuzzySelector):
+    """Pick something to do to the selected lines: sort them, drop repeats, reverse or join them."""
+    OPERATIONS = {
+        "sort lines": sorted,
+        "sort lines ignoring case": lambda lines: sorted(lines, key=str.casefold),
+        "sort lines by number": lambda lines: sorted(lines, key=numericSortKey),
+        "sort lines naturally (file2 before file10)": lambda lines: sorted(lines, key=naturalSortKey),
+        "unique lines": uniqueLines,
+        "reverse lines": lambda lines: lines[::-1],
+        "join lines": joinLines,
+    }
+
+    def __init__(self, context, file):
+        self.file = file
+        super().__init__(context)
+
+    def allItems(self):
+        return list(LineOperationSelector.OPERATIONS)
+
+    def accept(self, item):
+        self.file.transformLines(LineOperationSelector.OPERATIONS[item])
+        self.context.fullRedraw()
+
+
+class CompletionPopup(Display):
+    """A list of completions for the word before the cursor, drawn just below it.
+
+    Typing more of the word narrows the list; any other key closes it and
+    goes to the buffer as usual.
+    """
+    def __init__(self, context, file, prefix, words):
+        super().__init__(context)
+
+        self.file = file
+        self.prefix = prefix
+        self.words = words
+        self.selectedIx = 0
+
+    def redraw(self):
+        file = self.file
+        sel = file.selections[-1].clipToReal(file.lines)
+
+        width = min(max(len(w) for w in self.words) + 4, self.context.windowX - 2)
+        height = len(self.words) + 1
+
+        fileX, fileY, _, _ = file.viewRect()
+        row, x = file.screenCellOf(sel.line1, sel.col1) or (0, 0)
+
+        x0 = min(
+            fileX + file.linecountWidth + 2 + max(0, x - len(self.prefix)),
+            self.context.windowX - width - 2
+        )
+        y0 = fileY + row + 2
+
+        if y0 + height >= self.context.windowY - 1:
+            # no room below the cursor, so go above it
+            y0 = max(0, y0 - height - 2)
+
+        self.box(x0, y0, x0 + width, y0 + height, clear=True)
+
+        for i, word in enumerate(self.words):
+            if i == self.selectedIx:
+                self.highlightedText(x0 + 1, y0 + 1 + i, pad(word, width - 2))
+            else:
+                self.text(x0 + 1, y0 + 1 + i, pad(word, width - 2))
+
+    def receiveChar(self, char):
+        if char == "KEY_DOWN":
+            self.selectedIx = min(self.selectedIx + 1, len(self.words) - 1)
+            self.redraw()
+            return
+
+        if char == "KEY_UP":
+            self.selectedIx = max(self.selectedIx - 1, 0)
+            self.redraw()
+            return
+
+        if char == KEY_ESC:
+            self.context.removeDisplay(self)
+            return
+
+        if char in ("\n", "\t"):
+            self.context.displays.remove(self)
+            self.file.insertCompletion(self.prefix, self.words[self.selectedIx])
+            self.context.fullRedraw()
+            return
+
+        # anything else goes to the buffer, and we refilter if they're still typing the word
+        self.context.displays.remove(self)
+        self.file.receiveChar(char)
+
+        if len(char) == 1 and (char.isalnum() or char == "_") or char == "KEY_BACKSPACE":
+            prefix = self.file.wordBeforeCursor()
+            words = [word for _, word in self.context.completions.complete(prefix) if word != prefix]
+
+            if prefix and words:
+                self.prefix = prefix
+                self.words = words
+                self.selectedIx = 0
+                self.context.displays.append(self)
+
+        self.context.fullRedraw()
+
+
 class CursesWindow:
     """A wrapper around a standard curses 'window' object.
 
@@ -1805,9 +6849,58 @@ class CursesWindow:
     Outside of 'main', all curses interactions should go through
     this object.
     """
+    # kind -> curses attribute for syntax highlighting, filled in by 'initColors'
+    colorAttrs = {}
+
     def __init__(self, stdscr):
         self.stdscr = stdscr
 
+    def initColors(self):
+        if not curses.has_colors():
+            return
+
+        curses.start_color()
+        curses.use_default_colors()
+
+        colors = {
+            "keyword": (curses.COLOR_MAGENTA, curses.A_BOLD),
+            "builtin": (curses.COLOR_CYAN, 0),
+            "definition": (curses.COLOR_GREEN, curses.A_BOLD),
+            "string": (curses.COLOR_YELLOW, 0),
+            "comment": (curses.COLOR_BLUE, 0),
+            "number": (curses.COLOR_RED, 0),
+            "decorator": (curses.COLOR_CYAN, curses.A_BOLD),
+            "bracket": (curses.COLOR_WHITE, curses.A_BOLD | curses.A_UNDERLINE),
+            "added": (curses.COLOR_GREEN, curses.A_BOLD),
+            "modified": (curses.COLOR_YELLOW, curses.A_BOLD),
+            "deleted": (curses.COLOR_RED, curses.A_BOLD),
+            "headAdded": (curses.COLOR_GREEN, curses.A_DIM),
+            "headModified": (curses.COLOR_YELLOW, curses.A_DIM),
+            "headDeleted": (curses.COLOR_RED, curses.A_DIM),
+        }
+
+        self.colorAttrs = {}
+        for pairIx, (kind, (color, extra)) in enumerate(sorted(colors.items()), 1):
+            curses.init_pair(pairIx, color, -1)
+            self.colorAttrs[kind] = curses.color_pair(pairIx) | extra
+
+    def syntaxAttr(self, kind):
+        """The attribute to draw a token of the given kind with."""
+        if kind in self.colorAttrs:
+            return self.colorAttrs[kind]
+
+        if kind in ("keyword", "definition", "decorator", "bracket", "added", "modified", "deleted"):
+            return self.A_BOLD
+
+        if kind in ("comment", "headAdded", "headModified", "headDeleted"):
+            return self.A_DIM
+
+        return self.A_NORMAL
+
+    @property
+    def A_NORMAL(self):
+        return curses.A_NORMAL
+
     @property
     def A_STANDOUT(self):
         return curses.A_STANDOUT
@@ -1870,7 +6963,242 @@ class CursesWindow:
         self.stdscr.erase()
 
 
-def main(stdscr, *args):
+class HeadlessWindow(CursesWindow):
+    """A CursesWindow that draws nowhere.
+
+    Used to replay a KeyJournal without a terminal. Like the real thing,
+    it complains if you draw past the right edge of the screen.
+    """
+    def __init__(self, height, width):
+        self.height = height
+        self.width = width
+
+    @property
+    def A_NORMAL(self):
+        return 0
+
+    @property
+    def A_STANDOUT(self):
+        return 0
+
+    @property
+    def A_DIM(self):
+        return 0
+
+    @property
+    def A_BOLD(self):
+        return 0
+
+    @property
+    def ACS_ULCORNER(self):
+        return 0
+
+    @property
+    def ACS_LLCORNER(self):
+        return 0
+
+    @property
+    def ACS_URCORNER(self):
+        return 0
+
+    @property
+    def ACS_LRCORNER(self):
+        return 0
+
+    @property
+    def ACS_HLINE(self):
+        return 0
+
+    @property
+    def ACS_VLINE(self):
+        return 0
+
+    def getmaxyx(self):
+        return (self.height, self.width)
+
+    def chgat(self, y, x, count, attr):
+        pass
+
+    def addch(self, y, x, ch):
+        pass
+
+    def addstr(self, y, x, text):
+        if x + len(text) > self.width:
+            raise Exception(f"Drawing {len(text)} chars at column {x} overflows a {self.width}-column window")
+
+    def hline(self, y, x, linechar, count):
+        pass
+
+    def vline(self, y, x, linechar, count):
+        pass
+
+    def erase(self):
+        pass
+
+
+class KeyJournal:
+    """A compact binary log of every key the editor receives.
+
+    The file starts with a header (magic, the window size, and the wall-clock
+    start time). Each event after that is a 7-byte record header - the event
+    kind, milliseconds since the start of the journal, and payload length -
+    followed by the payload: the utf-8 encoded key, or the new window size
+    for a resize.
+
+    We flush after every event so that the journal survives the editor (or
+    the ssh session it's running in) dying.
+    """
+    MAGIC = b"BBLJ\x01"
+    HEADER = struct.Struct("<HHd")
+    RECORD = struct.Struct("<BIH")
+    SIZE = struct.Struct("<HH")
+
+    KIND_KEY = 0
+    KIND_RESIZE = 1
+
+    def __init__(self, path, windowY, windowX):
+        self.path = path
+        self.startTime = time.time()
+        self.file = open(path, "wb")
+        self.file.write(self.MAGIC + self.HEADER.pack(windowY, windowX, self.startTime))
+        self.file.flush()
+
+    def _write(self, kind, payload):
+        millis = int((time.time() - self.startTime) * 1000)
+        self.file.write(self.RECORD.pack(kind, millis, len(payload)) + payload)
+        self.file.flush()
+
+    def recordKey(self, key):
+        self._write(self.KIND_KEY, key.encode("utf8", "surrogateescape"))
+
+    def recordResize(self, windowY, windowX):
+        self._write(self.KIND_RESIZE, self.SIZE.pack(windowY, windowX))
+
+    def close(self):
+        self.file.close()
+
+    @staticmethod
+    def read(path):
+        """Read a journal written by KeyJournal.
+
+        Returns ((windowY, windowX), events) where each event is a tuple
+        (millis, key, windowSize) and windowSize is only set for
+        "KEY_RESIZE" events. A record truncated by a crash is ignored.
+        """
+        with open(path, "rb") as f:
+            data = f.read()
+
+        if not data.startswith(KeyJournal.MAGIC):
+            raise Exception(f"{path} is not a bblime key journal")
+
+        pos = len(KeyJournal.MAGIC)
+        windowY, windowX, _ = KeyJournal.HEADER.unpack_from(data, pos)
+        pos += KeyJournal.HEADER.size
+
+        events = []
+
+        while pos + KeyJournal.RECORD.size <= len(data):
+            kind, millis, length = KeyJournal.RECORD.unpack_from(data, pos)
+            pos += KeyJournal.RECORD.size
+
+            if pos + length > len(data):
+                break
+
+            payload = data[pos:pos + length]
+            pos += length
+
+            if kind == KeyJournal.KIND_RESIZE:
+                events.append((millis, "KEY_RESIZE", KeyJournal.SIZE.unpack(payload)))
+            else:
+                events.append((millis, payload.decode("utf8", "surrogateescape"), None))
+
+        return (windowY, windowX), events
+
+
+class ReplayFileSet(DirFileSet):
+    """A DirFileSet that keeps writes in memory, so replaying a journal
+    never touches the files on disk."""
+    def __init__(self, directory, ignore=()):
+        super().__init__(directory, ignore)
+        self.written = {}
+
+    def readlines(self, path):
+        if path in self.written:
+            return list(self.written[path])
+        return super().readlines(path)
+
+    def writelines(self, path, lines):
+        self.written[path] = list(lines)
+
+
+def replayJournal(journalPath, fileSet, window=None, realtime=False):
+    """Re-run the keys in a journal against 'fileSet' without a terminal.
+
+    Args:
+        journalPath - a file written by KeyJournal
+        fileSet - the FileSet the keys should be applied to. This should
+            look like the one the journal was recorded against.
+        window - a CursesWindow to draw into. Defaults to a HeadlessWindow
+            of the size the journal was recorded at.
+        realtime - if True, sleep so that keys arrive with their original
+            timing.
+
+    Returns:
+        (context, keyTimes) - the DisplayContext after the last key, and a
+        list of (key, seconds) giving how long we took to process each key.
+    """
+    (windowY, windowX), events = KeyJournal.read(journalPath)
+
+    if window is None:
+        window = HeadlessWindow(windowY, windowX)
+
+    context = DisplayContext(window, fileSet)
+    context.fullRedraw()
+
+    keyTimes = []
+    replayStart = time.time()
+
+    for millis, key, windowSize in events:
+        if context.wantsToExit:
+            break
+
+        if realtime:
+            time.sleep(max(0, millis / 1000.0 - (time.time() - replayStart)))
+
+        if windowSize is not None:
+            window.height, window.width = windowSize
+
+        t0 = time.time()
+        context.receiveChar(key)
+        keyTimes.append((key, time.time() - t0))
+
+    return context, keyTimes
+
+
+def replayMain(journalPath, dirpath, recover=False, ignore=()):
+    fileSet = ReplayFileSet(dirpath, ignore)
+    context, keyTimes = replayJournal(journalPath, fileSet)
+
+    totalTime = sum(t for _, t in keyTimes)
+    print(f"replayed {len(keyTimes)} keys in {totalTime:.3f} seconds")
+
+    for key, t in sorted(keyTimes, key=lambda kt: -kt[1])[:10]:
+        print(f"    {t * 1000:10.2f} ms  {key!r}")
+
+    for fileName, openFile in sorted(context.openFiles.items()):
+        if openFile.isChanged():
+            if recover:
+                recoveredPath = openFile.path + ".recovered"
+                FileSet.writelines(fileSet, recoveredPath, openFile.lines)
+                print(f"unsaved changes to {fileName} written to {recoveredPath}")
+            else:
+                print(f"{fileName} has unsaved changes")
+
+
+def main(
+    stdscr, dirpath, journalPath=None, memoryBudget=None, unloadInactiveAfter=None, swapDir=None, symbolCacheDir=None,
+    completeFromProject=False, ignore=(), restoreSession=True
+):
     # Clear screen
     stdscr.clear()
     curses.curs_set(0)
@@ -1878,29 +7206,125 @@ def main(stdscr, *args):
     stdscr.keypad(True)
     stdscr.refresh()
 
-    if not len(args):
-        dirpath = "."
-    else:
-        dirpath = args[0]
+    window = CursesWindow(stdscr)
+    window.initColors()
+
+    context = DisplayContext(window, DirFileSet(dirpath, ignore))
+    context.memoryBudget = memoryBudget
+    context.unloadInactiveAfter = unloadInactiveAfter
+
+    if swapDir is not None:
+        context.swapFiles = SwapFiles(swapDir)
+
+    sessionPath = None
+
+    if symbolCacheDir is not None:
+        digest = hashlib.sha1(context.fileSet.directory.encode("utf8", "surrogateescape")).hexdigest()[:16]
+        context.symbolIndex = SymbolIndex(context.fileSet, os.path.join(symbolCacheDir, "symbols-" + digest + ".json"))
+        context.symbolIndex.start()
+
+        # replay ranks Ctrl-P starting from no history, so a recording keeps its history in memory
+        if journalPath is None:
+            context.fileHistory = FileHistory(os.path.join(symbolCacheDir, "history-" + digest + ".json"))
+
+        # a journal replays from an empty editor, so a recorded session has to start from one too
+        if restoreSession and journalPath is None:
+            sessionPath = os.path.join(symbolCacheDir, "session-" + digest + ".json")
+
+    if completeFromProject:
+        context.completions.queueFiles(context.fileSet)
+
+    if journalPath is not None:
+        context.journal = KeyJournal(journalPath, context.windowY, context.windowX)
+
+    if sessionPath is not None:
+        context.loadSession(sessionPath)
 
-    context = DisplayContext(CursesWindow(stdscr), DirFileSet(dirpath))
     context.fullRedraw()
     stdscr.refresh()
 
-    o = 0
+    # wake up every second so the context can do housekeeping while we're idle
+    stdscr.timeout(1000)
 
-    while not context.wantsToExit:
-        key = stdscr.getkey()
+    try:
+        while not context.wantsToExit:
+            # check back often while a command is filtering text, so its output shows up promptly
+            stdscr.timeout(50 if context.pipeJobs else 1000)
 
-        context.receiveChar(key)
+            try:
+                key = stdscr.getkey()
+            except curses.error:
+                context.idle()
+                continue
 
-        stdscr.refresh()
+            context.receiveChar(key)
 
-if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("bblime [dir]")
-        print()
-        print("Edit all the files within 'dir'.")
-        sys.exit(-1)
+            stdscr.refresh()
+    finally:
+        if context.journal is not None:
+            context.journal.close()
+
+        if context.swapFiles is not None:
+            context.swapFiles.close()
+
+        if context.symbolIndex is not None and not context.symbolIndex.isBuilding:
+            context.symbolIndex.save()
 
-    sys.exit(curses.wrapper(lambda stdscr: main(stdscr, *sys.argv[1:])))
+        context.fileHistory.save()
+
+        if sessionPath is not None:
+            context.saveSession(sessionPath)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="bblime", description="Edit all the files within 'dir'.")
+    parser.add_argument("dir")
+    parser.add_argument("--record", metavar="JOURNAL", help="log every key to JOURNAL")
+    parser.add_argument(
+        "--replay", metavar="JOURNAL", help="re-run the keys in JOURNAL without a terminal and report timings"
+    )
+    parser.add_argument(
+        "--memory-budget", metavar="MB", type=float,
+        help="free undo history and unload clean buffers when open files use more than MB megabytes"
+    )
+    parser.add_argument(
+        "--unload-after", metavar="SECONDS", type=float, default=900,
+        help="unload clean buffers that haven't been looked at for this long (default 900)"
+    )
+    parser.add_argument(
+        "--swap-dir", metavar="DIR", default=os.path.expanduser("~/.cache/bblime/swap"),
+        help="where to journal unsaved edits so they survive a crash (default ~/.cache/bblime/swap)"
+    )
+    parser.add_argument("--no-swap", action="store_true", help="don't journal unsaved edits")
+    parser.add_argument(
+        "--cache-dir", metavar="DIR", default=os.path.expanduser("~/.cache/bblime"),
+        help="where to keep the symbol index and file history (default ~/.cache/bblime)"
+    )
+    parser.add_argument(
+        "--recover", action="store_true", help="with --replay, write unsaved buffers to '<file>.recovered'"
+    )
+    parser.add_argument(
+        "--complete-from-project", action="store_true",
+        help="offer identifiers from every file under 'dir' in Ctrl-Space completion, not just open ones"
+    )
+    parser.add_argument(
+        "--no-session", action="store_true", help="don't reopen the files that were open last time"
+    )
+    parser.add_argument(
+        "--ignore", metavar="GLOB", action="append", default=[],
+        help="leave files matching GLOB (a .gitignore pattern) out of Ctrl-P. Can be given more than once"
+    )
+    args = parser.parse_args()
+
+    if args.replay:
+        sys.exit(replayMain(args.replay, args.dir, recover=args.recover, ignore=args.ignore))
+
+    memoryBudget = int(args.memory_budget * 1024 * 1024) if args.memory_budget is not None else None
+
+    sys.exit(curses.wrapper(lambda stdscr: main(
+        stdscr, args.dir, args.record, memoryBudget, args.unload_after,
+        None if args.no_swap else args.swap_dir, args.cache_dir, args.complete_from_project, args.ignore,
+        not args.no_session
+    )))
@@ -1,3 +1,8 @@
+import codecs
+import os
+import shutil
+import subprocess
+
 import pytest
 import bblime
 
@@ -347,3 +352,1168 @@ def test_cut_multiline():
     assert context.currentOpenFile().lines[6] == "line 7"
 
 
+def test_journal_replay(tmp_path):
+    journalPath = str(tmp_path / "keys.journal")
+
+    context = bblime.DisplayContext(FakeWindow(100, 50), canonicalFakeFileSet())
+    context.journal = bblime.KeyJournal(journalPath, context.windowY, context.windowX)
+
+    context.receiveChars(bblime.KEY_CTRL_P, *"boo", "\n", "KEY_END", *"é!", "KEY_DOWN", "KEY_HOME", bblime.KEY_CTRL_D, "Z")
+    context.journal.close()
+
+    (windowY, windowX), events = bblime.KeyJournal.read(journalPath)
+    assert (windowY, windowX) == (50, 100)
+    assert [e[1] for e in events][:4] == [bblime.KEY_CTRL_P, "b", "o", "o"]
+
+    replayed, keyTimes = bblime.replayJournal(journalPath, canonicalFakeFileSet(), FakeWindow(100, 50))
+
+    assert len(keyTimes) == len(events)
+    assert replayed.currentOpenFile().lines == context.currentOpenFile().lines
+    assert replayed.currentOpenFile().lines[0] == "A = 'B'é!"
+    assert replayed.currentOpenFile().lines[1] == "Z = 'C'"
+
+    # a record truncated by a crash gets dropped rather than breaking the replay
+    with open(journalPath, "ab") as f:
+        f.write(b"\x00\x01")
+
+    assert len(bblime.KeyJournal.read(journalPath)[1]) == len(events)
+
+def test_memory_budget():
+    context = bblime.DisplayContext(FakeWindow(100, 50), FakeFileSet(dict(CANONICAL_CONTENTS)))
+
+    # edit 'long.py' a bunch so it has some undo history, then save it
+    context.receiveChars(bblime.KEY_CTRL_P, *"long", "\n", *"abc", "KEY_DOWN", *"def", bblime.KEY_CTRL_S)
+    longPy = context.currentOpenFile()
+    assert len(longPy.undoBuffer.history) == 3
+
+    usage = longPy.memoryUsage()
+    assert usage["text"] > 0 and usage["undo"] > 0
+
+    # the saved copy shares strings with the text, so it costs less than the text
+    assert usage["saved"] < usage["text"]
+
+    # leave 'file.py' dirty
+    context.receiveChars(bblime.KEY_CTRL_P, *"file", "\n", "x")
+    context.receiveChars(bblime.KEY_CTRL_P, *"boo", "\n")
+
+    context.receiveChars(bblime.KEY_CTRL_O)
+    context.receiveChars(bblime.KEY_ESC)
+
+    context.memoryBudget = 0
+    context.enforceMemoryBudget()
+
+    # the dirty file keeps its text, the clean one got unloaded, and the
+    # file we're looking at is untouched
+    filePy = context.openFiles["file.py"]
+    assert filePy.isLoaded and filePy.lines[0] == "x# a comment"
+    assert len(filePy.undoBuffer.history) == 1
+    assert not longPy.isLoaded
+    assert context.currentOpenFile().isLoaded
+
+    # switching back reloads it
+    context.receiveChars(bblime.KEY_CTRL_P, *"long", "\n")
+    assert longPy.isLoaded
+    assert longPy.lines[0] == "abcline 1"
+
+def test_unload_inactive():
+    fileSet = FakeFileSet(dict(CANONICAL_CONTENTS))
+    fileSet.fileContents["long.py"] = "".join(f"line {i}\n" for i in range(1, 200))
+    context = bblime.DisplayContext(FakeWindow(100, 30), fileSet)
+
+    now = [0.0]
+    context.clock = lambda: now[0]
+    context.unloadInactiveAfter = 60
+
+    context.receiveChars(bblime.KEY_CTRL_P, *"long", "\n", bblime.KEY_CTRL_G, *"150\n", "KEY_RIGHT")
+    longPy = context.currentOpenFile()
+    topLine = longPy.topLine
+    assert topLine > 0
+
+    context.receiveChars(bblime.KEY_CTRL_P, *"boo", "\n")
+
+    now[0] = 30
+    context.idle()
+    assert longPy.isLoaded
+
+    now[0] = 100
+    context.idle()
+    assert not longPy.isLoaded
+    assert context.currentOpenFile().isLoaded
+
+    # alt-page-up brings it back where we left it
+    context.receiveChars(bblime.KEY_ALT_PAGE_UP)
+    assert context.currentOpenFile() is longPy
+    assert longPy.lines[149] == "line 150"
+    assert str(longPy.selections[0]) == "149:1"
+    assert longPy.topLine == topLine
+
+    # if the file shrank on disk while it was unloaded, the cursor gets clipped
+    context.receiveChars(bblime.KEY_ALT_PAGE_DOWN)
+    now[0] = 1000
+    context.idle()
+    fileSet.fileContents["long.py"] = "short\n"
+
+    context.receiveChars(bblime.KEY_ALT_PAGE_UP)
+    assert longPy.lines == ["short"]
+    assert str(longPy.selections[0]) == "0:5"
+    assert longPy.topLine == 0
+
+def test_line_interning():
+    contents = dict(CANONICAL_CONTENTS)
+    contents["copy.py"] = contents["file.py"]
+    context = bblime.DisplayContext(FakeWindow(100, 50), FakeFileSet(contents))
+
+    context.receiveChars(bblime.KEY_CTRL_P, *"file", "\n")
+    filePy = context.currentOpenFile()
+    context.receiveChars(bblime.KEY_CTRL_P, *"copy", "\n")
+    copyPy = context.currentOpenFile()
+
+    # identical lines in different buffers are the same object
+    assert all(a is b for a, b in zip(filePy.lines, copyPy.lines))
+
+    # typing and then undoing gets us back the original string objects
+    original = copyPy.lines[1]
+    context.receiveChars(*"xyz")
+    assert copyPy.lines[0] == "xyz# a comment"
+    context.receiveChars(bblime.KEY_CTRL_Z)
+    assert copyPy.lines[0] is filePy.lines[0]
+    assert copyPy.lines[1] is original
+
+    stats = context.sweepLineStore()
+    assert stats["uniqueLines"] == len(set(filePy.lines) | {"xyz# a comment"})
+    assert stats["dedupRatio"] > 2
+
+    # once the edit is gone from the undo history the sweep forgets it
+    copyPy.undoBuffer.evict()
+    context.sweepLineStore()
+    assert "xyz# a comment" not in context.lineStore.table
+
+    # typing on a huge line doesn't keep every version of it around until we're idle
+    contents = dict(CANONICAL_CONTENTS)
+    contents["huge.txt"] = "x" * 2000000
+    context = bblime.DisplayContext(FakeWindow(100, 50), FakeFileSet(contents))
+    context.receiveChars(bblime.KEY_CTRL_P, *"huge", "\n", *"y" * 40)
+    assert context.currentOpenFile().lines[0].startswith("y" * 40)
+    assert context.lineStore.tableBytes < 2 * bblime.LineStore.SWEEP_SLACK_BYTES
+
+
+def test_set_lines_reports_minimal_change():
+    context = bblime.DisplayContext(FakeWindow(100, 50), canonicalFakeFileSet())
+    context.receiveChars(bblime.KEY_CTRL_P, *"long", "\n")
+
+    changes = []
+    longPy = context.currentOpenFile()
+    longPy.buffer.addListener(lambda line0, old, new, source: changes.append((line0, old, new, source)))
+    version = longPy.buffer.version
+
+    newLines = list(longPy.lines)
+    newLines[5:7] = ["five"]
+    longPy.setLines(newLines)
+
+    assert changes == [(5, ["line 6", "line 7"], ["five"], longPy)]
+    assert longPy.buffer.version == version + 1
+
+    # setting the same text again isn't a change at all
+    longPy.setLines(list(newLines))
+    assert len(changes) == 1 and longPy.buffer.version == version + 1
+
+def test_swap_file_recovery(tmp_path):
+    contents = dict(CANONICAL_CONTENTS)
+    swapDir = str(tmp_path / "swap")
+
+    context = bblime.DisplayContext(FakeWindow(100, 50), FakeFileSet(dict(contents)))
+    context.swapFiles = bblime.SwapFiles(swapDir, compactAfter=5)
+
+    context.receiveChars(bblime.KEY_CTRL_P, *"boo", "\n", *"abc", "\n", "KEY_DOWN", bblime.KEY_CTRL_X)
+    edited = list(context.currentOpenFile().lines)
+    assert edited[0] == "abc"
+
+    context.swapFiles.flush()
+    swapPath = context.swapFiles.swapPathFor("boo.py")
+    with open(swapPath) as f:
+        records = f.read().splitlines()
+
+    # we compacted after five operations, so there's a snapshot in there
+    assert any(r.startswith('["s"') for r in records)
+
+    # 'crash', and open the file again in a new session
+    context = bblime.DisplayContext(FakeWindow(100, 50), FakeFileSet(dict(contents)))
+    context.swapFiles = bblime.SwapFiles(swapDir)
+    context.receiveChars(bblime.KEY_CTRL_P, *"boo", "\n")
+
+    assert isinstance(context.displays[-1], bblime.RecoverSwapDialog)
+    context.receiveChars("y")
+
+    assert context.currentOpenFile().lines == edited
+    assert context.currentOpenFile().isChanged()
+
+    # once we save, there's nothing to recover any more
+    context.receiveChars(bblime.KEY_CTRL_S)
+    context.swapFiles.close()
+    assert not bblime.os.path.exists(swapPath)
+
+
+def test_swap_file_ignores_stale_journal(tmp_path):
+    swapFiles = bblime.SwapFiles(str(tmp_path))
+    swapFiles.recordChange("a.py", ["one", "two"], 0, 1, ["ONE"], ["ONE", "two"])
+
+    assert swapFiles.recover("a.py", ["one", "two"]) is None
+
+    swapFiles.close()
+
+    swapFiles = bblime.SwapFiles(str(tmp_path))
+    assert swapFiles.recover("a.py", ["one", "two"]) == ["ONE", "two"]
+
+    # the file changed on disk underneath the journal
+    assert swapFiles.recover("a.py", ["one", "two", "three"]) is None
+    swapFiles.close()
+
+def test_incremental_highlighting():
+    contents = dict(CANONICAL_CONTENTS)
+    contents["doc.py"] = (
+        'def f():\n'
+        '    """a docstring\n'
+        '    that spans lines\n'
+        '    """\n'
+        '    return 1\n'
+    ) + "x = 1\n" * 1000
+    context = bblime.DisplayContext(FakeWindow(100, 30), FakeFileSet(contents))
+
+    context.receiveChars(bblime.KEY_CTRL_P, *"doc", "\n")
+    doc = context.currentOpenFile()
+    highlighter = doc.highlighter
+
+    # only what's on screen got lexed
+    assert highlighter.validUpTo < 30
+
+    def kinds(lineIx):
+        return [kind for _, _, kind in highlighter.runsFor(doc.lines, lineIx)]
+
+    assert kinds(0) == ["keyword", "definition"]
+    assert kinds(2) == ["string"]
+    assert kinds(4) == ["keyword", "number"]
+    assert doc.attributeRunsForLine(0) == [(0, 3, "A_BOLD"), (4, 1, "A_BOLD")]
+
+    # typing on the first line doesn't change any end-of-line state, so we
+    # stop re-lexing right away
+    context.receiveChars("KEY_END", " ")
+    assert highlighter.validUpTo < 30
+
+    # break the closing quotes: everything after is now inside the string
+    context.receiveChars(bblime.KEY_CTRL_G, *"4\n", "KEY_END", "KEY_BACKSPACE")
+    assert kinds(4) == ["string"]
+    assert kinds(900) == ["string"]
+
+    # and fix them again
+    context.receiveChars('"')
+    assert kinds(4) == ["keyword", "number"]
+    assert kinds(900) == ["number"]
+
+def test_symbol_index_and_go_to_definition():
+    contents = dict(CANONICAL_CONTENTS)
+    contents["shapes.py"] = (
+        "class Shape:\n"
+        "    def area(self):\n"
+        "        return 0\n"
+        "\n"
+        "class Square(Shape):\n"
+        "    def area(self):\n"
+        "        return helper(self)\n"
+        "\n"
+        "def helper(x):\n"
+        "    return 1\n"
+    )
+    fileSet = FakeFileSet(contents)
+    context = bblime.DisplayContext(FakeWindow(100, 50), fileSet)
+    context.symbolIndex = bblime.SymbolIndex(fileSet, processes=0)
+    context.symbolIndex.start()
+
+    assert ("Square.area", "method", "shapes.py", 6) in context.symbolIndex.allSymbols()
+    assert ("f", "def", "file.py", 4) in context.symbolIndex.allSymbols()
+
+    # ctrl-T to pick a symbol from anywhere
+    context.receiveChars(bblime.KEY_CTRL_T, *"Square.ar", "\n")
+    assert context.currentOpenFile().fileName == "shapes.py"
+    assert context.currentOpenFile().selections[0].line0 == 5
+
+    # F12 on 'helper' jumps straight to its definition
+    context.receiveChars(bblime.KEY_CTRL_G, *"7\n", *["KEY_RIGHT"] * 16, bblime.KEY_F12)
+    assert context.currentOpenFile().selections[0].line0 == 8
+
+    # F12 on 'area' is ambiguous, so we get a picker
+    context.receiveChars(bblime.KEY_CTRL_G, *"2\n", *["KEY_RIGHT"] * 9, bblime.KEY_F12)
+    assert isinstance(context.displays[-1], bblime.SymbolSelector)
+    assert len(context.displays[-1].matches) == 2
+
+
+def test_symbol_index_cache(tmp_path):
+    (tmp_path / "src").mkdir()
+    (tmp_path / "src" / "a.py").write_text("def alpha():\n    pass\n")
+    (tmp_path / "src" / "b.py").write_text("class Beta:\n    pass\n")
+    cachePath = str(tmp_path / "cache" / "symbols.json")
+
+    fileSet = bblime.DirFileSet(str(tmp_path / "src"))
+    index = bblime.SymbolIndex(fileSet, cachePath, processes=1)
+    index.start()
+    index.thread.join()
+
+    assert sorted(s[0] for s in index.allSymbols()) == ["Beta", "alpha"]
+
+    # a second index only needs to reparse what changed since the cache was written
+    index = bblime.SymbolIndex(fileSet, cachePath)
+    assert index.staleFiles() == []
+    assert sorted(s[0] for s in index.allSymbols()) == ["Beta", "alpha"]
+
+    # a pool build swaps in its results at the end, keeping files saved from the editor meanwhile
+    (tmp_path / "src" / "b.py").write_text("class Gamma:\n    pass\n")
+    os.utime(str(tmp_path / "src" / "b.py"), (1, 1))
+    index.processes = 2
+    index.start()
+    index.updateFile("a.py", ["def delta():", "    pass"])
+    index.thread.join()
+
+    assert sorted(s[0] for s in index.allSymbols()) == ["Gamma", "delta"]
+
+def test_outline():
+    contents = dict(CANONICAL_CONTENTS)
+    contents["shapes.py"] = (
+        "class Shape:\n"
+        "    def area(self):\n"
+        "        return 0\n"
+        "\n"
+        "def helper(x):\n"
+        "    return 1\n"
+    )
+    context = bblime.DisplayContext(FakeWindow(100, 50), FakeFileSet(contents))
+    context.receiveChars(bblime.KEY_CTRL_P, *"shapes", "\n")
+    shapes = context.currentOpenFile()
+
+    context.receiveChars(bblime.KEY_CTRL_E, *"help", "\n")
+    assert shapes.selections[0].line0 == 4
+
+    outline = shapes.outline
+    assert outline.symbols() == [("Shape", "class", 0), ("Shape.area", "def", 1), ("helper", "def", 4)]
+
+    # add a method; only the edited lines get rescanned, and line numbers below shift
+    context.receiveChars(bblime.KEY_CTRL_G, *"3\n", "KEY_END", "\n", "KEY_BACKSPACE", *"def perimeter(self):")
+    assert shapes.outline is outline
+    assert outline.symbols() == [
+        ("Shape", "class", 0), ("Shape.area", "def", 1), ("Shape.perimeter", "def", 3), ("helper", "def", 5)
+    ]
+
+    # '@' in go-to-line switches to the outline
+    context.receiveChars(bblime.KEY_CTRL_G, "@", *"Shape.per", "\n")
+    assert shapes.selections[0].line0 == 3
+
+
+def test_bracket_matching_and_blocks():
+    contents = dict(CANONICAL_CONTENTS)
+    contents["calls.py"] = (
+        "def f(x):\n"
+        "    if x:\n"
+        "        return g(\n"
+        "            x, \")\", [1, 2]\n"
+        "        )\n"
+        "\n"
+        "    return 0\n"
+    )
+    context = bblime.DisplayContext(FakeWindow(100, 50), FakeFileSet(contents))
+    context.receiveChars(bblime.KEY_CTRL_P, *"calls", "\n")
+    calls = context.currentOpenFile()
+
+    # jump from just after the '(' of 'g(' to just after its partner, skipping the one in the string
+    context.receiveChars(bblime.KEY_CTRL_G, *"3\n", "KEY_END", bblime.KEY_CTRL_RIGHT_BRACKET)
+    assert (calls.selections[0].line1, calls.selections[0].col1) == (4, 9)
+    assert calls.bracketHighlights == {2: [16], 4: [8]}
+
+    context.receiveChars(bblime.KEY_CTRL_RIGHT_BRACKET)
+    assert (calls.selections[0].line1, calls.selections[0].col1) == (2, 17)
+
+    # edits keep the index current
+    context.receiveChars("KEY_HOME", *"(")
+    assert calls.structure.matchingBracket(2, 0) is None
+    assert calls.structure.matchingBracket(2, 17) == (4, 8)
+    context.receiveChars("KEY_BACKSPACE")
+    assert calls.structure.matchingBracket(3, 25) == (3, 20)
+
+    # Ctrl-B selects the indented lines and their header, then the 'if' block, then the whole function
+    context.receiveChars(bblime.KEY_CTRL_G, *"4\n", bblime.KEY_CTRL_B)
+    sel = calls.selections[0]
+    assert (sel.line0, sel.col0, sel.line1, sel.col1) == (2, 0, 3, 26)
+
+    context.receiveChars(bblime.KEY_CTRL_B)
+    sel = calls.selections[0]
+    assert (sel.line0, sel.col0, sel.line1, sel.col1) == (1, 0, 4, 9)
+
+    context.receiveChars(bblime.KEY_CTRL_B)
+    sel = calls.selections[0]
+    assert (sel.line0, sel.col0, sel.line1, sel.col1) == (0, 0, 6, 12)
+
+    # a newline after an open bracket indents
+    context.receiveChars(bblime.KEY_CTRL_G, *"7\n", "KEY_END", *" + h(", "\n")
+    assert calls.lines[7] == "        "
+
+
+def test_folding():
+    contents = dict(CANONICAL_CONTENTS)
+    contents["big.py"] = "".join(
+        f"def f{i}():\n" + "".join(f"    x = {j}\n" for j in range(20)) + "\n" for i in range(50)
+    )
+    context = bblime.DisplayContext(FakeWindow(100, 30), FakeFileSet(contents))
+    context.receiveChars(bblime.KEY_CTRL_P, *"big", "\n")
+    big = context.currentOpenFile()
+
+    # fold f1 from inside its body; the cursor moves to the header
+    context.receiveChars(bblime.KEY_CTRL_G, *"30\n", bblime.KEY_CTRL_K)
+    assert big.selections[0].line1 == 22
+    assert big.folds.isFolded(22)
+
+    # moving down skips the folded body, and so does moving right off the end of the header
+    context.receiveChars("KEY_DOWN")
+    assert big.selections[0].line1 == 43
+    context.receiveChars("KEY_UP", "KEY_UP")
+    assert big.selections[0].line1 == 21
+    context.receiveChars("KEY_DOWN", "KEY_END", "KEY_RIGHT")
+    assert (big.selections[0].line1, big.selections[0].col1) == (43, 0)
+
+    # fold every function: each takes two rows, its header and the blank line after it
+    for i in range(50):
+        context.receiveChars(bblime.KEY_CTRL_G, *str(i * 22 + 1), "\n")
+        if not big.folds or not big.folds.isFolded(i * 22):
+            context.receiveChars(bblime.KEY_CTRL_K)
+
+    assert big.rowCount() == 100
+    context.receiveChars(bblime.KEY_CTRL_G, *"1\n", "KEY_NPAGE")
+    assert big.selections[0].line1 == 15 * 22
+    assert big.rowOfLine(big.topLine) > 0
+
+    # editing inside a fold opens it; editing elsewhere keeps the others
+    big.selections = [bblime.Selection(45, 4, 45, 4)]
+    context.receiveChars("y")
+    assert not big.folds.isHidden(45)
+    assert big.folds.isFolded(0) and big.folds.isFolded(66)
+    assert big.rowOfLine(66) == 4 + 22
+
+    context.receiveChars(bblime.KEY_CTRL_U)
+    assert big.folds is None and big.rowOfLine(66) == 66
+
+
+def test_word_completion():
+    contents = dict(CANONICAL_CONTENTS)
+    contents["words.py"] = (
+        "total_count = 0\n"
+        "total_count += 1\n"
+        "total_sum = 2\n"
+        "unique_thing = 3\n"
+    )
+    fileSet = FakeFileSet(contents)
+    context = bblime.DisplayContext(FakeWindow(100, 50), fileSet)
+    context.receiveChars(bblime.KEY_CTRL_P, *"words", "\n")
+    words = context.currentOpenFile()
+
+    assert [w for _, w in context.completions.complete("tot")] == ["total_count", "total_sum"]
+
+    # a single candidate is inserted straight away
+    context.receiveChars(bblime.KEY_CTRL_G, *"4\n", "KEY_END", "\n", *"uni", bblime.KEY_CTRL_SPACE)
+    assert words.lines[4] == "unique_thing"
+
+    # otherwise a popup offers the commonest first; typing narrows it
+    context.receiveChars("\n", *"tot", bblime.KEY_CTRL_SPACE)
+    popup = context.displays[-1]
+    assert isinstance(popup, bblime.CompletionPopup)
+    assert popup.words == ["total_count", "total_sum"]
+
+    context.receiveChars(*"al_s")
+    assert context.displays[-1] is popup and popup.words == ["total_sum"]
+    context.receiveChars("\n")
+    assert words.lines[5] == "total_sum"
+    assert context.displays[-1] is words
+
+    # one undo takes the whole completion back
+    context.receiveChars(bblime.KEY_CTRL_Z)
+    assert words.lines[5] == "total_s"
+
+    # counts follow edits, and closing the file forgets its words
+    assert ("unique_thing" in [w for _, w in context.completions.complete("uni")])
+    words.selections = [bblime.Selection(3, 0, 4, 12)]
+    context.receiveChars("KEY_BACKSPACE")
+    assert context.completions.complete("uni") == []
+
+    context.receiveChars(bblime.KEY_CTRL_W, "n")
+    assert context.completions.complete("tot") == []
+
+    # the project pass reads files that aren't open
+    context.completions.queueFiles(fileSet)
+    while context.completions.indexSomeFiles(fileSet):
+        pass
+    assert [w for _, w in context.completions.complete("tot")] == ["total_count", "total_sum"]
+    counts = context.completions.complete("tot")
+    assert counts == [(2, "total_count"), (1, "total_sum")]
+
+    # opening a file the project pass has read doesn't count its words twice
+    context.receiveChars(bblime.KEY_CTRL_P, *"words", "\n")
+    words = context.currentOpenFile()
+    assert context.completions.complete("tot") == counts
+
+    # and neither does unloading it forget them
+    words.unload()
+    assert context.completions.complete("tot") == counts
+    words.load()
+    assert context.completions.complete("tot") == counts
+
+    # closing it hands it back to the project pass
+    context.receiveChars(bblime.KEY_CTRL_W)
+    while context.completions.indexSomeFiles(fileSet):
+        pass
+    assert context.completions.complete("tot") == counts
+
+
+def test_split_panes():
+    contents = dict(CANONICAL_CONTENTS)
+    contents["long.py"] = "".join(f"line_{i} = {i}\n" for i in range(200))
+    context = bblime.DisplayContext(FakeWindow(100, 30), FakeFileSet(contents))
+    context.receiveChars(bblime.KEY_CTRL_P, *"long", "\n")
+    long = context.currentOpenFile()
+
+    # split side by side: both halves show the same buffer, the new one has the focus
+    context.receiveChars(bblime.KEY_F7)
+    left, right = context.panes()
+    other = right.display
+    assert left.display is long and other is not long and other.buffer is long.buffer
+    assert context.activePane is right and context.currentOpenFile() is other
+    assert left.rect == (0, 0, 50, 30) and right.rect == (50, 0, 50, 30)
+    assert long.rect == left.rect and other.rect == right.rect
+
+    # each pane scrolls independently
+    context.receiveChars(bblime.KEY_CTRL_G, *"150\n")
+    assert other.topLine > 100
+    context.receiveChars(bblime.KEY_F6)
+    assert context.activePane is left and context.currentOpenFile() is long
+    assert long.topLine == 0 and long.selections[0].line1 == 0
+
+    # but they share the text, and the other view stays on the same lines as it changes
+    context.receiveChars(*"x\n")
+    assert long.lines[:2] == ["x", "line_0 = 0"]
+    assert other.lines is long.lines
+    assert other.selections[0].line1 == 150
+    context.receiveChars(bblime.KEY_F6)
+    assert context.currentOpenFile() is other and other.lines[151] == "line_150 = 150"
+
+    # split the right pane top and bottom, and show another file in the bottom half
+    context.receiveChars(bblime.KEY_SHIFT_F7)
+    assert [p.rect for p in context.panes()] == [(0, 0, 50, 30), (50, 0, 50, 15), (50, 15, 50, 15)]
+    context.receiveChars(bblime.KEY_CTRL_P, *"file.py", "\n")
+    assert [p.display.getTitle().strip() for p in context.panes()] == ["* long.py", "* long.py", "file.py"]
+    assert context.isOnScreen(long)
+
+    # closing panes gives their space back until there's only one
+    context.receiveChars(bblime.KEY_F8)
+    assert [p.rect for p in context.panes()] == [(0, 0, 50, 30), (50, 0, 50, 30)]
+    assert context.currentOpenFile().buffer is long.buffer
+
+    # the views of closed panes stop listening to the buffer
+    context.receiveChars(bblime.KEY_F8)
+    assert context.paneTree is None and context.currentOpenFile() is long and long.rect is None
+    assert long.viewRect() == (0, 0, 100, 30)
+    assert long.buffer.listeners == [long.buffer.recordChange, long.linesReplaced]
+
+
+def test_long_lines():
+    contents = dict(CANONICAL_CONTENTS)
+    contents["wide.py"] = "short = 1\n" + "x = [" + ", ".join(str(i) for i in range(2000)) + "]\nend = 2\n"
+    context = bblime.DisplayContext(FakeWindow(60, 30), FakeFileSet(contents))
+    context.receiveChars(bblime.KEY_CTRL_P, *"wide", "\n")
+    wide = context.currentOpenFile()
+    width = wide.textWidth()
+
+    # moving past the right edge scrolls sideways to keep the cursor visible
+    context.receiveChars("KEY_DOWN", "KEY_END")
+    col = len(wide.lines[1])
+    assert wide.leftmostCol <= col < wide.leftmostCol + width
+    assert wide.screenCellOf(1, col) == (1, col - wide.leftmostCol)
+    assert len(wide.visibleTextForLine(1)) == width
+
+    context.receiveChars("KEY_HOME")
+    assert wide.leftmostCol == 0
+
+    # with wrapping, the line takes several rows and we never scroll sideways
+    context.receiveChars(bblime.KEY_CTRL_L, "KEY_END")
+    assert wide.wrapLines and wide.leftmostCol == 0
+
+    # the cursor at the end of the long line is on screen, at the bottom
+    rows = wide.screenRows(wide.pageRows() - 2)
+    assert all(row[0] == 1 and row[2] - row[1] <= width for row in rows)
+    assert wide.screenCellOf(1, col)[0] == len(rows) - 1
+
+    # and going back to the start of it shows its first row
+    context.receiveChars("KEY_HOME")
+    rows = wide.screenRows(wide.pageRows() - 2)
+    assert rows[0] == (1, 0, rows[1][1], 0) and wide.screenCellOf(1, 0) == (0, 0)
+    context.receiveChars("KEY_UP")
+    assert wide.screenRows(1) == [(0, 0, width, 0)]
+
+    # editing a line only recomputes its wrap points
+    cached = list(wide.wrapCache)
+    context.receiveChars(*"long_")
+    assert wide.wrapCache[0] is not cached[0] and wide.wrapCache[1] is cached[1]
+
+    context.receiveChars(bblime.KEY_CTRL_L)
+    assert not wide.wrapLines and wide.wrapCache is None
+
+
+def test_tabs_and_wide_characters():
+    contents = dict(CANONICAL_CONTENTS)
+    contents["cjk.py"] = "\tx = 1\ns = '日本語'  # c\n" + "漢字" * 60 + "\n"
+    context = bblime.DisplayContext(FakeWindow(60, 30), FakeFileSet(contents))
+    context.receiveChars(bblime.KEY_CTRL_P, *"cjk", "\n")
+    cjk = context.currentOpenFile()
+    width = cjk.textWidth()
+
+    # tabs expand to the next tab stop, and the cursor lands after them
+    assert cjk.visibleTextForLine(0).startswith("    x = 1")
+    assert cjk.screenCellOf(0, 1) == (0, 4)
+
+    # wide characters take two cells, and so do the runs and cursors that cover them
+    assert cjk.screenCellOf(1, 8) == (1, 11)
+    assert cjk.screenCellOf(1, 11) == (1, 14)
+    runs = [(x, n) for x, n, _ in cjk.attributeRunsForLine(1)]
+    assert (4, 8) in runs and (14, 3) in runs
+
+    # scrolling sideways counts cells, so the end of a wide line is visible
+    context.receiveChars("KEY_DOWN", "KEY_DOWN", "KEY_END")
+    row, x = cjk.screenCellOf(2, 120)
+    assert 0 <= x < width
+
+    # a wide character cut in half by the left edge is left out
+    assert cjk.leftmostCol % 2 == 1 and cjk.visibleTextForLine(2)[0] == " "
+    assert bblime.columnMap(cjk.lines[2])[120] == 240
+    assert len(cjk.visibleTextForLine(2).encode("utf-32-le")) // 4 <= width
+
+    # and wrapped rows never hold more cells than fit
+    context.receiveChars(bblime.KEY_CTRL_L)
+    for lineIx, startCol, endCol, startCell in cjk.screenRows(cjk.pageRows() - 2):
+        if lineIx == 2:
+            assert bblime.cellOfCol(cjk.lines[2], min(endCol, 120)) - startCell <= width
+
+
+def test_dir_file_set_ignores(tmp_path):
+    def write(relPath, text=""):
+        path = tmp_path / relPath
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(text)
+
+    write(".gitignore", "# build output\nnode_modules/\n*.log\n!keep.log\n/out\n")
+    write("main.py")
+    write("debug.log")
+    write("keep.log")
+    write("scratch.tmp")
+    write("out/gen.py")
+    write("node_modules/left-pad/index.js")
+    write("pkg/node_modules")
+    write("pkg/out/kept.txt")
+    write("pkg/.gitignore", "*.py\n!api.py\ndocs/**/*.html\n")
+    write("pkg/api.py")
+    write("pkg/impl.py")
+    write("pkg/docs/a/b/index.html")
+    write("pkg/docs/readme.txt")
+    write("pkg/__pycache__/api.cpython-311.pyc")
+    write(".venv/bin/python")
+    write("pkg/.hidden/x.txt")
+
+    fileSet = bblime.DirFileSet(str(tmp_path), ignore=["*.tmp"])
+
+    assert fileSet.sortedNames == [
+        ".gitignore",
+        "keep.log",
+        "main.py",
+        "pkg/.gitignore",
+        "pkg/.hidden/x.txt",
+        "pkg/api.py",
+        "pkg/docs/readme.txt",
+        "pkg/node_modules",
+        "pkg/out/kept.txt",
+    ]
+    assert fileSet.namesToPaths["pkg/api.py"] == str(tmp_path / "pkg" / "api.py")
+
+
+def test_file_selector_frecency(tmp_path):
+    contents = dict(CANONICAL_CONTENTS)
+    contents["lib/util.py"] = "x = 1\n"
+    contents["lib/file_utils.py"] = "y = 2\n"
+    context = bblime.DisplayContext(FakeWindow(100, 50), FakeFileSet(contents))
+
+    now = [1000.0]
+    context.clock = lambda: now[0]
+
+    # nothing's been used, so everything is in alphabetical order
+    context.receiveChars(bblime.KEY_CTRL_P)
+    assert context.displays[-1].matches == sorted(contents)
+    context.receiveChars(bblime.KEY_ESC)
+
+    context.openFile("long.py")
+    context.openFile("lib/util.py")
+    context.openFile("lib/util.py")
+
+    context.receiveChars(bblime.KEY_CTRL_P)
+    selector = context.displays[-1]
+    assert selector.matches[:2] == ["lib/util.py", "long.py"]
+
+    # names starting with the filter come first, even if they're later alphabetically
+    context.receiveChars(*"util")
+    assert selector.filtered == ["lib/file_utils.py", "lib/util.py"]
+    assert selector.matches == ["lib/util.py", "lib/file_utils.py"]
+
+    # narrowing the filter only looks at what passed before
+    selector.allItems = lambda: pytest.fail("refiltered everything")
+    context.receiveChars(*"s")
+    assert selector.matches == ["lib/file_utils.py"]
+    context.receiveChars(bblime.KEY_ESC)
+
+    # the history decays, so what we use now soon beats what we used a lot long ago
+    now[0] += 30 * 24 * 3600
+    context.openFile("boo.py")
+    context.receiveChars(bblime.KEY_CTRL_P)
+    assert context.displays[-1].matches[0] == "boo.py"
+    context.receiveChars(bblime.KEY_ESC)
+
+    # and it survives a restart
+    path = str(tmp_path / "history.json")
+    history = bblime.FileHistory(path, clock=lambda: now[0])
+    history.entries = dict(context.fileHistory.entries)
+    history.needsSave = True
+    history.save()
+
+    reloaded = bblime.FileHistory(path, clock=lambda: now[0])
+    assert reloaded.scoreOf("boo.py") == pytest.approx(1.0)
+    assert 0 < reloaded.scoreOf("lib/util.py") < reloaded.scoreOf("boo.py")
+
+
+def test_session_restore(tmp_path):
+    context = bblime.DisplayContext(FakeWindow(100, 50), FakeFileSet(dict(CANONICAL_CONTENTS)))
+    context.receiveChars(bblime.KEY_CTRL_P, *"long", "\n")
+    context.receiveChars(bblime.KEY_CTRL_G, *"12\n", "KEY_RIGHT", bblime.KEY_SHIFT_RIGHT)
+    context.receiveChars(bblime.KEY_CTRL_P, *"boo", "\n")
+    context.receiveChars("KEY_DOWN")
+    context.receiveChars(bblime.KEY_CTRL_F, *"line", bblime.KEY_ESC)
+
+    path = str(tmp_path / "session.json")
+    context.saveSession(path)
+
+    class CountingFileSet(FakeFileSet):
+        def __init__(self, contents):
+            super().__init__(contents)
+            self.reads = []
+
+        def readlines(self, path):
+            self.reads.append(path)
+            return super().readlines(path)
+
+    fileSet = CountingFileSet(dict(CANONICAL_CONTENTS))
+    restored = bblime.DisplayContext(FakeWindow(100, 50), fileSet)
+    restored.loadSession(path)
+
+    # only the file that had the focus gets read
+    assert sorted(restored.openFiles) == ["boo.py", "long.py"]
+    assert fileSet.reads == ["boo.py"]
+    assert restored.currentOpenFile().fileName == "boo.py"
+    assert restored.currentOpenFile().selections[0].line1 == 1
+    assert restored.findBox.pattern == "line"
+    assert not restored.openFiles["long.py"].isLoaded
+
+    # the others come back when we switch to them, where we left them
+    restored.openFile("long.py")
+    assert fileSet.reads == ["boo.py", "long.py"]
+    sel = restored.currentOpenFile().selections[0]
+    assert (sel.line0, sel.col0, sel.line1, sel.col1) == (11, 1, 11, 2)
+
+    # and a broken session file just means starting empty
+    with open(path, "w") as f:
+        f.write("{not json")
+    empty = bblime.DisplayContext(FakeWindow(100, 50), FakeFileSet(dict(CANONICAL_CONTENTS)))
+    empty.loadSession(path)
+    assert empty.openFiles == {}
+
+
+def test_disk_diff_gutter():
+    context = bblime.DisplayContext(FakeWindow(100, 50), FakeFileSet(dict(CANONICAL_CONTENTS)))
+    context.receiveChars(bblime.KEY_CTRL_P, *"file", "\n")
+    file = context.currentOpenFile()
+
+    assert [file.changeMarkerAt(i) for i in range(5)] == [None] * 5
+
+    # change line 2, insert after line 4, and drop the blank line
+    context.receiveChars(bblime.KEY_CTRL_G, *"2\n", "KEY_END", "!")
+    context.receiveChars(bblime.KEY_CTRL_G, *"4\n", "KEY_END", "\n", *"y = x")
+    context.receiveChars(bblime.KEY_CTRL_G, *"3\n", "KEY_END", "KEY_BACKSPACE")
+
+    assert file.lines == ["# a comment", "CONSTANT = 'hi'!", "def f(x):", "    y = x", "    pass"]
+    assert [file.changeMarkerAt(i) for i in range(5)] == [None, "modified", None, "added", None]
+    assert file.buffer.diskDiff.hunks == [[1, 2, 1, 3], [3, 4, 4, 4]]
+
+    # the incremental diff agrees with diffing from scratch
+    assert file.buffer.diskDiff.hunks == [list(h) for h in bblime.diffLines(file.lines, file.linesOnDisk)]
+
+    # saving makes the file the new baseline
+    context.receiveChars(bblime.KEY_CTRL_S)
+    assert file.buffer.diskDiff.hunks == []
+
+    # deleting lines marks the line above the gap
+    context.receiveChars(bblime.KEY_CTRL_G, *"4\n", "KEY_HOME", bblime.KEY_SHIFT_DOWN, "KEY_BACKSPACE")
+    assert [file.changeMarkerAt(i) for i in range(4)] == [None, None, "deleted", None]
+
+    context.receiveChars(bblime.KEY_CTRL_Z)
+    assert file.buffer.diskDiff.hunks == []
+
+    # adding a line and then undoing or deleting it leaves no hunk behind
+    context = bblime.DisplayContext(FakeWindow(100, 50), FakeFileSet(dict(CANONICAL_CONTENTS)))
+    context.receiveChars(bblime.KEY_CTRL_P, *"file", "\n")
+    file = context.currentOpenFile()
+
+    context.receiveChars(bblime.KEY_CTRL_G, *"2\n", "KEY_END", "\n", *"xy")
+    assert file.buffer.diskDiff.hunks == [[2, 3, 2, 2]]
+    context.receiveChars(bblime.KEY_CTRL_Z, bblime.KEY_CTRL_Z, bblime.KEY_CTRL_Z)
+    assert not file.isChanged()
+    assert file.buffer.diskDiff.hunks == []
+    assert [file.changeMarkerAt(i) for i in range(5)] == [None] * 5
+
+    context.receiveChars(bblime.KEY_CTRL_G, *"2\n", "KEY_END", "\n", *"xy", "KEY_HOME", bblime.KEY_SHIFT_DOWN, "KEY_BACKSPACE")
+    assert file.lines == ["# a comment", "CONSTANT = 'hi'", "", "def f(x):", "    pass"]
+    assert file.buffer.diskDiff.hunks == []
+
+
+def test_diff_lines():
+    assert bblime.diffLines([], []) == []
+    assert bblime.diffLines(list("abc"), list("abc")) == []
+    assert bblime.diffLines(list("abc"), list("axc")) == [(1, 2, 1, 2)]
+    assert bblime.diffLines(list("abcd"), list("ad")) == [(1, 3, 1, 1)]
+
+    # a big rewrite falls back from Myers to patience diffing and still lines up
+    a = ["line %d" % i for i in range(3000)]
+    b = [("changed %d" % i) if i % 3 else a[i] for i in range(3000)]
+    hunks = bblime.diffLines(a, b)
+    rebuilt = []
+    prev = 0
+    for a0, a1, b0, b1 in hunks:
+        rebuilt.extend(a[prev:a0])
+        rebuilt.extend(b[b0:b1])
+        prev = a1
+    rebuilt.extend(a[prev:])
+    assert rebuilt == b
+
+
+@pytest.mark.skipif(shutil.which("git") is None, reason="needs git to build the repository")
+def test_head_diff_gutter(tmp_path):
+    def git(*args):
+        subprocess.run(
+            ["git", "-c", "user.name=t", "-c", "user.email=t@t", "-c", "init.defaultBranch=main"] + list(args),
+            cwd=str(tmp_path), check=True, capture_output=True
+        )
+
+    original = "".join("line %d\n" % i for i in range(200))
+    (tmp_path / "pkg").mkdir()
+    (tmp_path / "pkg" / "a.py").write_text(original)
+    git("init", "-q")
+    git("add", ".")
+    git("commit", "-q", "-m", "one")
+
+    # a second commit and a repack, so HEAD's blob is a delta inside a pack
+    (tmp_path / "pkg" / "a.py").write_text(original.replace("line 100\n", "line one hundred\n"))
+    git("commit", "-q", "-am", "two")
+    git("gc", "-q", "--aggressive")
+    assert not (tmp_path / ".git" / "refs" / "heads" / "main").exists()
+
+    # saved, but not committed
+    (tmp_path / "pkg" / "a.py").write_text(original.replace("line 5\n", "line five\n"))
+
+    context = bblime.DisplayContext(FakeWindow(100, 50), bblime.DirFileSet(str(tmp_path)))
+    context.receiveChars(bblime.KEY_CTRL_P, *"a.py", "\n")
+    file = context.currentOpenFile()
+
+    assert file.changeMarkerAt(5) == "headModified"
+    assert file.changeMarkerAt(100) == "headModified"
+    assert file.changeMarkerAt(6) is None
+
+    # unsaved edits show over committed ones, and the HEAD diff follows along
+    context.receiveChars(bblime.KEY_CTRL_G, *"6\n", "KEY_END", "!")
+    context.receiveChars(bblime.KEY_CTRL_G, *"2\n", "KEY_END", "\n", *"new")
+    assert file.changeMarkerAt(2) == "added"
+    assert file.changeMarkerAt(6) == "modified"
+    assert file.changeMarkerAt(101) == "headModified"
+
+    # after a commit, switching back to the file re-reads HEAD
+    context.receiveChars(bblime.KEY_CTRL_S)
+    git("commit", "-q", "-am", "three")
+    context.openFile("pkg/a.py")
+    assert [file.changeMarkerAt(i) for i in range(len(file.lines))] == [None] * len(file.lines)
+
+    # files git doesn't know about get no HEAD markers at all
+    assert context.fileSet.headBlobId(str(tmp_path / "pkg" / "b.py")) is None
+
+
+def test_text_formats_round_trip(tmp_path):
+    files = {
+        "crlf.py": b"a = 1\r\nb = 2\r\n",
+        "oldmac.txt": b"one\rtwo\r",
+        "latin.txt": "caf\xe9\n".encode("latin-1"),
+        "bom.txt": codecs.BOM_UTF8 + "über\n".encode("utf-8"),
+        "wide.txt": codecs.BOM_UTF16_LE + "x\r\ny".encode("utf-16-le"),
+        "nofinal.txt": b"last",
+        "words.txt": b"over\n",
+        "blob.bin": b"\x7fELF\x00\x01\x02" * 100,
+    }
+    for name, data in files.items():
+        (tmp_path / name).write_bytes(data)
+
+    fileSet = bblime.DirFileSet(str(tmp_path))
+
+    def read(name):
+        return fileSet.readlines(str(tmp_path / name))
+
+    assert read("crlf.py") == ["a = 1", "b = 2"]
+    assert read("oldmac.txt") == ["one", "two"]
+    assert read("latin.txt") == ["caf\xe9"]
+    assert read("bom.txt") == ["über"]
+    assert read("wide.txt") == ["x", "y"]
+    assert read("nofinal.txt") == ["last"]
+
+    # writing back what we read gives the same bytes
+    for name in files:
+        if name != "blob.bin":
+            fileSet.writelines(str(tmp_path / name), read(name))
+            assert (tmp_path / name).read_bytes() == files[name], name
+
+    # typing something latin-1 can't hold turns the file into utf-8
+    fileSet.writelines(str(tmp_path / "latin.txt"), ["caf\xe9 €"])
+    assert (tmp_path / "latin.txt").read_bytes() == "caf\xe9 €\n".encode("utf-8")
+
+    # edits keep the line endings
+    context = bblime.DisplayContext(FakeWindow(100, 50), fileSet)
+    context.receiveChars(bblime.KEY_CTRL_P, *"crlf", "\n", "KEY_END", "\n", *"c = 3", bblime.KEY_CTRL_S)
+    assert (tmp_path / "crlf.py").read_bytes() == b"a = 1\r\nc = 3\r\nb = 2\r\n"
+
+    # and ctrl-P won't open binaries
+    assert fileSet.isBinary(str(tmp_path / "blob.bin"))
+    assert not fileSet.isBinary(str(tmp_path / "wide.txt"))
+
+    context.receiveChars(bblime.KEY_CTRL_P, *"blob", "\n")
+    assert isinstance(context.displays[-1], bblime.FileSelector)
+    assert "binary" in context.displays[-1].message
+    assert "blob.bin" not in context.openFiles
+
+    # nor does completion read them
+    context.completions.queueFiles(fileSet)
+    while context.completions.indexSomeFiles(fileSet):
+        pass
+    assert [w for _, w in context.completions.complete("ov")] == ["over"]
+    assert context.completions.complete("EL") == []
+
+
+def test_block_selection():
+    contents = dict(CANONICAL_CONTENTS)
+    contents["table.txt"] = "".join("row\t%d here\n" % i for i in range(1000)) + "x\n"
+    context = bblime.DisplayContext(FakeWindow(100, 50), FakeFileSet(contents))
+    context.receiveChars(bblime.KEY_CTRL_P, *"table", "\n")
+    file = context.currentOpenFile()
+
+    # a rectangle over the tab and the digit after it, on lines 2-4
+    context.receiveChars("KEY_DOWN", *["KEY_RIGHT"] * 3)
+    context.receiveChars(bblime.KEY_CTRL_ALT_DOWN, bblime.KEY_CTRL_ALT_DOWN)
+    context.receiveChars(*[bblime.KEY_CTRL_ALT_RIGHT] * 2)
+
+    block = file.block
+    assert (block.top, block.bottom, block.left, block.right) == (1, 3, 3, 5)
+    assert [s.selectedText(file.lines) for s in block.selections(file.lines)] == ["\t1", "\t2", "\t3"]
+
+    # copying works on it like any other set of selections, and keeps it
+    context.receiveChars(bblime.KEY_CTRL_C)
+    assert context.clipboard == ["\t1", "\t2", "\t3"]
+    assert file.block is block
+
+    context.receiveChars("|")
+    assert file.lines[:5] == ["row\t0 here", "row| here", "row| here", "row| here", "row\t4 here"]
+    assert [(s.line1, s.col1) for s in file.block.selections(file.lines)] == [(1, 4), (2, 4), (3, 4)]
+
+    context.receiveChars("KEY_BACKSPACE", "KEY_DC")
+    assert file.lines[1:4] == ["rowhere"] * 3
+
+    # undo treats the run of edits like ordinary typing, and the block is gone afterwards
+    context.receiveChars(bblime.KEY_CTRL_Z)
+    assert file.lines[1:4] == ["row\t1 here", "row\t2 here", "row\t3 here"]
+    assert file.block is None
+
+    # a block down the whole file is edited as a single splice
+    edits = []
+    file.buffer.addListener(lambda line0, oldLines, newLines, source: edits.append((line0, len(oldLines))))
+
+    context.receiveChars(bblime.KEY_CTRL_G, *"1\n", "KEY_HOME", *[bblime.KEY_CTRL_ALT_DOWN] * 1000)
+    context.receiveChars(*"# ")
+    assert edits == [(0, 1001), (0, 1001)]
+    assert file.lines[0] == "# row\t0 here"
+    assert file.lines[1000] == "# x"
+
+    # shorter lines than the block just get a cursor at their end
+    context.receiveChars(bblime.KEY_ESC, bblime.KEY_CTRL_G, *"1000\n", "KEY_END")
+    context.receiveChars(bblime.KEY_CTRL_ALT_DOWN, "!")
+    assert file.lines[999:] == ["# row\t999 here!", "# x!"]
+
+    # each line keeps its own cursor, even where the block cut through a tab or a wide character
+    contents["wide.txt"] = "ab\tc\n\nx\n\u4e16\u754cz\n"
+    contents["empty.txt"] = ""
+    context = bblime.DisplayContext(FakeWindow(100, 50), FakeFileSet(contents))
+    context.receiveChars(bblime.KEY_CTRL_P, *"wide", "\n", "KEY_RIGHT")
+    wide = context.currentOpenFile()
+    context.receiveChars(*[bblime.KEY_CTRL_ALT_DOWN] * 3, *[bblime.KEY_CTRL_ALT_RIGHT] * 2, "Q")
+    assert wide.lines == ["aQc", "Q", "xQ", "\u4e16Qz"]
+    context.receiveChars("KEY_BACKSPACE", "KEY_BACKSPACE")
+    assert wide.lines == ["c", "", "", "z"]
+
+    # and typing into a block in an empty file starts its first line
+    context.receiveChars(bblime.KEY_ESC, bblime.KEY_CTRL_P, *"empty", "\n", bblime.KEY_CTRL_ALT_DOWN, "Q")
+    assert context.currentOpenFile().lines == ["Q"]
+
+
+def test_keyboard_macros():
+    contents = dict(CANONICAL_CONTENTS)
+    contents["items.txt"] = "".join("item %d\n" % i for i in range(20000))
+    context = bblime.DisplayContext(FakeWindow(100, 50), FakeFileSet(contents))
+    context.receiveChars(bblime.KEY_CTRL_P, *"items", "\n")
+    file = context.currentOpenFile()
+
+    context.receiveChars(bblime.KEY_F9, "KEY_HOME", *"- ", "KEY_END", ";", "KEY_DOWN", bblime.KEY_F9)
+    assert context.macro == ["KEY_HOME", "-", " ", "KEY_END", ";", "KEY_DOWN"]
+    assert file.lines[:2] == ["- item 0;", "item 1"]
+
+    # with a selection over several lines, it plays once at the start of each
+    file.selections = [bblime.Selection(1, 0, 20000, 0)]
+    context.receiveChars(bblime.KEY_F10)
+    assert file.lines[1] == "- item 1;"
+    assert file.lines[19999] == "- item 19999;"
+    assert all(line.startswith("- ") and line.endswith(";") for line in file.lines)
+    assert file.buffer.diskDiff.hunks == [[0, 20000, 0, 20000]]
+
+    # and undoes in one step
+    context.receiveChars(bblime.KEY_CTRL_Z)
+    assert file.lines[:3] == ["- item 0;", "item 1", "item 2"]
+    assert file.lines[19999] == "item 19999"
+    assert file.buffer.diskDiff.hunks == [[0, 1, 0, 1]]
+
+    # shift-F10 asks how many times to play it
+    context.receiveChars(bblime.KEY_CTRL_G, *"5\n")
+    context.receiveChars(bblime.KEY_SHIFT_F10, *"3\n")
+    assert file.lines[4:8] == ["- item 4;", "- item 5;", "- item 6;", "item 7"]
+    assert file.selections[-1].line1 == 7
+
+    # a count of zero plays nothing, and a huge one stops at MAX_MACRO_PLAYS
+    context.receiveChars(bblime.KEY_SHIFT_F10, *"0\n")
+    assert file.lines[7] == "item 7"
+
+    file.MAX_MACRO_PLAYS = 5
+    context.receiveChars(bblime.KEY_SHIFT_F10, *"999999999\n")
+    assert file.lines[7:13] == ["- item 7;", "- item 8;", "- item 9;", "- item 10;", "- item 11;", "item 12"]
+    assert "stopped" in file.status
+
+    # a macro that deletes the line it's on walks through the selection all the same
+    context.receiveChars(bblime.KEY_F9, "KEY_HOME", bblime.KEY_SHIFT_DOWN, "KEY_BACKSPACE", bblime.KEY_F9)
+    file.selections = [bblime.Selection(100, 0, 110, 0)]
+    context.receiveChars(bblime.KEY_F10)
+    assert file.lines[99:101] == ["item 100", "item 111"]
+
+
+@pytest.mark.skipif(shutil.which("sort") is None, reason="needs a unix shell")
+def test_pipe_through_command():
+    contents = dict(CANONICAL_CONTENTS)
+    contents["nums.txt"] = "3\n1\n2\n"
+    contents["big.txt"] = "".join("line %d\n" % i for i in range(200000))
+    context = bblime.DisplayContext(FakeWindow(100, 50), FakeFileSet(contents))
+
+    def finish(file):
+        assert file.pipeJob.wait(30)
+        context.idle()
+
+    # with nothing selected, the whole text goes through it
+    context.receiveChars(bblime.KEY_CTRL_P, *"nums", "\n")
+    file = context.currentOpenFile()
+    context.receiveChars(bblime.KEY_CTRL_BACKSLASH, *"sort -n", "\n")
+    finish(file)
+    assert file.lines == ["1", "2", "3"]
+
+    # in one undo step
+    context.receiveChars(bblime.KEY_CTRL_Z)
+    assert file.lines == ["3", "1", "2"]
+
+    # each selection gets its own run of the command, and the last command is remembered
+    file.selections = [bblime.Selection(0, 0, 0, 1), bblime.Selection(1, 0, 2, 1)]
+    context.receiveChars(bblime.KEY_CTRL_BACKSLASH, *["KEY_BACKSPACE"] * 2, *"| wc -l", "\n")
+    finish(file)
+    assert file.lines == ["1", "2"]
+
+    # failures leave the text alone and say why
+    context.receiveChars(bblime.KEY_CTRL_BACKSLASH, *["KEY_BACKSPACE"] * 20, *"echo oops >&2; exit 3", "\n")
+    finish(file)
+    assert file.lines == ["1", "2"]
+    assert file.status == "echo oops >&2; exit 3: exited with status 3: oops"
+
+    # output that arrives after the text was edited is dropped
+    context.receiveChars(bblime.KEY_CTRL_BACKSLASH, *["KEY_BACKSPACE"] * 30, *"sleep 0.2; cat", "\n")
+    context.receiveChars("x")
+    finish(file)
+    assert file.lines == ["x1", "2"]
+    assert "changed" in file.status
+
+    # more text than a pipe holds goes through without deadlocking
+    context.receiveChars(bblime.KEY_CTRL_P, *"big", "\n")
+    big = context.currentOpenFile()
+    context.receiveChars(bblime.KEY_CTRL_BACKSLASH, *["KEY_BACKSPACE"] * 30, *"tac", "\n")
+    finish(big)
+    assert big.lines[0] == "line 199999"
+    assert big.lines[-1] == "line 0"
+    assert len(big.lines) == 200000
+
+
+def test_line_operations():
+    contents = dict(CANONICAL_CONTENTS)
+    contents["names.txt"] = "file10\nFile2\nb\n  b\nfile1\nb\n"
+    contents["big.txt"] = "".join("%d\n" % ((i * 7919) % 100000) for i in range(100000))
+    context = bblime.DisplayContext(FakeWindow(100, 50), FakeFileSet(contents))
+    context.receiveChars(bblime.KEY_CTRL_P, *"names", "\n")
+    file = context.currentOpenFile()
+
+    # with nothing selected, it's the whole file
+    context.receiveChars(bblime.KEY_F4, *"sort lines", "\n")
+    assert file.lines == ["  b", "File2", "b", "b", "file1", "file10"]
+
+    context.receiveChars(bblime.KEY_F4, *"naturally", "\n")
+    assert file.lines == ["  b", "b", "b", "file1", "File2", "file10"]
+
+    # a selection ending at the start of a line leaves that line alone
+    file.selections = [bblime.Selection(1, 0, 4, 0)]
+    context.receiveChars(bblime.KEY_F4, *"unique", "\n")
+    assert file.lines == ["  b", "b", "file1", "File2", "file10"]
+    assert file.selections == [bblime.Selection(1, 0, 2, 5)]
+
+    file.selections = [bblime.Selection(0, 0, 3, 2)]
+    context.receiveChars(bblime.KEY_F4, *"join", "\n")
+    assert file.lines == ["  b b file1 File2", "file10"]
+
+    # each one is a single undo step
+    context.receiveChars(bblime.KEY_CTRL_Z)
+    assert file.lines == ["  b", "b", "file1", "File2", "file10"]
+
+    # and a big range goes in a single edit
+    context.receiveChars(bblime.KEY_CTRL_P, *"big", "\n")
+    big = context.currentOpenFile()
+    edits = []
+    big.buffer.addListener(lambda line0, oldLines, newLines, source: edits.append((line0, len(oldLines), len(newLines))))
+
+    context.receiveChars(bblime.KEY_F4, *"by number", "\n")
+    assert edits == [(0, 100000, 100000)]
+    assert big.lines[:3] == ["0", "1", "2"]
+    assert big.lines[-1] == "99999"
+
+    context.receiveChars(bblime.KEY_F4, *"reverse", "\n")
+    assert big.lines[0] == "99999"
+    assert big.buffer.diskDiff.markerAt(50000) == "modified"
+
+    context.receiveChars(bblime.KEY_CTRL_Z, bblime.KEY_CTRL_Z)
+    assert big.lines[:2] == ["0", "7919"]
+    assert big.buffer.diskDiff.hunks == []